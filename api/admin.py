@@ -1,9 +1,111 @@
-from django.contrib import admin
-from .models import Member, ReferralRelation, Transaction, Level
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.contrib.admin.views.main import ORDER_VAR
+from django.db import transaction
+from django.db.models import Max, Min, Q, QuerySet
+from django.utils import timezone
+from .models import Member, ReferralRelation, Transaction, Level, BackfillCheckpoint, LedgerEntry
+from .pagination import EstimatedCountPaginator
+from .search import rank_username, username_match
+
+
+class DateProbeQuerySet(QuerySet):
+    """
+    QuerySet whose datetimes() checks each candidate year, month or day with
+    an indexed range EXISTS instead of truncating every row, so the admin
+    date hierarchy stays cheap on large tables.
+    """
+    
+    def aggregate(self, *args, **kwargs):
+        # SQLite only answers a lone MIN() or MAX() from an index, so the
+        # hierarchy's combined first/last lookup runs as separate queries
+        if not args and len(kwargs) > 1 and all(isinstance(value, (Min, Max)) for value in kwargs.values()):
+            result = {}
+            for name, value in kwargs.items():
+                result.update(super().aggregate(**{name: value}))
+            return result
+        return super().aggregate(*args, **kwargs)
+    
+    def datetimes(self, field_name, kind, order='ASC', tzinfo=None):
+        if kind not in ('year', 'month', 'day'):
+            return super().datetimes(field_name, kind, order, tzinfo)
+        
+        tzinfo = tzinfo or timezone.get_current_timezone()
+        bounds = self.aggregate(first=Min(field_name), last=Max(field_name))
+        if bounds['first'] is None:
+            return []
+        first = timezone.localtime(bounds['first'], tzinfo)
+        last = timezone.localtime(bounds['last'], tzinfo)
+        
+        periods = []
+        period = first.replace(
+            month=1 if kind == 'year' else first.month,
+            day=first.day if kind == 'day' else 1,
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        while period <= last:
+            if kind == 'year':
+                following = datetime(period.year + 1, 1, 1)
+            elif kind == 'month':
+                following = datetime(period.year + period.month // 12, period.month % 12 + 1, 1)
+            else:
+                following = datetime.fromordinal(period.toordinal() + 1)
+            following = timezone.make_aware(following, tzinfo)
+            if self.filter(**{f'{field_name}__gte': period, f'{field_name}__lt': following}).exists():
+                periods.append(period)
+            period = following
+        return periods if order == 'ASC' else periods[::-1]
+
+
+class DateProbeMixin:
+    """Admin mixin using DateProbeQuerySet for the change list"""
+    
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return DateProbeQuerySet(model=queryset.model, query=queryset.query, using=queryset.db)
+
+
+class BonusActionForm(ActionForm):
+    """Action bar fields for granting a manual bonus to selected members"""
+    amount = forms.DecimalField(
+        max_digits=15,
+        decimal_places=2,
+        min_value=Decimal('0.01'),
+        required=False
+    )
+    reason = forms.CharField(max_length=200, required=False)
+
+
+def batch_summary(summary, elapsed):
+    """Human readable result of a batched balance action"""
+    return (
+        f"{summary['deposits']} deposits confirmed and {summary['bonuses']} bonuses recorded, "
+        f"{summary['members']} members credited (+{summary['vcoins']} V-Coins, "
+        f"+{summary['rubles']} rubles) in {elapsed:.1f}s"
+    )
+
+
+class ReferralLevelFilter(admin.SimpleListFilter):
+    """Fixed 1-10 choices, avoiding a DISTINCT scan of the relation table"""
+    title = 'level'
+    parameter_name = 'level'
+    
+    def lookups(self, request, model_admin):
+        return [(level, str(level)) for level in range(1, ReferralRelation.MAX_LEVEL + 1)]
+    
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(level=self.value())
+        return queryset
 
 
 @admin.register(Member)
-class MemberAdmin(admin.ModelAdmin):
+class MemberAdmin(DateProbeMixin, admin.ModelAdmin):
     list_display = (
         'id',
         'username',
@@ -18,8 +120,14 @@ class MemberAdmin(admin.ModelAdmin):
     )
     list_filter = ('user_type', 'level', 'is_admin', 'first_tournament_played', 'created_at')
     search_fields = ('username', 'referral_code')
+    search_help_text = 'Username substring or exact referral code'
     readonly_fields = ('referral_code', 'created_at')
     ordering = ('-created_at',)
+    date_hierarchy = 'created_at'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    action_form = BonusActionForm
+    actions = ['grant_bonus']
     
     fieldsets = (
         ('Basic Information', {
@@ -35,10 +143,61 @@ class MemberAdmin(admin.ModelAdmin):
             'fields': ('created_at',)
         }),
     )
+    
+    @admin.action(description='Grant bonus (amount and reason) to selected members')
+    def grant_bonus(self, request, queryset):
+        form = self.action_form(request.POST)
+        form.fields['action'].choices = self.get_action_choices(request)
+        if not form.is_valid() or not form.cleaned_data['amount'] or not form.cleaned_data['reason']:
+            self.message_user(request, 'Enter a positive amount and a reason for the bonus', messages.ERROR)
+            return
+        
+        started = time.monotonic()
+        summary = Transaction.grant_bonuses(
+            queryset,
+            form.cleaned_data['amount'],
+            form.cleaned_data['reason']
+        )
+        self.message_user(request, batch_summary(summary, time.monotonic() - started), messages.SUCCESS)
+    
+    def save_model(self, request, obj, form, change):
+        """Save the member, recording balance edits as ledger adjustments"""
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            if not change:
+                adjustments = {'vcoins': obj.balance_vcoins, 'rubles': obj.balance_rubles}
+            else:
+                # save() never writes balances, so an edit is applied as the
+                # difference to the loaded value and keeps concurrent credits
+                adjustments = {
+                    currency: getattr(obj, field) - form.initial[field]
+                    for currency, field in (('vcoins', 'balance_vcoins'), ('rubles', 'balance_rubles'))
+                }
+                if any(adjustments.values()):
+                    Member.apply_balance_deltas({obj.pk: (adjustments['vcoins'], adjustments['rubles'])})
+            LedgerEntry.append([
+                LedgerEntry(member_id=obj.pk, currency=currency, amount=amount, type='adjustment')
+                for currency, amount in adjustments.items()
+                if amount
+            ])
+    
+    def get_search_results(self, request, queryset, search_term):
+        """Search usernames through the trigram index, prefix matches first"""
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        queryset = queryset.filter(
+            # Codes are generated upper case; an exact match keeps the unique index usable
+            username_match(search_term) | Q(referral_code=search_term.upper())
+        )
+        # A column picked in the change list overrides relevance order
+        if ORDER_VAR not in request.GET:
+            queryset = rank_username(queryset, search_term)
+        return queryset, False
 
 
 @admin.register(ReferralRelation)
-class ReferralRelationAdmin(admin.ModelAdmin):
+class ReferralRelationAdmin(DateProbeMixin, admin.ModelAdmin):
     list_display = (
         'id',
         'referrer',
@@ -46,10 +205,16 @@ class ReferralRelationAdmin(admin.ModelAdmin):
         'level',
         'created_at'
     )
-    list_filter = ('level', 'created_at')
+    list_filter = (ReferralLevelFilter, 'created_at')
+    list_select_related = ('referrer', 'referred')
     search_fields = ('referrer__username', 'referred__username')
+    search_help_text = 'Referrer or referred username substring'
+    raw_id_fields = ('referrer', 'referred')
     readonly_fields = ('created_at',)
     ordering = ('-created_at',)
+    date_hierarchy = 'created_at'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     
     fieldsets = (
         ('Referral Information', {
@@ -59,10 +224,19 @@ class ReferralRelationAdmin(admin.ModelAdmin):
             'fields': ('created_at',)
         }),
     )
+    
+    def get_search_results(self, request, queryset, search_term):
+        """Search either side's username through the trigram index"""
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.filter(
+            username_match(search_term, 'referrer__') | username_match(search_term, 'referred__')
+        ), False
 
 
 @admin.register(Transaction)
-class TransactionAdmin(admin.ModelAdmin):
+class TransactionAdmin(DateProbeMixin, admin.ModelAdmin):
     list_display = (
         'id',
         'member',
@@ -74,9 +248,16 @@ class TransactionAdmin(admin.ModelAdmin):
         'created_at'
     )
     list_filter = ('type', 'currency', 'status', 'created_at')
-    search_fields = ('member__username', 'related_member__username', 'description')
+    list_select_related = ('member', 'related_member')
+    search_fields = ('member__username', 'related_member__username')
+    search_help_text = 'Member or related member username substring'
+    raw_id_fields = ('member', 'related_member')
     readonly_fields = ('created_at',)
     ordering = ('-created_at',)
+    date_hierarchy = 'created_at'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['confirm_pending_deposits']
     
     fieldsets = (
         ('Transaction Information', {
@@ -89,6 +270,29 @@ class TransactionAdmin(admin.ModelAdmin):
             'fields': ('created_at',)
         }),
     )
+    
+    @admin.action(description='Confirm selected pending deposits')
+    def confirm_pending_deposits(self, request, queryset):
+        selected = queryset.count()
+        started = time.monotonic()
+        summary = Transaction.confirm_deposits(queryset)
+        self.message_user(request, batch_summary(summary, time.monotonic() - started), messages.SUCCESS)
+        skipped = selected - summary['deposits']
+        if skipped:
+            self.message_user(
+                request,
+                f'{skipped} selected transactions were not pending deposits and were left unchanged',
+                messages.WARNING
+            )
+    
+    def get_search_results(self, request, queryset, search_term):
+        """Search member and related member usernames through the trigram index"""
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.filter(
+            username_match(search_term, 'member__') | username_match(search_term, 'related_member__')
+        ), False
 
 
 @admin.register(Level)
@@ -107,3 +311,34 @@ class LevelAdmin(admin.ModelAdmin):
             'fields': ('name', 'required_referrals', 'bonus_multiplier')
         }),
     )
+    
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change or {'name', 'required_referrals'} & set(form.changed_data):
+            self.recompute_levels(request)
+    
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self.recompute_levels(request)
+    
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        self.recompute_levels(request)
+    
+    def recompute_levels(self, request):
+        changed = Level.recompute_member_levels()
+        self.message_user(request, f'Member levels recomputed, {changed} changed')
+
+
+@admin.register(BackfillCheckpoint)
+class BackfillCheckpointAdmin(admin.ModelAdmin):
+    list_display = (
+        'name',
+        'last_pk',
+        'target_pk',
+        'rows_processed',
+        'updated_at',
+        'completed_at'
+    )
+    readonly_fields = ('started_at', 'updated_at')
+    ordering = ('name',)
@@ -0,0 +1,162 @@
+"""
+Admission control and load shedding.
+
+Every API and admin request is classified into a route class (auth, read,
+write, admin) and has to take a token from the token buckets of its class:
+one for the whole site, one per client IP and, for signed-in members, one
+per member. Buckets use GCRA, a token bucket stored as a single
+"theoretical arrival time" per key in the default cache, so they are
+shared by all workers when the cache backend is; with the per-process
+locmem cache the site-wide rates are split between the workers instead.
+A request is only charged when every bucket admits it, so refused requests
+do not drain the buckets that did have tokens. Reads and writes of the
+buckets are not atomic, so concurrent workers can over-admit slightly.
+
+Only credential POSTs (login, register, logout) are auth requests; the
+small site-wide auth bucket guards password hashing, not the session
+reads of /api/auth/me, which are ordinary reads.
+
+Per-client limits answer 429; the site-wide class limit and requests that
+already waited in the queue longer than ADMISSION_MAX_QUEUE_WAIT (from
+nginx's X-Request-Start) answer 503. Both carry Retry-After, and are cheap:
+no view, no database. Concurrency is not limited here: a sync worker only
+ever has one request in progress, so a per-process in-flight count cannot
+shed anything; gunicorn's worker count and nginx's queue bound it instead.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+
+from api import metrics
+
+EXEMPT_PREFIXES = ('/api/health/', '/api/metrics')
+AUTH_PATHS = ('/api/auth/login', '/api/auth/register', '/api/auth/logout')
+ADMIN_PREFIXES = ('/api/admin/', '/admin/')
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+def client_ip(request):
+    """Client address: X-Real-IP set by nginx, else the socket peer"""
+    return request.META.get('HTTP_X_REAL_IP') or request.META.get('REMOTE_ADDR')
+
+
+def route_class(request):
+    """auth, admin, write or read; None for requests outside admission control"""
+    path = request.path
+    if path.startswith(EXEMPT_PREFIXES) or not path.startswith(('/api/',) + ADMIN_PREFIXES):
+        return None
+    if request.method == 'POST' and path.rstrip('/') in AUTH_PATHS:
+        return 'auth'
+    if path.startswith(ADMIN_PREFIXES):
+        return 'admin'
+    if request.method in WRITE_METHODS:
+        return 'write'
+    return 'read'
+
+
+def take_tokens(buckets, now):
+    """
+    Take one token from each of the (key, rate, burst) buckets, refilling
+    `rate` tokens per second up to `burst`. Tokens are only taken when every
+    bucket has one: returns (None, 0) when admitted, otherwise the index of
+    the first empty bucket and the seconds until it frees a token.
+    """
+    cache_keys = [f'admission:{key}' for key, _, _ in buckets]
+    stored = cache.get_many(cache_keys)
+    arrivals = {}
+    timeout = 1
+    for index, (cache_key, (_, rate, burst)) in enumerate(zip(cache_keys, buckets)):
+        interval = 1.0 / rate
+        capacity = burst * interval
+        new_arrival = max(stored.get(cache_key, now), now) + interval
+        wait = new_arrival - now - capacity
+        if wait > 0:
+            return index, wait
+        arrivals[cache_key] = new_arrival
+        timeout = max(timeout, math.ceil(capacity) + 1)
+    cache.set_many(arrivals, timeout)
+    return None, 0
+
+
+def queue_wait(request, now):
+    """Seconds the request waited before reaching Django, if nginx stamped it"""
+    header = request.META.get('HTTP_X_REQUEST_START', '')
+    try:
+        started = float(header[2:] if header.startswith('t=') else header)
+    except ValueError:
+        return None
+    # Tolerate milli- or microsecond stamps from other proxies
+    while started > now * 100:
+        started /= 1000
+    return max(now - started, 0)
+
+
+def reject(status_code, error, detail, retry_after, route, reason):
+    metrics.inc('admission_rejected_total', route_class=route, reason=reason)
+    response = JsonResponse({'error': error, 'detail': detail}, status=status_code)
+    response['Retry-After'] = str(max(math.ceil(retry_after), 1))
+    return response
+
+
+class AdmissionControlMiddleware:
+    """Shed load early with 429/503 responses instead of queueing it"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        route = route_class(request) if settings.ADMISSION_CONTROL else None
+        if route is None:
+            return self.get_response(request)
+
+        rejection = self.check(request, route)
+        if rejection is not None:
+            return rejection
+        return self.get_response(request)
+
+    def check(self, request, route):
+        now = time.time()
+
+        waited = queue_wait(request, now)
+        if waited is not None and waited > settings.ADMISSION_MAX_QUEUE_WAIT:
+            return reject(
+                503, 'Service overloaded', f'Request waited {waited:.1f}s in the queue',
+                settings.ADMISSION_MAX_QUEUE_WAIT, route, 'queue_wait'
+            )
+
+        rates = settings.ADMISSION_RATES.get(route, {})
+        member_id = request.session.get('member_id') if hasattr(request, 'session') else None
+        # Per-client buckets first, so one noisy client is answered 429 for
+        # its own limit rather than 503 for the site's
+        buckets = [('ip', f'{route}:ip:{client_ip(request)}')]
+        if member_id:
+            buckets.append(('member', f'{route}:member:{member_id}'))
+        buckets.append(('global', route))
+
+        scopes, limits = [], []
+        for scope, key in buckets:
+            if scope not in rates:
+                continue
+            rate, burst = rates[scope]
+            if scope == 'global':
+                # Split between workers that each keep their own buckets
+                rate, burst = rate / settings.ADMISSION_WORKERS, max(burst / settings.ADMISSION_WORKERS, 1)
+            scopes.append(scope)
+            limits.append((key, rate, burst))
+
+        index, wait = take_tokens(limits, now)
+        if index is None:
+            return None
+        scope = scopes[index]
+        if scope == 'global':
+            return reject(
+                503, 'Service overloaded', f'Too many {route} requests, try again later',
+                wait, route, scope
+            )
+        return reject(
+            429, 'Too many requests', f'Rate limit for {route} requests exceeded',
+            wait, route, scope
+        )
@@ -1,6 +1,22 @@
 from django.apps import AppConfig
 
 
+def restore_username_fts(sender, using, **kwargs):
+    """Table remakes during migrate drop the username FTS triggers, put them back"""
+    from api.search import restore_fts_triggers
+
+    restore_fts_triggers(using)
+
+
 class ApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "api"
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_migrate
+
+        from api.slow_queries import install_slow_query_logger
+
+        connection_created.connect(install_slow_query_logger, dispatch_uid='api-slow-query-logger')
+        post_migrate.connect(restore_username_fts, sender=self, dispatch_uid='api-restore-username-fts')
@@ -0,0 +1,293 @@
+"""
+Online, resumable backfills for new denormalized columns.
+
+A backfill walks one model in primary-key ranges. Every range is handled in
+its own short transaction together with its checkpoint row, so the SQLite
+write lock is only held for one chunk at a time and an interrupted run picks
+up where it stopped. Rows created after the backfill started are expected to
+be written correctly by the application code, so only pks up to the maximum
+seen at start are visited.
+
+Handlers receive the model class and a queryset of one pk range. They must
+only use fields and managers, never custom model methods, because inside
+migrations they get historical models.
+"""
+import re
+import time
+from decimal import Decimal
+
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.db import connection, migrations, models, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_SLEEP = 0.05
+
+BACKFILLS = {}
+
+
+class Backfill:
+    """A named handler that fills rows of one model"""
+
+    def __init__(self, name, model_name, handler, description=''):
+        self.name = name
+        self.model_name = model_name
+        self.handler = handler
+        self.description = description
+
+
+def register_backfill(name, model_name, description=''):
+    """Register a handler(model, rows) -> changed row count as a backfill"""
+    def decorator(handler):
+        BACKFILLS[name] = Backfill(name, model_name, handler, description)
+        return handler
+    return decorator
+
+
+def run_backfill(name, apps=None, chunk_size=DEFAULT_CHUNK_SIZE, sleep=DEFAULT_SLEEP,
+                 max_chunks=None, reset=False, log=None):
+    """
+    Run (or resume) a registered backfill and return its checkpoint.
+
+    max_chunks bounds the work done by one call, the next call resumes from
+    the stored checkpoint.
+    """
+    apps = apps or global_apps
+    backfill = BACKFILLS[name]
+    model = apps.get_model('api', backfill.model_name)
+    Checkpoint = apps.get_model('api', 'BackfillCheckpoint')
+
+    checkpoint, _ = Checkpoint.objects.get_or_create(name=name)
+    if reset:
+        checkpoint.last_pk = 0
+        checkpoint.target_pk = None
+        checkpoint.rows_processed = 0
+        checkpoint.completed_at = None
+        checkpoint.save()
+
+    if checkpoint.completed_at:
+        return checkpoint
+
+    if checkpoint.target_pk is None:
+        max_pk = model.objects.aggregate(max_pk=models.Max('pk'))['max_pk']
+        checkpoint.target_pk = max_pk or 0
+        checkpoint.save()
+
+    chunks = 0
+    while checkpoint.last_pk < checkpoint.target_pk:
+        upper = min(checkpoint.last_pk + chunk_size, checkpoint.target_pk)
+        with transaction.atomic():
+            rows = model.objects.filter(pk__gt=checkpoint.last_pk, pk__lte=upper).order_by()
+            changed = backfill.handler(model, rows) or 0
+            checkpoint.last_pk = upper
+            checkpoint.rows_processed += changed
+            checkpoint.save()
+
+        chunks += 1
+        if log:
+            log(f'{name}: pk {checkpoint.last_pk}/{checkpoint.target_pk}, '
+                f'{checkpoint.rows_processed} rows updated')
+        if max_chunks and chunks >= max_chunks:
+            return checkpoint
+        if sleep:
+            # Leave room for the web workers between two write transactions
+            time.sleep(sleep)
+
+    checkpoint.completed_at = timezone.now()
+    checkpoint.save()
+    return checkpoint
+
+
+def backfill_operation(name, **options):
+    """
+    Migration operation running a registered backfill.
+
+    The migration using it must set ``atomic = False`` so each chunk commits
+    on its own. With BACKFILL_IN_MIGRATIONS disabled the checkpoint is only
+    created and ``manage.py backfill`` finishes the job while the site is up.
+    """
+    def forward(apps, schema_editor):
+        if not settings.BACKFILL_IN_MIGRATIONS:
+            apps.get_model('api', 'BackfillCheckpoint').objects.get_or_create(name=name)
+            return
+        run_backfill(name, apps=apps, **options)
+
+    def backward(apps, schema_editor):
+        apps.get_model('api', 'BackfillCheckpoint').objects.filter(name=name).delete()
+
+    return migrations.RunPython(forward, backward, atomic=False)
+
+
+LEVEL_PATTERN = re.compile(r'\(Level (\d+)\)')
+
+
+@register_backfill(
+    'transaction_referral_level', 'Transaction',
+    'Set referral_level of bonus transactions from their description'
+)
+def backfill_transaction_referral_level(model, rows):
+    bonuses = list(
+        rows.filter(type='bonus', referral_level__isnull=True)
+        .only('pk', 'description', 'related_member_id')
+    )
+    for bonus in bonuses:
+        match = LEVEL_PATTERN.search(bonus.description)
+        if match:
+            bonus.referral_level = int(match.group(1))
+        elif bonus.related_member_id:
+            # Deposit bonuses are always paid to the direct referrer
+            bonus.referral_level = 1
+    changed = [bonus for bonus in bonuses if bonus.referral_level]
+    model.objects.bulk_update(changed, ['referral_level'])
+    return len(changed)
+
+
+@register_backfill(
+    'member_referral_counts', 'Member',
+    'Recount direct_referral_count and downline_count from referral relations'
+)
+def backfill_member_referral_counts(model, rows):
+    ReferralRelation = model._meta.apps.get_model('api', 'ReferralRelation')
+
+    def relation_count(**filters):
+        counts = (
+            ReferralRelation.objects.filter(referrer=models.OuterRef('pk'), **filters)
+            .order_by()
+            .values('referrer')
+            .annotate(count=models.Count('pk'))
+            .values('count')
+        )
+        return Coalesce(models.Subquery(counts), 0)
+
+    # One UPDATE per chunk, so concurrent registrations can't be lost
+    # between reading and writing the counts
+    return rows.update(
+        direct_referral_count=relation_count(level=1),
+        downline_count=relation_count()
+    )
+
+
+def compute_referral_rollups(relation_model, transaction_model, referrer_ids):
+    """
+    Recompute ReferralLevelRollup values from source rows for the given
+    referrers, as {(referrer_id, level): [member_count, earned_vcoins, earned_rubles]}
+    """
+    rollups = {}
+    counts = (
+        relation_model.objects.filter(referrer_id__in=referrer_ids)
+        .order_by()
+        .values_list('referrer_id', 'level')
+        .annotate(count=models.Count('pk'))
+    )
+    for referrer_id, level, count in counts:
+        rollups[(referrer_id, level)] = [count, Decimal('0'), Decimal('0')]
+
+    earnings = (
+        transaction_model.objects.filter(
+            member_id__in=referrer_ids,
+            type='bonus',
+            status='confirmed'
+        )
+        .order_by()
+        .values_list('member_id', 'referral_level', 'currency')
+        .annotate(total=models.Sum('amount'))
+    )
+    for member_id, level, currency, total in earnings:
+        row = rollups.setdefault((member_id, level or 0), [0, Decimal('0'), Decimal('0')])
+        row[1 if currency == 'vcoins' else 2] += total
+    return rollups
+
+
+def replace_referral_rollups(rollup_model, referrer_ids, rollups):
+    """Replace the stored rollup rows of the given referrers"""
+    rollup_model.objects.filter(referrer_id__in=referrer_ids).delete()
+    rollup_model.objects.bulk_create([
+        rollup_model(
+            referrer_id=referrer_id,
+            level=level,
+            member_count=count,
+            earned_vcoins=vcoins,
+            earned_rubles=rubles
+        )
+        for (referrer_id, level), (count, vcoins, rubles) in rollups.items()
+    ])
+
+
+@register_backfill(
+    'referral_level_rollups', 'Member',
+    'Rebuild referral_level_rollups from referral relations and bonuses'
+)
+def backfill_referral_level_rollups(model, rows):
+    apps = model._meta.apps
+    rollup_model = apps.get_model('api', 'ReferralLevelRollup')
+    referrer_ids = list(rows.values_list('pk', flat=True))
+    # Delete first: it takes the write lock before the source rows are read,
+    # so no registration can commit in between
+    rollup_model.objects.filter(referrer_id__in=referrer_ids).delete()
+    rollups = compute_referral_rollups(
+        apps.get_model('api', 'ReferralRelation'),
+        apps.get_model('api', 'Transaction'),
+        referrer_ids
+    )
+    replace_referral_rollups(rollup_model, referrer_ids, rollups)
+    return len(referrer_ids)
+
+
+@register_backfill(
+    'ledger_opening_balances', 'Member',
+    'Record current balances not yet in the ledger as opening entries'
+)
+def backfill_ledger_opening_balances(model, rows):
+    apps = model._meta.apps
+    entry_model = apps.get_model('api', 'LedgerEntry')
+    snapshot_model = apps.get_model('api', 'BalanceSnapshot')
+    quote = connection.ops.quote_name
+    entries = quote(entry_model._meta.db_table)
+    members, params = rows.values('pk').query.sql_with_params()
+    now = timezone.now()
+
+    # One INSERT ... SELECT per currency: balances and the entries already
+    # appended by the application are read by the statement that writes, so a
+    # concurrent credit is either in both or in neither
+    created = 0
+    with connection.cursor() as cursor:
+        for currency in ('vcoins', 'rubles'):
+            cursor.execute(
+                f"""
+                INSERT INTO {entries} (member_id, currency, sequence, amount, type, created_at)
+                SELECT id, %s, 0, amount, 'opening', %s FROM (
+                    SELECT m.id, ROUND(m.{quote('balance_' + currency)} - COALESCE((
+                        SELECT SUM(e.amount) FROM {entries} e
+                        WHERE e.member_id = m.id AND e.currency = %s
+                    ), 0), 2) AS amount
+                    FROM {quote(model._meta.db_table)} m
+                    WHERE m.id IN ({members}) AND NOT EXISTS (
+                        SELECT 1 FROM {entries} e
+                        WHERE e.member_id = m.id AND e.currency = %s AND e.sequence = 0
+                    )
+                ) opening
+                WHERE amount <> 0
+                """,
+                [
+                    currency,
+                    connection.ops.adapt_datetimefield_value(now),
+                    currency,
+                    *params,
+                    currency,
+                ]
+            )
+            created += cursor.rowcount
+
+    # Snapshots taken before the opening entry existed don't include it
+    opening = entry_model.objects.filter(
+        member=models.OuterRef('member'),
+        currency=models.OuterRef('currency'),
+        sequence=0,
+        created_at=now
+    ).values('amount')
+    snapshot_model.objects.filter(member__in=rows, as_of__lt=now).filter(
+        models.Exists(opening)
+    ).update(balance=models.F('balance') + models.Subquery(opening))
+    return created
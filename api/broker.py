@@ -0,0 +1,51 @@
+"""
+Local wake-up notifications for the event stream server (api.sse).
+
+Web workers send one UDP datagram to SSE_NOTIFY_PORT on localhost after a
+transaction that appended outbox events commits. The datagram carries no
+data, the server reads the events from the outbox; it only saves the
+server from waiting for its next poll. Lost datagrams cost at most
+SSE_POLL_SECONDS of latency, so sending never blocks or fails a request.
+"""
+import socket
+
+from django.conf import settings
+from django.db import transaction
+
+WAKE_UP = b'1'
+
+
+def notify():
+    """Wake the event stream server up now"""
+    if not settings.SSE_NOTIFY_PORT:
+        return
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(WAKE_UP, (settings.SSE_HOST, settings.SSE_NOTIFY_PORT))
+    except OSError:
+        pass
+
+
+def notify_on_commit():
+    """Wake the server up once the current transaction commits"""
+    transaction.on_commit(notify)
+
+
+class WakeUpProtocol:
+    """asyncio datagram protocol setting an event for every datagram"""
+
+    def __init__(self, event):
+        self.event = event
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.event.set()
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
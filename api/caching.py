@@ -0,0 +1,133 @@
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+from api import metrics
+from api.models import Level
+
+# Validators differ per member (session cookie) and per negotiated format
+VARY_HEADERS = ('Accept', 'Cookie')
+
+
+def member_validators(request):
+    """Validators for endpoints that depend only on the member's own data"""
+    member = request.user
+    return [f'm{member.id}.{member.data_version}'], [member.data_updated_at]
+
+
+def level_validators(request):
+    """Validators for endpoints that depend only on the level table"""
+    count, updated_at = Level.get_version()
+    stamp = updated_at.timestamp() if updated_at else 0
+    return [f'l{count}.{stamp}'], [updated_at]
+
+
+def member_level_validators(request):
+    """Validators for endpoints that depend on the member and the level table"""
+    member_parts, member_dates = member_validators(request)
+    level_parts, level_dates = level_validators(request)
+    return member_parts + level_parts, member_dates + level_dates
+
+
+def compute_validators(request, validators):
+    """Build (etag, last_modified) for the request from a validators function"""
+    cached = getattr(request, '_validators', None)
+    if cached is not None and cached[0] is validators:
+        return cached[1]
+
+    parts, dates = validators(request)
+    # Different query strings or formats of one endpoint must never share
+    # an ETag
+    parts = [
+        request.path,
+        request.META.get('QUERY_STRING', ''),
+        getattr(request, 'accepted_media_type', '') or ''
+    ] + parts
+    digest = hashlib.sha1('|'.join(parts).encode()).hexdigest()[:20]
+    dates = [date for date in dates if date is not None]
+    last_modified = int(max(dates).timestamp()) if dates else None
+    result = f'"{digest}"', last_modified
+    request._validators = (validators, result)
+    return result
+
+
+def conditional_get(validators):
+    """
+    Add ETag/Last-Modified to a GET handler and answer 304 when the client
+    copy is still current, without running the handler at all.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            if not request.user or request.user.is_anonymous:
+                return view_method(self, request, *args, **kwargs)
+
+            etag, last_modified = compute_validators(request, validators)
+            not_modified = get_conditional_response(
+                request, etag=etag, last_modified=last_modified
+            )
+            if not_modified is not None:
+                patch_cache_control(not_modified, private=True, no_cache=True)
+                patch_vary_headers(not_modified, VARY_HEADERS)
+                return not_modified
+
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code == 200:
+                response['ETag'] = etag
+                if last_modified is not None:
+                    response['Last-Modified'] = http_date(last_modified)
+                patch_cache_control(response, private=True, no_cache=True)
+                patch_vary_headers(response, VARY_HEADERS)
+            return response
+        return wrapper
+    return decorator
+
+
+def cached_response(endpoint, validators):
+    """
+    Cache the response data of a GET handler per member.
+
+    The key embeds the member's data version (and the level version where
+    relevant), so writes that bump those versions invalidate every entry of
+    the member at once, on every worker sharing the cache backend.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            if not request.user or request.user.is_anonymous:
+                return view_method(self, request, *args, **kwargs)
+            # Streaming formats are not cached
+            renderer = getattr(request, 'accepted_renderer', None)
+            if renderer is not None and renderer.format != 'json':
+                return view_method(self, request, *args, **kwargs)
+
+            etag, _ = compute_validators(request, validators)
+            digest = etag.strip('"')
+            key = f'response:{endpoint}:{request.user.id}:{digest}'
+            cached = cache.get(key)
+            if cached is not None:
+                record_cache_lookup(endpoint, hit=True)
+                status_code, data = cached
+                return Response(data, status=status_code)
+
+            record_cache_lookup(endpoint, hit=False)
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(
+                    key,
+                    (response.status_code, response.data),
+                    settings.RESPONSE_CACHE_TIMEOUT
+                )
+            return response
+        return wrapper
+    return decorator
+
+
+def record_cache_lookup(endpoint, hit):
+    """Count a response cache hit or miss for the endpoint"""
+    metrics.inc('response_cache_lookups_total', endpoint=endpoint, result='hit' if hit else 'miss')
@@ -0,0 +1,208 @@
+"""
+Process-local index of the referral graph.
+
+Only level-1 ReferralRelation edges are kept, as compressed sparse row
+arrays indexed directly by member id:
+
+    parents[member_id]                      direct referrer id (0 for none)
+    children[offsets[id]:offsets[id + 1]]   direct referrals, oldest first
+
+That is 8 bytes per member for each of parents and offsets plus 8 bytes per
+edge, about 24 bytes per member. Edges created after the build are read
+incrementally from a relation id high-water mark into a small overlay, every
+REFERRAL_GRAPH_REFRESH_SECONDS or on demand (get_referral_graph(current=True)).
+
+The overlay is folded into the arrays by a full rebuild every
+REFERRAL_GRAPH_REBUILD_SECONDS, or once it holds REFERRAL_GRAPH_MAX_OVERLAY
+edges. Deletions are only picked up then. The first graph is built by the
+gunicorn master (warm_referral_graph); later rebuilds run in a background
+thread of the worker and are swapped in when done, so requests never wait
+for one.
+"""
+import logging
+import threading
+import time
+from array import array
+from collections import deque
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+from api.models import Member, ReferralRelation
+
+logger = logging.getLogger(__name__)
+
+MAX_DEPTH = 10
+
+
+class ReferralGraph:
+    """Compact parent/child adjacency of level-1 referral edges"""
+
+    def __init__(self):
+        self.parents = array('q')
+        self.offsets = array('q', [0])
+        self.children = array('q')
+        self.high_water_mark = 0
+        self.extra_parents = {}
+        self.extra_children = {}
+        self.built_at = 0.0
+        self.refreshed_at = 0.0
+
+    @classmethod
+    def build(cls):
+        """Load every level-1 edge with two passes over compact arrays"""
+        graph = cls()
+        high_water_mark = ReferralRelation.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        max_member_id = Member.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+        sources = array('q')
+        targets = array('q')
+        edges = ReferralRelation.objects.filter(
+            level=1,
+            id__lte=high_water_mark
+        ).order_by('id').values_list('referrer_id', 'referred_id')
+        for referrer_id, referred_id in edges.iterator(chunk_size=10000):
+            sources.append(referrer_id)
+            targets.append(referred_id)
+            max_member_id = max(max_member_id, referrer_id, referred_id)
+
+        size = max_member_id + 1
+        parents = array('q', bytes(8 * size))
+        offsets = array('q', bytes(8 * (size + 1)))
+        for source in sources:
+            offsets[source + 1] += 1
+        for index in range(1, size + 1):
+            offsets[index] += offsets[index - 1]
+
+        # Counting sort of the edges by referrer, keeping relation id order
+        children = array('q', bytes(8 * len(targets)))
+        positions = array('q', offsets)
+        for source, target in zip(sources, targets):
+            children[positions[source]] = target
+            positions[source] += 1
+            parents[target] = source
+
+        graph.parents = parents
+        graph.offsets = offsets
+        graph.children = children
+        graph.high_water_mark = high_water_mark
+        graph.built_at = graph.refreshed_at = time.monotonic()
+        return graph
+
+    def refresh(self):
+        """Apply level-1 edges created since the last build or refresh"""
+        new_edges = ReferralRelation.objects.filter(
+            id__gt=self.high_water_mark
+        ).order_by('id').values_list('id', 'referrer_id', 'referred_id', 'level')
+        for relation_id, referrer_id, referred_id, level in new_edges:
+            self.high_water_mark = relation_id
+            if level != 1:
+                continue
+            self.extra_parents[referred_id] = referrer_id
+            self.extra_children.setdefault(referrer_id, []).append(referred_id)
+        self.refreshed_at = time.monotonic()
+
+    @property
+    def overlay_size(self):
+        return len(self.extra_parents)
+
+    def memory_bytes(self):
+        """Bytes held by the base arrays"""
+        return sum(
+            values.buffer_info()[1] * values.itemsize
+            for values in (self.parents, self.offsets, self.children)
+        )
+
+    def children_of(self, member_id):
+        """Direct referral ids, oldest first"""
+        children = []
+        if member_id + 1 < len(self.offsets):
+            children = self.children[self.offsets[member_id]:self.offsets[member_id + 1]].tolist()
+        return children + self.extra_children.get(member_id, [])
+
+    def descendants(self, member_id, max_depth=MAX_DEPTH):
+        """Yield (member_id, parent_id, depth) breadth first up to max_depth"""
+        queue = deque([(member_id, 0)])
+        while queue:
+            node, depth = queue.popleft()
+            if depth >= max_depth:
+                continue
+            for child in self.children_of(node):
+                yield child, node, depth + 1
+                queue.append((child, depth + 1))
+
+
+_graph = None
+_lock = threading.Lock()
+_rebuild_thread = None
+
+
+def get_referral_graph(current=False):
+    """
+    Return the process graph, refreshing it when due.
+
+    With current=True every committed edge is applied first (one indexed
+    query past the high-water mark; SQLite assigns relation ids in commit
+    order). Callers whose result carries the member's data version as a
+    validator need that, otherwise a tree built from a graph that missed a
+    just-committed referral would be tagged as up to date.
+
+    Only a process without any graph builds it here; a due rebuild is
+    started in the background and the current graph is served meanwhile.
+    """
+    global _graph
+    with _lock:
+        if _graph is None:
+            _graph = ReferralGraph.build()
+            return _graph
+        now = time.monotonic()
+        if (
+            now - _graph.built_at >= settings.REFERRAL_GRAPH_REBUILD_SECONDS
+            or _graph.overlay_size >= settings.REFERRAL_GRAPH_MAX_OVERLAY
+        ):
+            start_rebuild()
+        if current or now - _graph.refreshed_at >= settings.REFERRAL_GRAPH_REFRESH_SECONDS:
+            _graph.refresh()
+        return _graph
+
+
+def start_rebuild():
+    """Start a background rebuild unless one is running (call with _lock held)"""
+    global _rebuild_thread
+    if _rebuild_thread is not None and _rebuild_thread.is_alive():
+        return
+    _rebuild_thread = threading.Thread(target=rebuild_referral_graph, name='referral-graph-rebuild', daemon=True)
+    _rebuild_thread.start()
+
+
+def rebuild_referral_graph():
+    """Build a new graph and swap it in for the current one"""
+    global _graph
+    try:
+        graph = ReferralGraph.build()
+    except DatabaseError:
+        logger.warning('Referral graph not rebuilt, database unavailable', exc_info=True)
+        with _lock:
+            # Retry after the next rebuild interval instead of on every request
+            _graph.built_at = time.monotonic()
+        return
+    finally:
+        # The thread's own connection, opened by the build
+        connections.close_all()
+    with _lock:
+        # Edges committed during the build are applied by the next refresh
+        _graph = graph
+
+
+def warm_referral_graph():
+    """Build the graph ahead of the first request (e.g. in the gunicorn master)"""
+    try:
+        graph = get_referral_graph()
+    except DatabaseError:
+        logger.warning('Referral graph not built, database unavailable', exc_info=True)
+        return None
+    logger.info(
+        'Referral graph built: %d members, %d edges, %d bytes',
+        len(graph.parents), len(graph.children), graph.memory_bytes()
+    )
+    return graph
@@ -0,0 +1,143 @@
+"""
+Readiness checks of a worker process.
+
+The result is cached in the process for HEALTH_CACHE_SECONDS, so frequent
+probes from nginx or the container runtime cost nothing. Readiness is per
+worker (it checks this process's database connection), which is why the
+cache is not shared.
+
+Failing checks are logged with their details (errors, pending migration
+names). The public response only says which check failed; the details
+are shown to admins and local addresses (see HealthReadyView).
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.utils import timezone
+
+from api import graph
+from api.models import BackfillCheckpoint
+
+_lock = threading.Lock()
+_cached = {'result': None, 'at': 0.0}
+_migrations_applied = False
+
+logger = logging.getLogger(__name__)
+
+
+def timed(check):
+    """Run a check, adding its duration and turning database errors into failures"""
+    started = time.perf_counter()
+    try:
+        result = check()
+    except DatabaseError as error:
+        result = {'ok': False, 'error': str(error)}
+    result['ms'] = round((time.perf_counter() - started) * 1000, 3)
+    return result
+
+
+def check_database():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+    return {'ok': True}
+
+
+def check_write_lock():
+    """
+    Time taking the SQLite write lock with a no-op BEGIN IMMEDIATE. The busy
+    timeout is lowered for the probe so a long-held lock fails it quickly
+    instead of waiting the full connection timeout.
+    """
+    if connection.vendor != 'sqlite' or connection.in_atomic_block:
+        return {'ok': True, 'skipped': True}
+
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA busy_timeout')
+        busy_timeout = cursor.fetchone()[0]
+        cursor.execute(f'PRAGMA busy_timeout = {int(settings.HEALTH_WRITE_LOCK_TIMEOUT_MS)}')
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('ROLLBACK')
+        finally:
+            cursor.execute(f'PRAGMA busy_timeout = {int(busy_timeout)}')
+    return {'ok': True}
+
+
+def check_migrations():
+    """Unapplied migrations; once none are left the answer can't change until a deploy"""
+    global _migrations_applied
+    if _migrations_applied:
+        return {'ok': True, 'pending': 0}
+
+    executor = MigrationExecutor(connection)
+    plan = executor.migration_plan(executor.loader.graph.leaf_nodes())
+    pending = [f'{migration.app_label}.{migration.name}' for migration, _ in plan]
+    _migrations_applied = not pending
+    return {'ok': not pending, 'pending': len(pending), 'migrations': pending[:10]}
+
+
+def check_background_jobs():
+    """
+    Lag of background work. Informational: an unfinished backfill or an
+    old graph doesn't make the worker unable to serve.
+    """
+    now = timezone.now()
+    backfills = [
+        {
+            'name': checkpoint.name,
+            'remaining_pks': max((checkpoint.target_pk or 0) - checkpoint.last_pk, 0)
+            if checkpoint.target_pk is not None else None,
+            'seconds_since_progress': round((now - checkpoint.updated_at).total_seconds(), 1),
+        }
+        for checkpoint in BackfillCheckpoint.objects.filter(completed_at__isnull=True).order_by('name')
+    ]
+    referral_graph = graph._graph
+    return {
+        'ok': True,
+        'pending_backfills': backfills,
+        'referral_graph_age_seconds': round(time.monotonic() - referral_graph.built_at, 1)
+        if referral_graph is not None else None,
+        'referral_graph_refresh_lag_seconds': round(time.monotonic() - referral_graph.refreshed_at, 1)
+        if referral_graph is not None else None,
+    }
+
+
+def run_checks():
+    checks = {
+        'database': timed(check_database),
+        'write_lock': timed(check_write_lock),
+        'migrations': timed(check_migrations),
+        'background_jobs': timed(check_background_jobs),
+    }
+    failed = [name for name, check in checks.items() if not check['ok']]
+    if failed:
+        logger.warning('Readiness checks failed: %s', {name: checks[name] for name in failed})
+    return {
+        'status': 'fail' if failed else 'ok',
+        # Coarse and safe to show anyone: the first failed check
+        'reason': failed[0] if failed else None,
+        'checked_at': timezone.now().isoformat(),
+        'checks': checks,
+    }
+
+
+def public_result(result):
+    """Readiness result without the per-check details"""
+    return {key: value for key, value in result.items() if key != 'checks'}
+
+
+def readiness():
+    """Cached readiness result and whether it came from the cache"""
+    with _lock:
+        now = time.monotonic()
+        if _cached['result'] is not None and now - _cached['at'] < settings.HEALTH_CACHE_SECONDS:
+            return _cached['result'], True
+        result = run_checks()
+        _cached['result'] = result
+        _cached['at'] = time.monotonic()
+        return result, False
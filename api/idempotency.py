@@ -0,0 +1,121 @@
+"""
+Idempotency keys for endpoints that move money.
+
+A client sends a unique Idempotency-Key header with a POST and the same
+key when it retries. The first request claims the key, runs the view and
+stores its response, all in one transaction: either the writes and the
+stored response are committed together or neither is. A retry finds the
+stored response with a single lookup on the (member, key) unique index
+and gets it replayed instead of running the view again. A concurrent
+duplicate blocks on the claim until the first request commits and then
+replays its response.
+
+Keys are per member and expire after IDEMPOTENCY_KEY_TTL_HOURS;
+``manage.py purge_idempotency_keys`` deletes expired keys.
+"""
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from api import metrics
+from api.models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+def request_hash(request):
+    """SHA-256 of the method, path and body of a request"""
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+def is_expired(record):
+    return record.created_at < timezone.now() - timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS)
+
+
+def replay(record, digest, endpoint):
+    """Stored response of a key, or an error if the key was used for another request"""
+    if record.request_hash != digest:
+        return Response(
+            {
+                'error': 'Idempotency key reused',
+                'detail': f'{HEADER} was already used for a different request'
+            },
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    if record.status_code is None:
+        # Only possible if a claim was committed without a response
+        response = Response(
+            {
+                'error': 'Request in progress',
+                'detail': f'A request with this {HEADER} is still being processed'
+            },
+            status=status.HTTP_409_CONFLICT
+        )
+        response['Retry-After'] = '1'
+        return response
+
+    metrics.inc('idempotent_replays_total', endpoint=endpoint)
+    response = Response(record.response_body, status=record.status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view_method):
+    """
+    Make a POST handler idempotent for requests with an Idempotency-Key
+    header. Requests without the header, or from anonymous clients, run
+    the view as before. Server errors are not stored, so they can be retried.
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None or not request.user or request.user.is_anonymous:
+            return view_method(self, request, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {
+                    'error': 'Validation error',
+                    'detail': f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters'
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        member = request.user
+        endpoint = type(self).__name__
+        digest = request_hash(request)
+        record = IdempotencyKey.objects.filter(member=member, key=key).first()
+        if record is not None and not is_expired(record):
+            return replay(record, digest, endpoint)
+
+        try:
+            with transaction.atomic():
+                if record is not None:
+                    record.delete()
+                # Claim first, so a concurrent duplicate waits for this
+                # transaction instead of running the view as well
+                claim = IdempotencyKey.objects.create(member=member, key=key, request_hash=digest)
+                response = view_method(self, request, *args, **kwargs)
+                if response.status_code >= 500:
+                    transaction.set_rollback(True)
+                    return response
+                claim.status_code = response.status_code
+                # Stored as rendered, so a replay matches the original byte for byte
+                claim.response_body = json.loads(json.dumps(response.data, cls=JSONEncoder))
+                claim.save(update_fields=['status_code', 'response_body'])
+                return response
+        except IntegrityError:
+            record = IdempotencyKey.objects.filter(member=member, key=key).first()
+            if record is None:
+                raise
+            return replay(record, digest, endpoint)
+    return wrapper
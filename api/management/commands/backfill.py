@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.backfill import BACKFILLS, DEFAULT_CHUNK_SIZE, DEFAULT_SLEEP, run_backfill
+from api.models import BackfillCheckpoint
+
+
+class Command(BaseCommand):
+    help = 'Run or resume a chunked data backfill while the site keeps serving'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', nargs='?', help='Registered backfill name')
+        parser.add_argument('--list', action='store_true', help='List backfills and their progress')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--sleep', type=float, default=DEFAULT_SLEEP,
+                            help='Seconds to pause between chunks')
+        parser.add_argument('--max-chunks', type=int, default=None,
+                            help='Stop after this many chunks, the next run resumes')
+        parser.add_argument('--reset', action='store_true', help='Start over from the first row')
+
+    def handle(self, *args, **options):
+        if options['list'] or not options['name']:
+            checkpoints = {c.name: c for c in BackfillCheckpoint.objects.all()}
+            for name, backfill in sorted(BACKFILLS.items()):
+                checkpoint = checkpoints.get(name)
+                if checkpoint is None:
+                    state = 'not started'
+                elif checkpoint.completed_at:
+                    state = f'done, {checkpoint.rows_processed} rows updated'
+                else:
+                    state = f'at pk {checkpoint.last_pk}/{checkpoint.target_pk}'
+                self.stdout.write(f'{name} [{backfill.model_name}] {state} - {backfill.description}')
+            return
+
+        name = options['name']
+        if name not in BACKFILLS:
+            raise CommandError(f'Unknown backfill "{name}", use --list to see them')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        checkpoint = run_backfill(
+            name,
+            chunk_size=options['chunk_size'],
+            sleep=options['sleep'],
+            max_chunks=options['max_chunks'],
+            reset=options['reset'],
+            log=self.stdout.write
+        )
+        if checkpoint.completed_at:
+            self.stdout.write(self.style.SUCCESS(
+                f'{name} completed, {checkpoint.rows_processed} rows updated'
+            ))
+        else:
+            self.stdout.write(f'{name} paused at pk {checkpoint.last_pk}/{checkpoint.target_pk}')
@@ -0,0 +1,104 @@
+import pstats
+import re
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.profiling import list_profiles, load_profile_meta, normalize_sql, profile_dir
+
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+
+def short_path(filename):
+    """Path relative to the project or the site-packages directory"""
+    for root in [str(settings.BASE_DIR)] + sorted(sys.path, key=len, reverse=True):
+        if root and filename.startswith(root + '/'):
+            return filename[len(root) + 1:]
+    return filename
+
+
+class Command(BaseCommand):
+    help = 'Show the top functions and SQL queries across collected request profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--list', action='store_true', help='List the collected profiles')
+        parser.add_argument('--path', help='Only profiles whose request path contains this')
+        parser.add_argument('--last', type=int, help='Only the newest N profiles')
+        parser.add_argument('--sort', choices=SORT_KEYS, default='cumulative')
+        parser.add_argument('--limit', type=int, default=25, help='Functions to show')
+        parser.add_argument('--queries', type=int, default=15, help='Query shapes to show')
+        parser.add_argument('--filter', default='',
+                            help='Regular expression restricting shown functions, e.g. "api/"')
+        parser.add_argument('--clear', action='store_true', help='Delete all collected profiles')
+
+    def handle(self, *args, **options):
+        directory = profile_dir()
+        names = list_profiles(directory)
+
+        if options['clear']:
+            for path in list(directory.glob('*.prof')) + list(directory.glob('*.json')):
+                path.unlink(missing_ok=True)
+            self.stdout.write(self.style.SUCCESS(f'{len(names)} profiles deleted'))
+            return
+
+        profiles = [(name, load_profile_meta(name, directory) or {}) for name in names]
+        if options['path']:
+            profiles = [
+                (name, meta) for name, meta in profiles
+                if options['path'] in meta.get('path', '')
+            ]
+        if options['last']:
+            profiles = profiles[-options['last']:]
+        if not profiles:
+            raise CommandError(f'No profiles found in {directory}')
+
+        if options['list']:
+            for name, meta in profiles:
+                self.stdout.write(
+                    f"{name}  {meta.get('status', '?')}  {meta.get('ms', '?')} ms, "
+                    f"{len(meta.get('queries', []))} queries in {meta.get('sql_ms', '?')} ms"
+                )
+            return
+
+        total_ms = sum(meta.get('ms', 0) for _, meta in profiles)
+        sql_ms = sum(meta.get('sql_ms', 0) for _, meta in profiles)
+        self.stdout.write(
+            f'{len(profiles)} profiles, {total_ms / len(profiles):.1f} ms per request, '
+            f'{sql_ms / len(profiles):.1f} ms of it in SQL'
+        )
+
+        self.write_functions(directory, profiles, options)
+        self.write_queries(profiles, options['queries'])
+
+    def write_functions(self, directory, profiles, options):
+        stats = pstats.Stats(*[str(directory / f'{name}.prof') for name, _ in profiles])
+        pattern = re.compile(options['filter']) if options['filter'] else None
+        column = {'ncalls': 1, 'tottime': 2, 'cumulative': 3}[options['sort']]
+
+        rows = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            label = f'{short_path(filename)}:{line}({function})'
+            if pattern is None or pattern.search(label):
+                rows.append((label, calls, tottime, cumtime))
+        rows.sort(key=lambda row: -row[column])
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f'Top functions by {options["sort"]}'))
+        self.stdout.write(f'{"calls":>9}  {"tottime":>9}  {"cumtime":>9}  function')
+        for label, calls, tottime, cumtime in rows[:options['limit']]:
+            self.stdout.write(f'{calls:9d}  {tottime:9.4f}  {cumtime:9.4f}  {label}')
+
+    def write_queries(self, profiles, limit):
+        shapes = {}
+        for _, meta in profiles:
+            for query in meta.get('queries', []):
+                shape = shapes.setdefault(normalize_sql(query['sql']), [0, 0.0])
+                shape[0] += 1
+                shape[1] += query['ms']
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Top queries by total time'))
+        ranked = sorted(shapes.items(), key=lambda item: -item[1][1])[:limit]
+        for sql, (count, ms) in ranked:
+            self.stdout.write(
+                f'{ms:10.1f} ms  {count:6d} calls  {count / len(profiles):6.1f}/request  {sql[:200]}'
+            )
@@ -0,0 +1,48 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from api.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=None,
+                            help='Age in hours, defaults to IDEMPOTENCY_KEY_TTL_HOURS')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Keys deleted per statement, keeps write locks short')
+        parser.add_argument('--every', type=float, default=None,
+                            help='Keep running and purge every N seconds')
+
+    def handle(self, *args, **options):
+        hours = options['hours'] if options['hours'] is not None else settings.IDEMPOTENCY_KEY_TTL_HOURS
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        while True:
+            deleted = self.purge(hours, options['batch_size'])
+            self.stdout.write(f'Deleted {deleted} idempotency keys older than {hours:g} hours')
+            if not options['every']:
+                return
+            close_old_connections()
+            time.sleep(options['every'])
+
+    def purge(self, hours, batch_size):
+        cutoff = timezone.now() - timedelta(hours=hours)
+        deleted = 0
+        while True:
+            # Oldest first along the created_at index
+            pks = list(
+                IdempotencyKey.objects.filter(created_at__lt=cutoff)
+                .order_by('created_at')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not pks:
+                return deleted
+            deleted += IdempotencyKey.objects.filter(pk__in=pks).delete()[0]
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Level
+
+
+class Command(BaseCommand):
+    help = 'Reassign member levels from direct referral counts and the level thresholds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('member_ids', nargs='*', type=int, help='Only these members (default: all)')
+
+    def handle(self, *args, **options):
+        changed = Level.recompute_member_levels(options['member_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f'{changed} member levels changed'))
@@ -0,0 +1,89 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import BalanceSnapshot, LedgerEntry, Member
+
+CURRENCIES = ('vcoins', 'rubles')
+
+
+class Command(BaseCommand):
+    help = 'Stream the balance ledger and report drift against member balances and snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Members per chunk')
+        parser.add_argument('--member', type=int, help='Only check this member')
+
+    def handle(self, *args, **options):
+        members = Member.objects.order_by('pk')
+        if options['member']:
+            members = members.filter(pk=options['member'])
+
+        checked = streamed = drifted = 0
+        last_pk = 0
+        while True:
+            # Each chunk is read in one transaction, so balances, entries and
+            # snapshots come from the same point in time and a concurrent
+            # credit never shows up as drift
+            with transaction.atomic():
+                balances = list(
+                    members.filter(pk__gt=last_pk)
+                    .values_list('pk', 'balance_vcoins', 'balance_rubles')[:options['chunk_size']]
+                )
+                if not balances:
+                    break
+                last_pk = balances[-1][0]
+                checked += len(balances)
+                member_ids = [row[0] for row in balances]
+
+                snapshots = {
+                    (member_id, currency, sequence): balance
+                    for member_id, currency, sequence, balance in BalanceSnapshot.objects.filter(
+                        member_id__in=member_ids
+                    ).values_list('member_id', 'currency', 'sequence', 'balance')
+                }
+                entries = (
+                    LedgerEntry.objects.filter(member_id__in=member_ids)
+                    .order_by('member_id', 'currency', 'sequence')
+                    .values_list('member_id', 'currency', 'sequence', 'amount')
+                )
+
+                totals = {}
+                problems = {}
+                for member_id, currency, sequence, amount in entries.iterator(chunk_size=5000):
+                    streamed += 1
+                    key = (member_id, currency)
+                    expected, total = totals.get(key, (None, Decimal('0')))
+                    if expected is None:
+                        # Members may or may not have an opening entry
+                        expected = sequence if sequence <= 1 else 1
+                    if sequence != expected:
+                        problems.setdefault(member_id, []).append(
+                            f'{currency} entry {expected} missing, next is {sequence}'
+                        )
+                    total += amount
+                    totals[key] = (sequence + 1, total)
+                    snapshot = snapshots.get((member_id, currency, sequence))
+                    if snapshot is not None and snapshot != total:
+                        problems.setdefault(member_id, []).append(
+                            f'{currency} snapshot at {sequence} is {snapshot}, ledger {total}'
+                        )
+
+                for member_id, *columns in balances:
+                    for currency, balance in zip(CURRENCIES, columns):
+                        total = totals.get((member_id, currency), (None, Decimal('0')))[1]
+                        if total != balance:
+                            problems.setdefault(member_id, []).append(
+                                f'{currency} balance {balance}, ledger {total} (drift {balance - total})'
+                            )
+
+            for member_id, lines in sorted(problems.items()):
+                for line in lines:
+                    self.stdout.write(f'member {member_id}: {line}')
+            drifted += len(problems)
+
+        style = self.style.SUCCESS if not drifted else self.style.WARNING
+        self.stdout.write(style(
+            f'{checked} members checked, {streamed} ledger entries streamed, {drifted} with drift found'
+        ))
@@ -0,0 +1,87 @@
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api.slow_queries import read_entries
+
+SORT_KEYS = ('total', 'count', 'max', 'avg')
+
+
+class Command(BaseCommand):
+    help = 'Print the slowest query fingerprints from the slow-query log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument('--sort', choices=SORT_KEYS, default='total')
+        parser.add_argument('--hours', type=float, help='Only entries of the last N hours')
+        parser.add_argument('--fingerprint', help='Only this fingerprint, with all its callers')
+        parser.add_argument('--no-plans', action='store_true', help='Leave out query plans')
+        parser.add_argument('--clear', action='store_true', help='Delete the log files')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            path = Path(settings.SLOW_QUERY_LOG)
+            for candidate in (path, path.with_name(path.name + '.1')):
+                candidate.unlink(missing_ok=True)
+            self.stdout.write(self.style.SUCCESS('Slow-query log cleared'))
+            return
+
+        since = None
+        if options['hours']:
+            since = timezone.now() - timedelta(hours=options['hours'])
+
+        groups = {}
+        for entry in read_entries():
+            if since and parse_datetime(entry['at']) < since:
+                continue
+            if options['fingerprint'] and entry['fingerprint'] != options['fingerprint']:
+                continue
+            group = groups.setdefault(entry['fingerprint'], {
+                'sql': entry['sql'],
+                'count': 0,
+                'total': 0.0,
+                'max': 0.0,
+                'callers': Counter(),
+                'plan': None,
+                'last_at': None,
+            })
+            group['count'] += 1
+            group['total'] += entry['ms']
+            group['max'] = max(group['max'], entry['ms'])
+            group['callers'][(entry.get('view'), entry.get('caller'))] += 1
+            group['last_at'] = entry['at']
+            if entry.get('plan'):
+                # Latest captured plan wins
+                group['plan'] = entry['plan']
+
+        if not groups:
+            self.stdout.write('No slow queries logged')
+            return
+
+        for group in groups.values():
+            group['avg'] = group['total'] / group['count']
+        ranked = sorted(groups.items(), key=lambda item: -item[1][options['sort']])
+
+        self.stdout.write(
+            f'{len(groups)} fingerprints, {sum(g["count"] for g in groups.values())} slow queries '
+            f'over {settings.SLOW_QUERY_MS:g} ms'
+        )
+        for fingerprint, group in ranked[:options['limit']]:
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'\n{fingerprint}  {group["count"]} x, total {group["total"]:.1f} ms, '
+                f'avg {group["avg"]:.1f} ms, max {group["max"]:.1f} ms, last {group["last_at"]}'
+            ))
+            self.stdout.write(f'  {group["sql"][:500]}')
+            callers = group['callers'].most_common(None if options['fingerprint'] else 3)
+            for (view, caller), count in callers:
+                where = view if caller in (None, view) else f'{caller} in {view}'
+                self.stdout.write(f'  {count:6d} x from {where}')
+            if group['plan'] and not options['no_plans']:
+                self.stdout.write('  plan:')
+                for line in group['plan']:
+                    self.stdout.write(f'    {line}')
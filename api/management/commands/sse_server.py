@@ -0,0 +1,23 @@
+import asyncio
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.sse import STREAM_PATH, EventStreamServer
+
+
+class Command(BaseCommand):
+    help = f'Serve {STREAM_PATH} server-sent events (behind nginx) until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=settings.SSE_HOST)
+        parser.add_argument('--port', type=int, default=settings.SSE_PORT)
+        parser.add_argument('--notify-port', type=int, default=settings.SSE_NOTIFY_PORT,
+                            help='UDP port web workers send wake-ups to, 0 to only poll')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+        server = EventStreamServer(options['host'], options['port'], options['notify_port'])
+        asyncio.run(server.run())
+        self.stdout.write('Event stream server stopped')
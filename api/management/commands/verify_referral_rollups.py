@@ -0,0 +1,74 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.backfill import compute_referral_rollups, replace_referral_rollups
+from api.models import Member, ReferralLevelRollup, ReferralRelation, Transaction
+
+CENT = Decimal('0.01')
+EMPTY = (0, Decimal('0.00'), Decimal('0.00'))
+
+
+class Command(BaseCommand):
+    help = 'Recompute referral level rollups from source rows and report (or fix) drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Rewrite rollups of drifted referrers')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--member', type=int, help='Only check this member')
+
+    def handle(self, *args, **options):
+        members = Member.objects.order_by('pk').values_list('pk', flat=True)
+        if options['member']:
+            members = members.filter(pk=options['member'])
+
+        checked = drifted = 0
+        last_pk = 0
+        while True:
+            referrer_ids = list(members.filter(pk__gt=last_pk)[:options['chunk_size']])
+            if not referrer_ids:
+                break
+            last_pk = referrer_ids[-1]
+            checked += len(referrer_ids)
+
+            with transaction.atomic():
+                expected = {
+                    key: self.normalize(values)
+                    for key, values in compute_referral_rollups(
+                        ReferralRelation, Transaction, referrer_ids
+                    ).items()
+                }
+                stored = {
+                    (rollup.referrer_id, rollup.level): self.normalize(
+                        (rollup.member_count, rollup.earned_vcoins, rollup.earned_rubles)
+                    )
+                    for rollup in ReferralLevelRollup.objects.filter(referrer_id__in=referrer_ids)
+                }
+
+                bad_referrers = set()
+                for key in expected.keys() | stored.keys():
+                    # Rows left at zero (e.g. after deletions) are not drift
+                    if expected.get(key, EMPTY) != stored.get(key, EMPTY):
+                        bad_referrers.add(key[0])
+                        self.stdout.write(
+                            f'referrer {key[0]} level {key[1]}: '
+                            f'stored {stored.get(key)} expected {expected.get(key)}'
+                        )
+                drifted += len(bad_referrers)
+
+                if options['fix'] and bad_referrers:
+                    replace_referral_rollups(
+                        ReferralLevelRollup,
+                        bad_referrers,
+                        {key: values for key, values in expected.items() if key[0] in bad_referrers}
+                    )
+
+        style = self.style.SUCCESS if not drifted else self.style.WARNING
+        action = 'fixed' if options['fix'] else 'found'
+        self.stdout.write(style(f'{checked} members checked, {drifted} with drift {action}'))
+
+    @staticmethod
+    def normalize(values):
+        count, vcoins, rubles = values
+        return count, Decimal(vcoins).quantize(CENT), Decimal(rubles).quantize(CENT)
@@ -0,0 +1,341 @@
+"""
+Prometheus metrics shared by all gunicorn workers.
+
+Every process counts into in-memory counters and histograms and writes
+them, at most every METRICS_FLUSH_SECONDS, to its own METRICS_DIR/<pid>.json
+(atomically, through a rename). A scrape merges the files of all
+processes. Files of exited processes are folded into archive.json under a
+file lock, so their counts survive worker recycling while the directory
+stays small. The directory is emptied when gunicorn starts, which resets
+the counters as Prometheus expects after a restart.
+"""
+import atexit
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# Latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by route'),
+    'http_requests_total': ('counter', 'Requests by route, method and status'),
+    'db_queries_total': ('counter', 'Database statements run by requests, by route'),
+    'db_query_duration_seconds_total': ('counter', 'Time spent in database statements, by route'),
+    'response_cache_lookups_total': ('counter', 'Per-member response cache lookups by endpoint and result'),
+    'admission_rejected_total': ('counter', 'Requests refused by admission control, by route class and reason'),
+    'idempotent_replays_total': ('counter', 'Stored responses replayed for retried Idempotency-Key requests, by endpoint'),
+    'registrations_total': ('counter', 'Registered members by user type'),
+    'referral_bonuses_paid_total': ('counter', 'Confirmed bonuses by referral level (0 = manual) and currency'),
+    'referral_bonuses_paid_amount_total': ('counter', 'Confirmed bonus amounts by referral level and currency'),
+}
+
+ARCHIVE = 'archive.json'
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_state = {'flushed_at': 0.0, 'dirty': False, 'worker': False, 'timer': None}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add value to a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        _state['dirty'] = True
+
+
+def observe(name, value, **labels):
+    """Record one observation in a histogram"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[0][index] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+        _state['dirty'] = True
+
+
+def count_bonuses(bonuses):
+    """Count confirmed bonuses once the surrounding transaction commits"""
+    totals = {}
+    for bonus in bonuses:
+        key = (str(bonus.referral_level or 0), bonus.currency)
+        count, amount = totals.get(key, (0, 0.0))
+        totals[key] = (count + 1, amount + float(bonus.amount))
+
+    def record():
+        for (level, currency), (count, amount) in totals.items():
+            inc('referral_bonuses_paid_total', count, level=level, currency=currency)
+            inc('referral_bonuses_paid_amount_total', amount, level=level, currency=currency)
+
+    if totals:
+        transaction.on_commit(record)
+
+
+def metrics_dir():
+    return Path(settings.METRICS_DIR)
+
+
+def _dump(counters, histograms, worker):
+    return {
+        'worker': worker,
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [
+            [name, dict(labels), buckets, total, count]
+            for (name, labels), (buckets, total, count) in histograms.items()
+        ],
+    }
+
+
+def _write_json(path, data):
+    handle, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(handle, 'w') as tmp:
+        json.dump(data, tmp)
+    os.replace(tmp_path, path)
+
+
+def flush(force=False):
+    """Write this process's metrics file if changed and due (or forced)"""
+    now = time.monotonic()
+    if not force and (not _state['dirty'] or now - _state['flushed_at'] < settings.METRICS_FLUSH_SECONDS):
+        return
+    with _lock:
+        data = _dump(_counters, _histograms, _state['worker'])
+        _state['dirty'] = False
+        _state['flushed_at'] = now
+    directory = metrics_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    _write_json(directory / f'{os.getpid()}.json', data)
+
+
+def flush_soon():
+    """
+    Flush now if the interval has passed, otherwise once it has, so the
+    last requests of a worker that goes idle are not held back
+    """
+    delay = settings.METRICS_FLUSH_SECONDS - (time.monotonic() - _state['flushed_at'])
+    if delay <= 0:
+        flush(force=True)
+        return
+    with _lock:
+        if _state['timer'] is not None:
+            return
+        timer = _state['timer'] = threading.Timer(delay, _timed_flush)
+    timer.daemon = True
+    timer.start()
+
+
+def _timed_flush():
+    _state['timer'] = None
+    try:
+        flush(force=True)
+    except OSError:
+        pass
+
+
+def register_worker():
+    """Mark this process as a gunicorn worker (post_fork hook)"""
+    # Forked from the master: start from empty metrics
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _state['worker'] = True
+    flush(force=True)
+
+
+def reset_metrics():
+    """Remove all metrics files (gunicorn master start)"""
+    shutil.rmtree(metrics_dir(), ignore_errors=True)
+
+
+@atexit.register
+def _flush_at_exit():
+    if _state['dirty']:
+        try:
+            flush(force=True)
+        except OSError:
+            pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(data, counters, histograms):
+    for name, labels, value in data.get('counters', []):
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, buckets, total, count in data.get('histograms', []):
+        key = _key(name, labels)
+        merged = histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+        merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+        merged[1] += total
+        merged[2] += count
+
+
+def collect():
+    """Merge the metrics of all processes: (counters, histograms, live worker count)"""
+    flush(force=True)
+    directory = metrics_dir()
+    counters, histograms = {}, {}
+    workers = 0
+
+    with open(directory / '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            archive = _read(directory / ARCHIVE) or {}
+            archive_counters, archive_histograms = {}, {}
+            _merge(archive, archive_counters, archive_histograms)
+            archived = False
+
+            for path in directory.glob('*.json'):
+                if not path.stem.isdigit():
+                    continue
+                data = _read(path)
+                if data is None:
+                    continue
+                if _alive(int(path.stem)):
+                    _merge(data, counters, histograms)
+                    workers += bool(data.get('worker'))
+                else:
+                    _merge(data, archive_counters, archive_histograms)
+                    path.unlink(missing_ok=True)
+                    archived = True
+
+            if archived:
+                _write_json(directory / ARCHIVE, _dump(archive_counters, archive_histograms, False))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    _merge(_dump(archive_counters, archive_histograms, False), counters, histograms)
+    return counters, histograms, workers
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = [
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    ]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(counters, histograms, gauges):
+    """
+    Prometheus text exposition of merged metrics. gauges is a list of
+    (name, help, [(labels dict, value)]).
+    """
+    lines = []
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for (name, labels), value in histograms.items():
+        by_name.setdefault(name, []).append((labels, value))
+
+    for name in sorted(by_name):
+        kind, help_text = METRICS.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name[name]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                continue
+            buckets, total, count = value
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+
+    for name, help_text, samples in gauges:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in samples:
+            lines.append(f'{name}{_labels(sorted(labels.items()))} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class QueryCounter:
+    """execute_wrapper counting statements and their time"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Record latency, status and database work of every request per route"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryCounter()
+        started = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        # Named routes keep label cardinality bounded, whatever the path
+        route = (match.view_name or match.route) if match else 'unmatched'
+        observe('http_request_duration_seconds', elapsed, route=route, method=request.method)
+        inc('http_requests_total', route=route, method=request.method, status=response.status_code)
+        if queries.count:
+            inc('db_queries_total', queries.count, route=route)
+            inc('db_query_duration_seconds_total', queries.seconds, route=route)
+        try:
+            flush_soon()
+        except OSError:
+            # Metrics must never fail a request
+            pass
+        return response
@@ -0,0 +1,64 @@
+# Generated migration
+
+import re
+
+from django.db import migrations, models, transaction
+
+CHUNK_SIZE = 1000
+LEVEL_PATTERN = re.compile(r'\(Level (\d+)\)')
+
+
+def backfill_referral_level(apps, schema_editor):
+    """
+    Parse the level out of existing bonus descriptions, one pk range at a
+    time. The migration is not atomic, so every range commits on its own
+    and the SQLite write lock is only held for one chunk.
+    """
+    Transaction = apps.get_model('api', 'Transaction')
+    rows = Transaction.objects.order_by()
+
+    last_pk = 0
+    max_pk = rows.aggregate(max_pk=models.Max('pk'))['max_pk'] or 0
+    while last_pk < max_pk:
+        with transaction.atomic():
+            chunk = list(
+                rows.filter(
+                    pk__gt=last_pk,
+                    pk__lte=last_pk + CHUNK_SIZE,
+                    type='bonus',
+                    referral_level__isnull=True
+                ).only('pk', 'description', 'related_member_id')
+            )
+            for bonus in chunk:
+                match = LEVEL_PATTERN.search(bonus.description)
+                if match:
+                    bonus.referral_level = int(match.group(1))
+                elif bonus.related_member_id:
+                    # Deposit bonuses are always paid to the direct referrer
+                    bonus.referral_level = 1
+            Transaction.objects.bulk_update(
+                [bonus for bonus in chunk if bonus.referral_level], ['referral_level']
+            )
+        last_pk += CHUNK_SIZE
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0002_member_data_version_level_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='referral_level',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['member', 'type', 'referral_level'], name='transaction_member_level_idx'),
+        ),
+        migrations.RunPython(backfill_referral_level, migrations.RunPython.noop),
+    ]
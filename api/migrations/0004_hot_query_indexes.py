@@ -0,0 +1,29 @@
+# Generated migration
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_transaction_referral_level'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='referralrelation',
+            index=models.Index(condition=models.Q(level=1), fields=['referred', 'referrer'], name='referral_direct_ref_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['member', 'type', 'status', 'referral_level', 'amount'], name='transaction_member_stats_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(status='confirmed', type='bonus'), fields=['member', 'related_member', 'amount'], name='transaction_bonus_related_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(status='pending', type='deposit'), fields=['type', 'status', 'created_at'], name='transaction_pending_dep_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated migration
+
+from django.db import migrations, models
+
+from api.backfill import backfill_operation
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0005_backfillcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='direct_referral_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='downline_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        backfill_operation('member_referral_counts'),
+    ]
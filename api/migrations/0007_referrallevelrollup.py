@@ -0,0 +1,35 @@
+# Generated migration
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from api.backfill import backfill_operation
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0006_member_referral_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralLevelRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField()),
+                ('member_count', models.PositiveIntegerField(default=0)),
+                ('earned_vcoins', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('earned_rubles', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('referrer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='level_rollups', to='api.member')),
+            ],
+            options={
+                'db_table': 'referral_level_rollups',
+                'ordering': ['level'],
+                'unique_together': {('referrer', 'level')},
+            },
+        ),
+        backfill_operation('referral_level_rollups'),
+    ]
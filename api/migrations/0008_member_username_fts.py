@@ -0,0 +1,48 @@
+# Generated migration
+
+from django.db import migrations
+
+from api.search import FTS_REBUILD_SQL, FTS_TRIGGERS
+
+# SQLite only: FTS5 trigram index over members.username, an external
+# content table so usernames are not stored twice. The triggers live in
+# api.search, which recreates them after table remakes
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE member_username_fts USING fts5(
+        username,
+        content='members',
+        content_rowid='id',
+        tokenize='trigram'
+    )
+    """,
+    *FTS_TRIGGERS.values(),
+    FTS_REBUILD_SQL,
+]
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS member_username_fts_update',
+    'DROP TRIGGER IF EXISTS member_username_fts_delete',
+    'DROP TRIGGER IF EXISTS member_username_fts_insert',
+    'DROP TABLE IF EXISTS member_username_fts',
+]
+
+
+def run_sqlite(statements):
+    def operation(apps, schema_editor):
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_referrallevelrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_sqlite(CREATE_SQL), run_sqlite(DROP_SQL)),
+    ]
@@ -0,0 +1,39 @@
+# Generated migration
+
+from django.db import migrations
+
+# PostgreSQL only: trigram GIN index matching the UPPER(username) LIKE
+# UPPER(%s) that Django generates for username__icontains. SQLite uses the
+# FTS5 table of 0008 instead.
+CREATE_SQL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS members_username_trgm_idx '
+    'ON members USING gin (UPPER(username::text) gin_trgm_ops)',
+]
+
+DROP_SQL = [
+    'DROP INDEX CONCURRENTLY IF EXISTS members_username_trgm_idx',
+]
+
+
+def run_postgresql(statements):
+    def operation(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0008_member_username_fts'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_postgresql(CREATE_SQL), run_postgresql(DROP_SQL), atomic=False),
+    ]
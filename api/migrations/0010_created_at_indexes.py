@@ -0,0 +1,25 @@
+# Generated migration
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_member_username_trgm'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='member',
+            index=models.Index(fields=['created_at'], name='member_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralrelation',
+            index=models.Index(fields=['created_at'], name='referral_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['created_at'], name='transaction_created_at_idx'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated migration
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+from api.backfill import backfill_operation
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0012_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(choices=[('vcoins', 'V-Coins'), ('rubles', 'Rubles')], max_length=10)),
+                ('sequence', models.PositiveBigIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('type', models.CharField(choices=[('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('bonus', 'Bonus'), ('tournament', 'Tournament'), ('opening', 'Opening balance'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='api.member')),
+                ('transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='api.transaction')),
+            ],
+            options={
+                'db_table': 'ledger_entries',
+                'ordering': ['member', 'currency', 'sequence'],
+                'constraints': [models.UniqueConstraint(fields=('member', 'currency', 'sequence'), name='ledger_entry_sequence_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(choices=[('vcoins', 'V-Coins'), ('rubles', 'Rubles')], max_length=10)),
+                ('sequence', models.PositiveBigIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('as_of', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to='api.member')),
+            ],
+            options={
+                'db_table': 'balance_snapshots',
+                'ordering': ['member', 'currency', 'sequence'],
+                'constraints': [models.UniqueConstraint(fields=('member', 'currency', 'sequence'), name='balance_snapshot_sequence_uniq')],
+            },
+        ),
+        backfill_operation('ledger_opening_balances'),
+    ]
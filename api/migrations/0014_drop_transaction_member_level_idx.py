@@ -0,0 +1,19 @@
+# Generated migration
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_ledger'),
+    ]
+
+    operations = [
+        # Covered by transaction_member_stats_idx (member, type, status,
+        # referral_level, amount), which every query using it can take
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='transaction_member_level_idx',
+        ),
+    ]
@@ -1,6 +1,8 @@
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
 from django.contrib.auth.hashers import make_password, check_password
 from django.utils import timezone
+from api import broker, metrics
 import uuid
 import string
 import random
@@ -32,10 +34,32 @@ class Member(models.Model):
     is_admin = models.BooleanField(default=False)
     first_tournament_played = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Validator stamps for conditional GET, bumped with a single UPDATE
+    # whenever balances, relations or transactions of this member change
+    data_version = models.PositiveIntegerField(default=0)
+    data_updated_at = models.DateTimeField(default=timezone.now)
+    # Downline counters maintained by ReferralRelation.create_referral_chain
+    direct_referral_count = models.PositiveIntegerField(default=0)
+    downline_count = models.PositiveIntegerField(default=0)
+    
+    # Columns only ever moved by set-based UPDATEs, never from an instance;
+    # balances change through apply_balance_deltas() next to a ledger entry
+    MANAGED_FIELDS = (
+        'balance_vcoins',
+        'balance_rubles',
+        'data_version',
+        'data_updated_at',
+        'direct_referral_count',
+        'downline_count',
+    )
     
     class Meta:
         db_table = 'members'
         ordering = ['-created_at']
+        indexes = [
+            # Default ordering and the admin date hierarchy
+            models.Index(fields=['created_at'], name='member_created_at_idx'),
+        ]
     
     def __str__(self):
         return self.username
@@ -60,7 +84,58 @@ class Member(models.Model):
     def save(self, *args, **kwargs):
         if not self.referral_code:
             self.referral_code = self.generate_referral_code()
+        
+        if self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        
+        # Never write balances, version stamps or counters from a (possibly
+        # stale) instance, they are only moved by set-based UPDATEs
+        if kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.MANAGED_FIELDS
+            ]
         super().save(*args, **kwargs)
+        Member.bump_versions([self.pk])
+    
+    @staticmethod
+    def bump_versions(member_ids, **updates):
+        """Invalidate cached validators of the given members, applying extra updates"""
+        member_ids = [member_id for member_id in member_ids if member_id]
+        if not member_ids:
+            return 0
+        return Member.objects.filter(id__in=member_ids).update(
+            data_version=models.F('data_version') + 1,
+            data_updated_at=timezone.now(),
+            **updates
+        )
+    
+    @staticmethod
+    def apply_balance_deltas(deltas):
+        """
+        Add {member_id: (vcoins, rubles)} to member balances and bump their
+        data versions, with one prepared UPDATE executed for all members
+        """
+        if not deltas:
+            return
+        table = connection.ops.quote_name(Member._meta.db_table)
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"""
+                UPDATE {table}
+                SET balance_vcoins = balance_vcoins + %s,
+                    balance_rubles = balance_rubles + %s,
+                    data_version = data_version + 1,
+                    data_updated_at = %s
+                WHERE id = %s
+                """,
+                [
+                    (vcoins, rubles, now, member_id)
+                    for member_id, (vcoins, rubles) in deltas.items()
+                ]
+            )
     
     # DRF compatibility properties and methods
     @property
@@ -158,34 +233,54 @@ class ReferralRelation(models.Model):
         indexes = [
             models.Index(fields=['referrer', 'level']),
             models.Index(fields=['referred']),
+            # Direct referrer lookup, covering (referred, level=1) -> referrer
+            models.Index(
+                fields=['referred', 'referrer'],
+                condition=models.Q(level=1),
+                name='referral_direct_ref_idx'
+            ),
+            # Admin change list ordering and date hierarchy
+            models.Index(fields=['created_at'], name='referral_created_at_idx'),
         ]
     
+    # Deepest referral level that is tracked
+    MAX_LEVEL = 10
+    
     def __str__(self):
         return f"{self.referrer.username} -> {self.referred.username} (Level {self.level})"
     
     @staticmethod
     def create_referral_chain(referrer, new_member):
         """Create referral chain when a new member joins"""
-        # Create direct referral (level 1)
-        ReferralRelation.objects.create(
-            referrer=referrer,
-            referred=new_member,
-            level=1
-        )
-        
-        # Find all people who referred the referrer and create chain
-        upper_chain = ReferralRelation.objects.filter(
-            referred=referrer
-        ).order_by('level')
+        # The direct row and one row per ancestor of the referrer (one level
+        # deeper, up to 10) in a single statement
+        table = connection.ops.quote_name(ReferralRelation._meta.db_table)
+        created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (referrer_id, referred_id, level, created_at)
+                SELECT %s, %s, 1, %s
+                UNION ALL
+                SELECT referrer_id, %s, level + 1, %s FROM {table}
+                WHERE referred_id = %s AND level < %s
+                """,
+                [
+                    referrer.id, new_member.id, created_at,
+                    new_member.id, created_at,
+                    referrer.id, ReferralRelation.MAX_LEVEL
+                ]
+            )
         
-        for relation in upper_chain:
-            new_level = relation.level + 1
-            if new_level <= 10:  # Maximum 10 levels
-                ReferralRelation.objects.create(
-                    referrer=relation.referrer,
-                    referred=new_member,
-                    level=new_level
-                )
+        # Stats and trees of the whole upline changed
+        Member.bump_versions(
+            ReferralRelation.objects.filter(referred=new_member).values_list('referrer_id', flat=True),
+            downline_count=models.F('downline_count') + 1
+        )
+        Member.objects.filter(id=referrer.id).update(
+            direct_referral_count=models.F('direct_referral_count') + 1
+        )
+        ReferralLevelRollup.record_referral(new_member)
 
 
 class Transaction(models.Model):
@@ -226,6 +321,8 @@ class Transaction(models.Model):
         blank=True,
         related_name='related_transactions'
     )
+    # Referral depth (1-10) a bonus was paid for, null for other transactions
+    referral_level = models.PositiveSmallIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     confirmed_at = models.DateTimeField(null=True, blank=True)
     
@@ -235,33 +332,273 @@ class Transaction(models.Model):
         indexes = [
             models.Index(fields=['member', '-created_at']),
             models.Index(fields=['type', 'status']),
+            # Confirmed bonus totals and per-level earnings, covering amount;
+            # its (member, type) prefix also serves per-type listings
+            models.Index(
+                fields=['member', 'type', 'status', 'referral_level', 'amount'],
+                name='transaction_member_stats_idx'
+            ),
+            # Earnings per referred member (SQLite still reads the rows, to
+            # check the type and status the partial index already implies)
+            models.Index(
+                fields=['member', 'related_member', 'amount'],
+                condition=models.Q(type='bonus', status='confirmed'),
+                name='transaction_bonus_related_idx'
+            ),
+            # Admin queue of deposits waiting for confirmation
+            models.Index(
+                fields=['type', 'status', 'created_at'],
+                condition=models.Q(type='deposit', status='pending'),
+                name='transaction_pending_dep_idx'
+            ),
+            # Admin change list ordering and date hierarchy
+            models.Index(fields=['created_at'], name='transaction_created_at_idx'),
         ]
     
     def __str__(self):
         return f"{self.member.username} - {self.type} {self.amount} {self.currency}"
     
+    @property
+    def signed_amount(self):
+        """Balance change of the transaction, negative for withdrawals"""
+        return -self.amount if self.type == 'withdrawal' else self.amount
+    
+    # Share of a confirmed deposit paid to an influencer direct referrer
+    DEPOSIT_BONUS_RATE = Decimal('0.10')
+    
+    # Status as last read from or written to the database
+    _stored_status = None
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_status = instance.__dict__.get('status')
+        return instance
+    
+    def save(self, *args, **kwargs):
+        became_confirmed = self.status == 'confirmed' and (
+            self._state.adding or self._stored_status != 'confirmed'
+        )
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Member.bump_versions([self.member_id])
+            if became_confirmed:
+                OutboxEvent.append([OutboxEvent.for_transaction(self)])
+            if became_confirmed and self.type == 'bonus':
+                ReferralLevelRollup.record_bonus(self)
+                metrics.count_bonuses([self])
+        self._stored_status = self.status
+    
     def complete(self):
-        """Mark transaction as confirmed and update member balance"""
+        """
+        Mark transaction as confirmed and update member balance. Rows that
+        are already confirmed (bonuses and tournament rewards are created
+        that way) are left alone and not credited.
+        """
         if self.status == 'confirmed':
             return
         
         self.status = 'confirmed'
         self.confirmed_at = timezone.now()
         
-        # Update member balance
-        if self.currency == 'vcoins':
-            if self.type == 'withdrawal':
-                self.member.balance_vcoins -= self.amount
-            else:
-                self.member.balance_vcoins += self.amount
-        elif self.currency == 'rubles':
-            if self.type == 'withdrawal':
-                self.member.balance_rubles -= self.amount
-            else:
-                self.member.balance_rubles += self.amount
+        with transaction.atomic():
+            self.save()
+            Transaction._credit([self])
+        
+        # Keep a loaded member in step with the balance UPDATE
+        if Transaction.member.is_cached(self):
+            field = f'balance_{self.currency}'
+            setattr(self.member, field, getattr(self.member, field) + self.signed_amount)
+    
+    @staticmethod
+    def confirm_deposits(deposits):
+        """
+        Confirm the pending deposits of a queryset in one database transaction.
         
-        self.member.save()
-        self.save()
+        Balance changes are summed per member and applied with a few UPDATEs,
+        and the 10% bonuses of influencer direct referrers are bulk-created.
+        Like ConfirmDepositView (deposit.complete() plus a bonus created as
+        confirmed), only the deposits are credited. Returns a summary dict.
+        """
+        with transaction.atomic():
+            pending = list(
+                deposits.filter(type='deposit', status='pending')
+                .select_for_update(of=('self',))
+                .select_related(None)
+                .select_related('member')
+                .only(
+                    'id', 'type', 'amount', 'currency', 'member_id', 'related_member_id',
+                    'referral_level', 'member__username'
+                )
+                .order_by()
+            )
+            now = timezone.now()
+            
+            # Influencer direct referrers of the depositing members
+            referrers = dict(
+                ReferralRelation.objects.filter(
+                    referred_id__in={deposit.member_id for deposit in pending},
+                    level=1,
+                    referrer__user_type='influencer'
+                ).values_list('referred_id', 'referrer_id')
+            )
+            bonuses = [
+                Transaction(
+                    member_id=referrers[deposit.member_id],
+                    type='bonus',
+                    amount=deposit.amount * Transaction.DEPOSIT_BONUS_RATE,
+                    currency='rubles',
+                    status='confirmed',
+                    description=f"10% deposit bonus from {deposit.member.username}",
+                    related_member_id=deposit.member_id,
+                    referral_level=1,
+                    confirmed_at=now
+                )
+                for deposit in pending
+                if deposit.member_id in referrers
+            ]
+            
+            Transaction.objects.filter(
+                id__in=[deposit.id for deposit in pending]
+            ).update(status='confirmed', confirmed_at=now)
+            Transaction.objects.bulk_create(bonuses, batch_size=500)
+            ReferralLevelRollup.record_bonuses(bonuses)
+            OutboxEvent.append([OutboxEvent.for_transaction(row) for row in pending + bonuses])
+            metrics.count_bonuses(bonuses)
+            return dict(Transaction._credit(pending), deposits=len(pending), bonuses=len(bonuses))
+    
+    @staticmethod
+    def grant_bonuses(members, amount, reason):
+        """
+        Create a confirmed manual bonus for every member of a queryset in one
+        database transaction. Like AdminBonusView, the bonuses are recorded
+        (rollups, events) but not added to balances. Returns a summary dict.
+        """
+        with transaction.atomic():
+            now = timezone.now()
+            bonuses = [
+                Transaction(
+                    member_id=member.id,
+                    type='bonus',
+                    amount=amount,
+                    currency='vcoins' if member.user_type == 'player' else 'rubles',
+                    status='confirmed',
+                    description=f"Manual bonus: {reason}",
+                    confirmed_at=now
+                )
+                for member in members.only('id', 'user_type').order_by()
+            ]
+            Transaction.objects.bulk_create(bonuses, batch_size=500)
+            ReferralLevelRollup.record_bonuses(bonuses)
+            OutboxEvent.append([OutboxEvent.for_transaction(bonus) for bonus in bonuses])
+            metrics.count_bonuses(bonuses)
+            return {
+                'deposits': 0,
+                'bonuses': len(bonuses),
+                'members': 0,
+                'vcoins': Decimal('0'),
+                'rubles': Decimal('0'),
+            }
+    
+    @staticmethod
+    def _credit(rows):
+        """
+        Apply transactions that just became confirmed to balances, summed per
+        member, and record them in the ledger. complete() passes its own row
+        and confirm_deposits() its whole set, so both credit the same way.
+        Returns the members and totals credited.
+        """
+        deltas = {}
+        totals = {'vcoins': Decimal('0'), 'rubles': Decimal('0')}
+        for row in rows:
+            delta = deltas.setdefault(row.member_id, [Decimal('0'), Decimal('0')])
+            delta[0 if row.currency == 'vcoins' else 1] += row.signed_amount
+            totals[row.currency] += row.signed_amount
+        Member.apply_balance_deltas(deltas)
+        LedgerEntry.append([LedgerEntry.for_transaction(row) for row in rows])
+        return {
+            'members': len(deltas),
+            'vcoins': totals['vcoins'],
+            'rubles': totals['rubles'],
+        }
+
+
+class ReferralLevelRollup(models.Model):
+    """Downline size and confirmed bonus earnings per (referrer, level)"""
+    
+    # Bucket for confirmed bonuses that are not tied to a referral level
+    UNATTRIBUTED_LEVEL = 0
+    
+    referrer = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='level_rollups'
+    )
+    level = models.PositiveSmallIntegerField()
+    member_count = models.PositiveIntegerField(default=0)
+    earned_vcoins = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    earned_rubles = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    
+    class Meta:
+        db_table = 'referral_level_rollups'
+        unique_together = ['referrer', 'level']
+        ordering = ['level']
+    
+    def __str__(self):
+        return f"{self.referrer_id} level {self.level}: {self.member_count} members"
+    
+    @property
+    def earned(self):
+        return self.earned_vcoins + self.earned_rubles
+    
+    @staticmethod
+    def record_referral(new_member):
+        """Count the new member once for every upline referrer at its level"""
+        table = connection.ops.quote_name(ReferralLevelRollup._meta.db_table)
+        relations = connection.ops.quote_name(ReferralRelation._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (referrer_id, level, member_count, earned_vcoins, earned_rubles)
+                SELECT referrer_id, level, 1, 0, 0 FROM {relations} WHERE referred_id = %s
+                ON CONFLICT (referrer_id, level)
+                DO UPDATE SET member_count = {table}.member_count + 1
+                """,
+                [new_member.id]
+            )
+    
+    @staticmethod
+    def record_bonus(bonus):
+        """Add a confirmed bonus to the earnings of its member and level"""
+        ReferralLevelRollup.record_bonuses([bonus])
+    
+    @staticmethod
+    def record_bonuses(bonuses):
+        """Add confirmed bonuses to the earnings rows, one upsert per (member, level)"""
+        totals = {}
+        for bonus in bonuses:
+            key = (bonus.member_id, bonus.referral_level or ReferralLevelRollup.UNATTRIBUTED_LEVEL)
+            earned = totals.setdefault(key, [Decimal('0'), Decimal('0')])
+            earned[0 if bonus.currency == 'vcoins' else 1] += bonus.amount
+        if not totals:
+            return
+        
+        table = connection.ops.quote_name(ReferralLevelRollup._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"""
+                INSERT INTO {table} (referrer_id, level, member_count, earned_vcoins, earned_rubles)
+                VALUES (%s, %s, 0, %s, %s)
+                ON CONFLICT (referrer_id, level)
+                DO UPDATE SET
+                    earned_vcoins = {table}.earned_vcoins + excluded.earned_vcoins,
+                    earned_rubles = {table}.earned_rubles + excluded.earned_rubles
+                """,
+                [
+                    (member_id, level, vcoins, rubles)
+                    for (member_id, level), (vcoins, rubles) in totals.items()
+                ]
+            )
 
 
 class Level(models.Model):
@@ -276,6 +613,7 @@ class Level(models.Model):
     name = models.CharField(max_length=20, choices=LEVEL_NAMES, unique=True)
     required_referrals = models.IntegerField(default=0)
     bonus_multiplier = models.DecimalField(max_digits=5, decimal_places=2, default=1.0)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         db_table = 'levels'
@@ -284,25 +622,374 @@ class Level(models.Model):
     def __str__(self):
         return f"{self.name} (x{self.bonus_multiplier})"
     
+    @staticmethod
+    def get_version():
+        """Return (count, last update) of the level table for cache validators"""
+        stats = Level.objects.aggregate(
+            count=models.Count('id'),
+            updated_at=models.Max('updated_at')
+        )
+        return stats['count'], stats['updated_at']
+    
     @staticmethod
     def check_and_update_member_level(member):
         """Check if member qualifies for level upgrade"""
-        # Count direct referrals (level 1)
-        referral_count = ReferralRelation.objects.filter(
-            referrer=member,
-            level=1
-        ).count()
+        if not Level.recompute_member_levels([member.id]):
+            return False
+        member.refresh_from_db(fields=['level', 'data_version', 'data_updated_at'])
+        return True
+    
+    @staticmethod
+    def recompute_member_levels(member_ids=None):
+        """
+        Assign all members (or the given ones) the highest level their direct
+        referral count qualifies for, and append a level change event for
+        each. One SELECT finds the members whose level differs; they are then
+        updated per new level in batches of 500 ids. Returns the number of
+        members whose level changed.
+        """
+        thresholds = Level.objects.order_by('-required_referrals').values_list('name', 'required_referrals')
+        target_level = models.Case(
+            *[
+                models.When(direct_referral_count__gte=required, then=models.Value(name))
+                for name, required in thresholds
+            ],
+            default=models.Value('none'),
+            output_field=models.CharField()
+        )
+        
+        members = Member.objects.all()
+        if member_ids is not None:
+            members = members.filter(id__in=member_ids)
+        
+        with transaction.atomic():
+            changes = list(
+                members.annotate(target_level=target_level)
+                .exclude(level=models.F('target_level'))
+                .values_list('id', 'level', 'target_level')
+            )
+            by_level = {}
+            for member_id, _, new_level in changes:
+                by_level.setdefault(new_level, []).append(member_id)
+            now = timezone.now()
+            for new_level, ids in by_level.items():
+                for start in range(0, len(ids), 500):
+                    Member.objects.filter(id__in=ids[start:start + 500]).update(
+                        level=new_level,
+                        data_version=models.F('data_version') + 1,
+                        data_updated_at=now
+                    )
+            OutboxEvent.append([
+                OutboxEvent(
+                    type=OutboxEvent.MEMBER_LEVEL_CHANGED,
+                    member_id=member_id,
+                    payload={'from': old_level, 'to': new_level}
+                )
+                for member_id, old_level, new_level in changes
+            ])
+        return len(changes)
+
+
+class BackfillCheckpoint(models.Model):
+    """Resume point of a chunked data backfill (see api.backfill)"""
+    
+    name = models.CharField(max_length=100, unique=True)
+    last_pk = models.BigIntegerField(default=0)
+    target_pk = models.BigIntegerField(null=True, blank=True)
+    rows_processed = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'backfill_checkpoints'
+        ordering = ['name']
+    
+    def __str__(self):
+        state = 'done' if self.completed_at else f'at pk {self.last_pk}/{self.target_pk}'
+        return f"{self.name} ({state})"
+
+
+class IdempotencyKey(models.Model):
+    """Stored response of a request sent with an Idempotency-Key header (see api.idempotency)"""
+    
+    member = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='idempotency_keys'
+    )
+    key = models.CharField(max_length=255)
+    # SHA-256 of method, path and body, so a key can't be reused for another request
+    request_hash = models.CharField(max_length=64)
+    # Null until the response is stored, in the same transaction as the claim
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'idempotency_keys'
+        unique_together = ['member', 'key']
+        indexes = [
+            models.Index(fields=['created_at'], name='idempotency_created_at_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.member_id}:{self.key} ({self.status_code})"
+
+
+class OutboxEvent(models.Model):
+    """
+    Change event appended in the database transaction of the change it
+    describes, read by consumers through GET /api/admin/events.
+
+    Consumers page by id. SQLite assigns ids under its single write lock,
+    so ids increase in commit order and a cursor never skips an event that
+    commits later.
+    """
+    
+    TRANSACTION_CONFIRMED = 'transaction.confirmed'
+    MEMBER_REGISTERED = 'member.registered'
+    MEMBER_LEVEL_CHANGED = 'member.level_changed'
+    
+    TYPE_CHOICES = [
+        (TRANSACTION_CONFIRMED, 'Transaction confirmed'),
+        (MEMBER_REGISTERED, 'Member registered'),
+        (MEMBER_LEVEL_CHANGED, 'Member level changed'),
+    ]
+    
+    type = models.CharField(max_length=40, choices=TYPE_CHOICES)
+    # Plain id rather than a foreign key: events outlive the members they describe
+    member_id = models.BigIntegerField()
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'outbox_events'
+        ordering = ['id']
+    
+    def __str__(self):
+        return f"{self.id} {self.type} member {self.member_id}"
+    
+    @staticmethod
+    def for_transaction(txn):
+        """Unsaved event for a confirmed transaction"""
+        return OutboxEvent(
+            type=OutboxEvent.TRANSACTION_CONFIRMED,
+            member_id=txn.member_id,
+            payload={
+                'transaction_id': txn.id,
+                'type': txn.type,
+                'amount': format(txn.amount, '.2f'),
+                'currency': txn.currency,
+                'referral_level': txn.referral_level,
+                'related_member_id': txn.related_member_id,
+            }
+        )
+    
+    @staticmethod
+    def append(events):
+        """Insert unsaved events; call inside the transaction of the change"""
+        if not events:
+            return
+        OutboxEvent.objects.bulk_create(events, batch_size=1000)
+        broker.notify_on_commit()
+
+
+class LedgerEntry(models.Model):
+    """
+    Signed balance change of one member in one currency, never updated.
+
+    Entries are numbered 1, 2, ... per (member, currency); sequence 0 is the
+    opening balance recorded by the ledger_opening_balances backfill. Every
+    LEDGER_SNAPSHOT_INTERVAL entries a BalanceSnapshot is written, so a
+    balance is one snapshot plus a tail of fewer entries than that.
+    """
+    
+    TYPE_CHOICES = Transaction.TYPE_CHOICES + [
+        ('opening', 'Opening balance'),
+        ('adjustment', 'Adjustment'),
+    ]
+    
+    member = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='ledger_entries'
+    )
+    currency = models.CharField(max_length=10, choices=Transaction.CURRENCY_CHOICES)
+    sequence = models.PositiveBigIntegerField()
+    amount = models.DecimalField(max_digits=15, decimal_places=2)
+    type = models.CharField(max_length=20, choices=TYPE_CHOICES)
+    # Kept when the transaction is deleted, the balance change still happened
+    transaction = models.ForeignKey(
+        Transaction,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='ledger_entries'
+    )
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        db_table = 'ledger_entries'
+        ordering = ['member', 'currency', 'sequence']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['member', 'currency', 'sequence'],
+                name='ledger_entry_sequence_uniq'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.member_id} {self.currency} #{self.sequence}: {self.amount}"
+    
+    @staticmethod
+    def for_transaction(txn):
+        """Unsaved entry for a confirmed transaction"""
+        return LedgerEntry(
+            member_id=txn.member_id,
+            currency=txn.currency,
+            amount=txn.signed_amount,
+            type=txn.type,
+            transaction_id=txn.id
+        )
+    
+    @staticmethod
+    def append(entries):
+        """
+        Number unsaved entries and insert them with one prepared INSERT,
+        writing the snapshots that fall due. Call inside the transaction of
+        the balance change and after its UPDATE of the members: that holds
+        the write lock (row locks elsewhere), so no other writer can take
+        the same sequence numbers.
+        """
+        if not entries:
+            return
+        now = timezone.now()
+        heads = LedgerEntry.last_sequences({entry.member_id for entry in entries})
+        previous = dict(heads)
+        for entry in entries:
+            key = (entry.member_id, entry.currency)
+            heads[key] = heads.get(key, 0) + 1
+            entry.sequence = heads[key]
+            entry.created_at = now
         
-        # Find highest level member qualifies for
-        levels = Level.objects.filter(
-            required_referrals__lte=referral_count
-        ).order_by('-required_referrals')
+        ops = connection.ops
+        table = ops.quote_name(LedgerEntry._meta.db_table)
+        created_at = ops.adapt_datetimefield_value(now)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"""
+                INSERT INTO {table} (member_id, currency, sequence, amount, type, transaction_id, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """,
+                [
+                    (
+                        entry.member_id,
+                        entry.currency,
+                        entry.sequence,
+                        # Rounded like a model save, e.g. for 10% deposit bonuses
+                        ops.adapt_decimalfield_value(entry.amount, 15, 2),
+                        entry.type,
+                        entry.transaction_id,
+                        created_at
+                    )
+                    for entry in entries
+                ]
+            )
         
-        if levels.exists():
-            new_level = levels.first()
-            if member.level != new_level.name:
-                member.level = new_level.name
-                member.save()
-                return True
+        interval = settings.LEDGER_SNAPSHOT_INTERVAL
+        BalanceSnapshot.take([
+            (member_id, currency, sequence)
+            for (member_id, currency), sequence in heads.items()
+            if sequence // interval > previous.get((member_id, currency), 0) // interval
+        ], now)
+    
+    @staticmethod
+    def last_sequences(member_ids):
+        """{(member_id, currency): last sequence} of members with entries"""
+        member_ids = sorted(member_ids)
+        # One index lookup per member and currency, however long the ledgers
+        last = {
+            currency: models.Subquery(
+                LedgerEntry.objects.filter(member=models.OuterRef('pk'), currency=currency)
+                .order_by('-sequence').values('sequence')[:1]
+            )
+            for currency, _ in Transaction.CURRENCY_CHOICES
+        }
+        heads = {}
+        for start in range(0, len(member_ids), 500):
+            rows = (
+                Member.objects.filter(id__in=member_ids[start:start + 500])
+                .order_by().annotate(**last).values('id', *last)
+            )
+            for row in rows:
+                for currency in last:
+                    if row[currency] is not None:
+                        heads[(row['id'], currency)] = row[currency]
+        return heads
+    
+    @staticmethod
+    def balance(member_id, currency, at=None, sequence=None):
+        """
+        Balance from the ledger as of a time or up to a sequence number (the
+        latest by default): the closest snapshot plus the entries after it
+        """
+        snapshots = BalanceSnapshot.objects.filter(member_id=member_id, currency=currency)
+        entries = LedgerEntry.objects.filter(member_id=member_id, currency=currency)
+        if at is not None:
+            snapshots = snapshots.filter(as_of__lte=at)
+            # The opening balance counts from the start, even when it was
+            # recorded after the member's first entries
+            entries = entries.filter(models.Q(created_at__lte=at) | models.Q(sequence=0))
+        if sequence is not None:
+            snapshots = snapshots.filter(sequence__lte=sequence)
+            entries = entries.filter(sequence__lte=sequence)
         
-        return False
+        base_sequence, base = snapshots.order_by('-sequence').values_list(
+            'sequence', 'balance'
+        ).first() or (-1, Decimal('0'))
+        tail = entries.filter(sequence__gt=base_sequence).aggregate(total=models.Sum('amount'))['total']
+        return base + (tail or Decimal('0'))
+
+
+class BalanceSnapshot(models.Model):
+    """Ledger balance of a member in one currency after entry `sequence`"""
+    
+    member = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='balance_snapshots'
+    )
+    currency = models.CharField(max_length=10, choices=Transaction.CURRENCY_CHOICES)
+    sequence = models.PositiveBigIntegerField()
+    balance = models.DecimalField(max_digits=15, decimal_places=2)
+    # created_at of the entry at `sequence`
+    as_of = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'balance_snapshots'
+        ordering = ['member', 'currency', 'sequence']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['member', 'currency', 'sequence'],
+                name='balance_snapshot_sequence_uniq'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.member_id} {self.currency} #{self.sequence}: {self.balance}"
+    
+    @staticmethod
+    def take(heads, as_of):
+        """Snapshot the ledger balance of (member_id, currency, sequence) entries"""
+        BalanceSnapshot.objects.bulk_create([
+            BalanceSnapshot(
+                member_id=member_id,
+                currency=currency,
+                sequence=sequence,
+                balance=LedgerEntry.balance(member_id, currency, sequence=sequence),
+                as_of=as_of
+            )
+            for member_id, currency, sequence in heads
+        ], batch_size=1000)
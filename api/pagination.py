@@ -0,0 +1,73 @@
+import json
+
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection
+from django.db.models import Max
+from django.utils.functional import cached_property
+from rest_framework.pagination import PageNumberPagination
+
+
+def estimate_count(queryset):
+    """
+    Cheap row count estimate of a queryset, or None when not available.
+
+    PostgreSQL reports the planner's row estimate for any queryset. Other
+    backends can only estimate unfiltered tables, from the highest pk.
+    """
+    if connection.vendor == 'postgresql':
+        try:
+            plan = json.loads(queryset.order_by().explain(format='json'))
+        except (DatabaseError, ValueError):
+            return None
+        return int(plan[0]['Plan']['Plan Rows'])
+    if not queryset.query.where:
+        return queryset.model.objects.aggregate(max_pk=Max('pk'))['max_pk'] or 0
+    return None
+
+
+class CappedCountPaginator(Paginator):
+    """
+    Paginator that stops counting after max_count rows, so broad filters
+    don't have to find every match just to report the total.
+    """
+    max_count = 1000
+
+    def capped_count(self):
+        object_list = self.object_list
+        if hasattr(object_list, 'order_by'):
+            # Ordering is irrelevant for the count and would force a full sort
+            return object_list.order_by()[:self.max_count].count()
+        return min(len(object_list), self.max_count)
+
+    @cached_property
+    def count(self):
+        return self.capped_count()
+
+
+class EstimatedCountPaginator(CappedCountPaginator):
+    """
+    Paginator that counts exactly up to max_count rows and estimates
+    larger totals (see estimate_count), falling back to the cap.
+    """
+    max_count = 10000
+
+    @cached_property
+    def count(self):
+        count = self.capped_count()
+        if count < self.max_count or not hasattr(self.object_list, 'query'):
+            return count
+        estimate = estimate_count(self.object_list)
+        return max(count, estimate or 0)
+
+
+class CappedCountPagination(PageNumberPagination):
+    """Page number pagination whose count is capped at max_count"""
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    max_count = 1000
+
+    def django_paginator_class(self, *args, **kwargs):
+        paginator = CappedCountPaginator(*args, **kwargs)
+        paginator.max_count = self.max_count
+        return paginator
@@ -0,0 +1,179 @@
+"""
+On-demand cProfile sampling of requests.
+
+A request is profiled when an admin (an API session of an admin member, or
+a Django admin staff user) sends the ``X-Profile: 1`` header or a
+``_profile=1`` query parameter, or when PROFILING_SAMPLE_RATE picks it.
+Each profile is written to PROFILING_DIR as a ``.prof`` file loadable by
+pstats, next to a ``.json`` file with the request line, timings and the
+SQL statements it ran. Only the newest PROFILING_MAX_FILES profiles are
+kept. ``manage.py profiles`` summarizes them.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from api.models import Member
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAM = '_profile'
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+VALUE_LIST = re.compile(r'\((?:\s*(?:%s|\?|\d+|\'\?\')\s*,)+\s*(?:%s|\?|\d+|\'\?\')\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """
+    Fingerprint of a SQL statement: literals become placeholders and IN
+    lists collapse, so one query shape groups together whatever its values
+    """
+    sql = STRING_LITERAL.sub("'?'", sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = VALUE_LIST.sub('(...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+
+def profile_dir():
+    return Path(settings.PROFILING_DIR)
+
+
+def requested_by_admin(request):
+    """Whether an admin asked for this request to be profiled"""
+    flag = request.META.get(PROFILE_HEADER) or request.GET.get(PROFILE_PARAM)
+    if flag not in ('1', 'true'):
+        return False
+
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated and user.is_staff:
+        return True
+    member_id = request.session.get('member_id') if hasattr(request, 'session') else None
+    return bool(member_id) and Member.objects.filter(id=member_id, is_admin=True).exists()
+
+
+class QueryRecorder:
+    """execute_wrapper collecting each statement with its duration"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'many': many,
+                'ms': round((time.perf_counter() - started) * 1000, 3)
+            })
+
+
+class ProfilingMiddleware:
+    """Profile admin-flagged or sampled requests into PROFILING_DIR"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        on_demand = requested_by_admin(request)
+        sampled = not on_demand and random.random() < settings.PROFILING_SAMPLE_RATE
+        if not (on_demand or sampled):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        recorder = QueryRecorder()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(recorder):
+                response = self.get_response(request)
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+
+        try:
+            name = save_profile(profiler, recorder.queries, request, response, elapsed, on_demand)
+        except OSError:
+            logger.warning('Could not write request profile', exc_info=True)
+            return response
+
+        if on_demand:
+            response['X-Profile-Id'] = name
+        return response
+
+
+def save_profile(profiler, queries, request, response, elapsed, on_demand):
+    """Write the .prof and .json files of one request and rotate old ones"""
+    directory = profile_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+
+    now = timezone.now()
+    slug = re.sub(r'[^a-zA-Z0-9]+', '-', request.path).strip('-')[:60] or 'root'
+    name = f'{now:%Y%m%dT%H%M%S%f}-{os.getpid()}-{request.method.lower()}-{slug}'
+
+    profiler.dump_stats(directory / f'{name}.prof')
+    meta = {
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'ms': round(elapsed * 1000, 3),
+        'sql_ms': round(sum(query['ms'] for query in queries), 3),
+        'on_demand': on_demand,
+        'created_at': now.isoformat(),
+        # Statements only, parameters may hold personal data
+        'queries': queries,
+    }
+    with open(directory / f'{name}.json', 'w') as handle:
+        json.dump(meta, handle)
+
+    rotate_profiles(directory, settings.PROFILING_MAX_FILES)
+    return name
+
+
+def list_profiles(directory=None):
+    """Profile names in the directory, oldest first"""
+    directory = directory or profile_dir()
+    if not directory.is_dir():
+        return []
+    # Names start with a timestamp, so they sort chronologically
+    return sorted(path.stem for path in directory.glob('*.prof'))
+
+
+def rotate_profiles(directory, keep):
+    """Delete all but the newest `keep` profiles"""
+    names = list_profiles(directory)
+    for name in names[:max(len(names) - keep, 0)]:
+        for suffix in ('.prof', '.json'):
+            try:
+                (directory / f'{name}{suffix}').unlink()
+            except FileNotFoundError:
+                # Already removed by another worker
+                pass
+
+
+def load_profile_meta(name, directory=None):
+    """The .json side file of a profile, or None if missing or unreadable"""
+    directory = directory or profile_dir()
+    try:
+        with open(directory / f'{name}.json') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,40 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline delimited JSON, one record per line.
+
+    Views normally stream NDJSON themselves; this renderer makes the format
+    negotiable (?format=ndjson) and renders small payloads such as errors.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        records = data if isinstance(data, list) else [data]
+        return b''.join(encode_ndjson_line(record) for record in records)
+
+
+def encode_ndjson_line(record):
+    """Encode one record as an NDJSON line"""
+    return (json.dumps(record, cls=DjangoJSONEncoder, separators=(',', ':')) + '\n').encode()
+
+
+class PrometheusTextRenderer(BaseRenderer):
+    """Prometheus text exposition format; views pass the rendered text as data"""
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, str):
+            return data.encode(self.charset)
+        # Error payloads
+        return json.dumps(data, cls=DjangoJSONEncoder).encode(self.charset)
@@ -0,0 +1,114 @@
+"""
+Username search backed by a trigram index.
+
+On SQLite the ``member_username_fts`` FTS5 table (trigram tokenizer, kept
+in sync with ``members`` by triggers, see migration 0008) answers substring
+queries of three or more characters through its index. Shorter queries use
+a plain case-insensitive LIKE. On PostgreSQL that LIKE is served by the
+pg_trgm GIN index of migration 0009.
+
+SQLite drops a table's triggers whenever a migration remakes it (most
+AlterField/AddField operations on ``members`` do), and nothing reports it:
+the index just stops seeing new and renamed members. ``restore_fts_triggers``
+runs after every ``migrate`` (see ``ApiConfig.ready``), recreates missing
+triggers and rebuilds the index from ``members`` if any were gone.
+"""
+from django.db import connection, connections
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'member_username_fts'
+TRIGRAM_MIN_LENGTH = 3
+
+FTS_TRIGGERS = {
+    'member_username_fts_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS member_username_fts_insert AFTER INSERT ON members BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, username) VALUES (new.id, new.username);
+        END
+    """,
+    'member_username_fts_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS member_username_fts_delete AFTER DELETE ON members BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, username)
+            VALUES ('delete', old.id, old.username);
+        END
+    """,
+    'member_username_fts_update': f"""
+        CREATE TRIGGER IF NOT EXISTS member_username_fts_update AFTER UPDATE OF username ON members
+        WHEN old.username IS NOT new.username BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, username)
+            VALUES ('delete', old.id, old.username);
+            INSERT INTO {FTS_TABLE}(rowid, username) VALUES (new.id, new.username);
+        END
+    """,
+}
+FTS_REBUILD_SQL = f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"
+
+
+def restore_fts_triggers(using='default'):
+    """
+    Recreate missing FTS sync triggers and rebuild the index if any were missing.
+
+    Returns the names of the recreated triggers. A no-op off SQLite and
+    before migration 0008 has created the index.
+    """
+    db = connections[using]
+    if db.vendor != 'sqlite':
+        return []
+    with db.cursor() as cursor:
+        cursor.execute(
+            "SELECT type, name FROM sqlite_master WHERE name = %s OR (type = 'trigger' AND tbl_name = 'members')",
+            [FTS_TABLE]
+        )
+        existing = {name for _, name in cursor.fetchall()}
+        if FTS_TABLE not in existing:
+            return []
+        missing = [name for name in FTS_TRIGGERS if name not in existing]
+        for name in missing:
+            cursor.execute(FTS_TRIGGERS[name])
+        if missing:
+            # Members written while the triggers were gone are not indexed
+            cursor.execute(FTS_REBUILD_SQL)
+    return missing
+
+
+def fts_phrase(query):
+    """Quote a user query as a single FTS5 phrase"""
+    return '"%s"' % query.replace('"', '""')
+
+
+def username_match(query, member_path=''):
+    """
+    Q matching rows whose member username contains query (case-insensitive).
+
+    member_path is the lookup path from the queryset model to the Member,
+    e.g. 'referred__' for ReferralRelation, or '' for Member itself.
+    """
+    if connection.vendor == 'sqlite' and len(query) >= TRIGRAM_MIN_LENGTH:
+        matches = RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+            [fts_phrase(query)]
+        )
+        return Q(**{f'{member_path}id__in': matches})
+    # On PostgreSQL UPPER(username) LIKE is served by the pg_trgm index
+    return Q(**{f'{member_path}username__icontains': query})
+
+
+def filter_username(queryset, query, member_path=''):
+    """Keep rows whose member username contains query"""
+    return queryset.filter(username_match(query, member_path))
+
+
+def rank_username(queryset, query, member_path=''):
+    """Order username matches with prefix matches first, then alphabetically"""
+    return queryset.annotate(
+        match_rank=Case(
+            When(**{f'{member_path}username__istartswith': query}, then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField()
+        )
+    ).order_by('match_rank', f'{member_path}username', 'pk')
+
+
+def search_username(queryset, query, member_path=''):
+    """Filter and rank rows by member username"""
+    return rank_username(filter_username(queryset, query, member_path), query, member_path)
@@ -1,5 +1,7 @@
 from rest_framework import serializers
-from api.models import Member, ReferralRelation, Transaction, Level
+from django.db import transaction
+from django.db.models import Sum
+from api.models import Member, ReferralRelation, Transaction, Level, OutboxEvent
 from decimal import Decimal
 
 
@@ -87,13 +89,12 @@ class MemberAdminSerializer(serializers.ModelSerializer):
     
     def get_total_earned(self, obj):
         """Calculate total earned from bonuses"""
-        bonus_transactions = Transaction.objects.filter(
+        total = Transaction.objects.filter(
             member=obj,
             type='bonus',
             status='confirmed'
-        )
-        total = sum(t.amount for t in bonus_transactions)
-        return float(total)
+        ).aggregate(total=Sum('amount'))['total']
+        return float(total or 0)
 
 
 class MemberRegistrationSerializer(serializers.Serializer):
@@ -129,8 +130,9 @@ class MemberRegistrationSerializer(serializers.Serializer):
                 raise serializers.ValidationError("Invalid referral code")
         return value
     
+    @transaction.atomic
     def create(self, validated_data):
-        """Create new member with referral tracking"""
+        """Create new member with referral tracking, in one database transaction"""
         referral_code = validated_data.pop('referral_code', None)
         password = validated_data.pop('password')
         
@@ -140,34 +142,49 @@ class MemberRegistrationSerializer(serializers.Serializer):
         member.save()
         
         # Handle referral if code provided
+        referrer = None
         if referral_code and referral_code.strip():
             referrer = Member.objects.filter(referral_code=referral_code).first()
-            if referrer:
-                ReferralRelation.create_referral_chain(referrer, member)
+        
+        OutboxEvent.append([
+            OutboxEvent(
+                type=OutboxEvent.MEMBER_REGISTERED,
+                member_id=member.id,
+                payload={
+                    'username': member.username,
+                    'user_type': member.user_type,
+                    'referrer_id': referrer.id if referrer else None,
+                }
+            )
+        ])
+        
+        if referrer:
+            ReferralRelation.create_referral_chain(referrer, member)
+            
+            # Award bonuses to all referrers in chain
+            relations = ReferralRelation.objects.filter(referred=member).order_by('level')
+            for relation in relations:
+                if relation.level == 1:
+                    bonus_amount = relation.referrer.calculate_referral_bonus(member)
+                else:
+                    bonus_amount = relation.referrer.calculate_indirect_bonus(relation.level)
                 
-                # Award bonuses to all referrers in chain
-                relations = ReferralRelation.objects.filter(referred=member).order_by('level')
-                for relation in relations:
-                    if relation.level == 1:
-                        bonus_amount = relation.referrer.calculate_referral_bonus(member)
-                    else:
-                        bonus_amount = relation.referrer.calculate_indirect_bonus(relation.level)
-                    
-                    # Create transaction for bonus
-                    currency = 'vcoins' if relation.referrer.user_type == 'player' else 'rubles'
-                    transaction = Transaction.objects.create(
-                        member=relation.referrer,
-                        type='bonus',
-                        amount=bonus_amount,
-                        currency=currency,
-                        status='confirmed',
-                        description=f"Referral bonus from {member.username} (Level {relation.level})",
-                        related_member=member
-                    )
-                    transaction.complete()
-                    
-                    # Check for level upgrade
-                    Level.check_and_update_member_level(relation.referrer)
+                # Create transaction for bonus
+                currency = 'vcoins' if relation.referrer.user_type == 'player' else 'rubles'
+                bonus_transaction = Transaction.objects.create(
+                    member=relation.referrer,
+                    type='bonus',
+                    amount=bonus_amount,
+                    currency=currency,
+                    status='confirmed',
+                    description=f"Referral bonus from {member.username} (Level {relation.level})",
+                    related_member=member,
+                    referral_level=relation.level
+                )
+                bonus_transaction.complete()
+            
+            # Only the direct referrer's referral count changed
+            Level.check_and_update_member_level(referrer)
         
         return member
 
@@ -217,14 +234,13 @@ class ReferralRelationSerializer(serializers.ModelSerializer):
     
     def get_total_earned_from(self, obj):
         """Calculate total earned from this referral"""
-        transactions = Transaction.objects.filter(
-            member=obj.referrer,
+        total = Transaction.objects.filter(
+            member_id=obj.referrer_id,
             type='bonus',
-            related_member=obj.referred,
+            related_member_id=obj.referred_id,
             status='confirmed'
-        )
-        total = sum(t.amount for t in transactions)
-        return float(total)
+        ).aggregate(total=Sum('amount'))['total']
+        return float(total or 0)
 
 
 class TransactionSerializer(serializers.ModelSerializer):
@@ -284,26 +300,18 @@ class BonusSerializer(serializers.Serializer):
     amount = serializers.DecimalField(max_digits=15, decimal_places=2)
     referral_id = serializers.IntegerField()
     referral_username = serializers.CharField()
-    referral_level = serializers.IntegerField()
+    referral_level = serializers.IntegerField(allow_null=True)
     reason = serializers.CharField()
     created_at = serializers.DateTimeField(read_only=True)
     
     def to_representation(self, instance):
         """Convert Transaction to Bonus format"""
-        # Extract level from description
-        level = 1
-        if 'Level' in instance.description:
-            try:
-                level = int(instance.description.split('Level ')[1].split(')')[0])
-            except:
-                level = 1
-        
         return {
             'id': instance.id,
             'amount': float(instance.amount),
             'referral_id': instance.related_member.id if instance.related_member else None,
             'referral_username': instance.related_member.username if instance.related_member else 'Unknown',
-            'referral_level': level,
+            'referral_level': instance.referral_level,
             'reason': instance.description,
             'created_at': instance.created_at
         }
@@ -346,6 +354,52 @@ class ReferralTreeNodeSerializer(serializers.Serializer):
         }
 
 
+class ReferralTreeChildSerializer(serializers.Serializer):
+    """Serializer for one lazily expanded referral tree node"""
+    id = serializers.IntegerField(source='referred.id')
+    username = serializers.CharField(source='referred.username')
+    user_type = serializers.CharField(source='referred.user_type')
+    level = serializers.SerializerMethodField()
+    created_at = serializers.DateTimeField()
+    child_count = serializers.IntegerField(source='referred.direct_referral_count')
+    descendant_count = serializers.IntegerField(source='referred.downline_count')
+    
+    def get_level(self, obj):
+        """Depth of the node below the requesting member"""
+        return self.context['parent_level'] + 1
+
+
+class ReferralTreeChildrenSerializer(serializers.Serializer):
+    """Serializer for a page of referral tree children"""
+    node_id = serializers.IntegerField()
+    results = ReferralTreeChildSerializer(many=True)
+    next_cursor = serializers.IntegerField(allow_null=True)
+
+
+class ReferralUplineEntrySerializer(serializers.Serializer):
+    """Serializer for one ancestor in a member's referral chain"""
+    id = serializers.IntegerField(source='referrer.id')
+    username = serializers.CharField(source='referrer.username')
+    user_type = serializers.CharField(source='referrer.user_type')
+    level = serializers.IntegerField()
+    created_at = serializers.DateTimeField()
+
+
+class ReferralUplineSerializer(serializers.Serializer):
+    """Serializer for a member's ancestor chain"""
+    member_id = serializers.IntegerField()
+    upline = ReferralUplineEntrySerializer(many=True)
+
+
+class ReferralSearchResultSerializer(serializers.Serializer):
+    """Serializer for a member found in the user's referral network"""
+    id = serializers.IntegerField(source='referred.id')
+    username = serializers.CharField(source='referred.username')
+    user_type = serializers.CharField(source='referred.user_type')
+    level = serializers.IntegerField()
+    created_at = serializers.DateTimeField()
+
+
 class ManualBonusRequestSerializer(serializers.Serializer):
     """Serializer for manual bonus assignment request"""
     user_id = serializers.IntegerField(required=True)
@@ -380,3 +434,44 @@ class SystemStatsSerializer(serializers.Serializer):
 class MessageSerializer(serializers.Serializer):
     message = serializers.CharField(max_length=200)
     timestamp = serializers.DateTimeField(read_only=True)
+
+
+class OutboxEventSerializer(serializers.Serializer):
+    """Serializer for one outbox event"""
+    id = serializers.IntegerField(help_text='Cursor, increasing in commit order')
+    type = serializers.ChoiceField(choices=OutboxEvent.TYPE_CHOICES)
+    member_id = serializers.IntegerField()
+    payload = serializers.DictField(help_text='Event specific fields')
+    created_at = serializers.DateTimeField()
+
+
+class OutboxEventPageSerializer(serializers.Serializer):
+    """Serializer for a batch of the outbox event feed"""
+    events = OutboxEventSerializer(many=True)
+    next_after = serializers.IntegerField(help_text='Pass as after to get the next batch')
+    has_more = serializers.BooleanField()
+
+
+class LedgerBalanceSerializer(serializers.Serializer):
+    """Serializer for a member's ledger balances at a point in time"""
+    member_id = serializers.IntegerField()
+    at = serializers.DateTimeField(allow_null=True, help_text='Null for the current balances')
+    balance_vcoins = serializers.DecimalField(max_digits=15, decimal_places=2)
+    balance_rubles = serializers.DecimalField(max_digits=15, decimal_places=2)
+
+
+class HealthSerializer(serializers.Serializer):
+    """Serializer for health check results"""
+    status = serializers.ChoiceField(choices=['ok', 'fail'])
+    reason = serializers.CharField(
+        required=False,
+        allow_null=True,
+        help_text='Name of the first failed check, null when ready'
+    )
+    checked_at = serializers.DateTimeField(required=False)
+    cached = serializers.BooleanField(required=False)
+    checks = serializers.DictField(
+        child=serializers.DictField(),
+        required=False,
+        help_text='Result of each check: ok, ms and check specific details (admins and local addresses only)'
+    )
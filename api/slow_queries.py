@@ -0,0 +1,214 @@
+"""
+Slow-query log.
+
+An execute wrapper installed on every database connection times each
+statement. Statements slower than SLOW_QUERY_MS are appended to the JSON
+lines file SLOW_QUERY_LOG with their normalized fingerprint, the project
+line that ran them and the view of the current request. The first time a SELECT fingerprint is seen
+(again every SLOW_QUERY_PLAN_SECONDS, tracked in the shared cache so
+workers don't repeat it) its query plan is captured as well, on the
+backend cursor so that request query counts don't include the EXPLAIN.
+``manage.py slow_queries`` aggregates the log per fingerprint.
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from api.profiling import normalize_sql
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+}
+EXPLAIN_SAVEPOINT = 'slow_query_explain'
+
+_local = threading.local()
+
+
+def fingerprint_id(fingerprint):
+    return hashlib.sha1(fingerprint.encode()).hexdigest()[:12]
+
+
+IGNORED_FILES = ('slow_queries.py', 'profiling.py', 'manage.py', 'gunicorn.conf.py')
+REQUEST_HANDLER = os.path.join('django', 'core', 'handlers', 'base.py')
+
+
+def describe_view(request, callback):
+    """'METHOD /path (ViewClass)' for the view Django resolved the request to"""
+    target = getattr(callback, '__wrapped__', callback)
+    view_class = getattr(callback, 'view_class', None)
+    owner = getattr(target, '__self__', None)
+    if view_class is not None:
+        name = view_class.__qualname__
+    elif owner is not None:
+        # Admin views are bound methods of the ModelAdmin or AdminSite
+        name = f'{type(owner).__qualname__}.{target.__name__}'
+    else:
+        name = getattr(target, '__qualname__', repr(target))
+    return f'{request.method} {request.path} ({name})'
+
+
+def find_callers():
+    """
+    Where a query comes from: the innermost project frame issuing it and
+    the view handling the current request (or, outside requests, the
+    outermost project frame, e.g. a management command)
+    """
+    root = str(settings.BASE_DIR) + os.sep
+    frames = []
+    view = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.endswith(REQUEST_HANDLER) and frame.f_code.co_name == '_get_response':
+            callback = frame.f_locals.get('callback')
+            request = frame.f_locals.get('request')
+            if callback is not None and request is not None:
+                view = describe_view(request, callback)
+            break
+        if (
+            filename.startswith(root)
+            and 'site-packages' not in filename
+            and not filename.endswith(IGNORED_FILES)
+        ):
+            frames.append(f'{filename[len(root):]}:{frame.f_lineno} in {frame.f_code.co_qualname}')
+        frame = frame.f_back
+    caller = frames[0] if frames else None
+    return caller, view or (frames[-1] if frames else None)
+
+
+def explain(connection, sql, params):
+    """
+    Query plan lines of a statement, or None if it can't be explained.
+
+    Runs on the backend cursor, below the connection's execute wrappers, so
+    the EXPLAIN is not counted as a statement of the request by the metrics
+    and profiling wrappers.
+    """
+    prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+    if prefix is None or not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+
+    # Savepoint, so a failing EXPLAIN can't break the caller's transaction
+    savepoint = connection.in_atomic_block
+    try:
+        with connection.cursor() as wrapped:
+            cursor = wrapped.cursor
+            if savepoint:
+                cursor.execute(f'SAVEPOINT {EXPLAIN_SAVEPOINT}')
+            try:
+                cursor.execute(prefix + sql, params)
+                rows = cursor.fetchall()
+            except connection.Database.Error:
+                if savepoint:
+                    cursor.execute(f'ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}')
+                raise
+            finally:
+                if savepoint:
+                    cursor.execute(f'RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}')
+    except connection.Database.Error:
+        logger.debug('EXPLAIN failed', exc_info=True)
+        return None
+
+    if connection.vendor != 'sqlite':
+        return [row[0] for row in rows]
+    # (id, parent, notused, detail) rows form a tree
+    depths = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depths[node_id] = depths.get(parent, -1) + 1
+        lines.append('  ' * depths[node_id] + detail)
+    return lines
+
+
+def should_explain(fingerprint_hash):
+    """True once per fingerprint and plan interval across all workers"""
+    return cache.add(
+        f'slow-query-plan:{fingerprint_hash}', 1, settings.SLOW_QUERY_PLAN_SECONDS
+    )
+
+
+def write_entry(entry):
+    path = Path(settings.SLOW_QUERY_LOG)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if path.stat().st_size > settings.SLOW_QUERY_LOG_MAX_BYTES:
+            os.replace(path, path.with_name(path.name + '.1'))
+    except FileNotFoundError:
+        pass
+    # One write per line; appends of a line don't interleave between workers
+    with open(path, 'a') as handle:
+        handle.write(json.dumps(entry) + '\n')
+
+
+def slow_query_logger(execute, sql, params, many, context):
+    """Execute wrapper logging statements slower than SLOW_QUERY_MS"""
+    if getattr(_local, 'active', False):
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    result = execute(sql, params, many, context)
+    ms = (time.perf_counter() - started) * 1000
+    if ms < settings.SLOW_QUERY_MS:
+        return result
+
+    _local.active = True
+    try:
+        connection = context['connection']
+        fingerprint = normalize_sql(sql)
+        fingerprint_hash = fingerprint_id(fingerprint)
+        caller, view = find_callers()
+        entry = {
+            'at': timezone.now().isoformat(),
+            'ms': round(ms, 3),
+            'fingerprint': fingerprint_hash,
+            'sql': fingerprint,
+            'many': many,
+            'caller': caller,
+            'view': view,
+            'vendor': connection.vendor,
+        }
+        if not many and should_explain(fingerprint_hash):
+            entry['plan'] = explain(connection, sql, params)
+        write_entry(entry)
+        logger.warning('Slow query %s (%.1f ms) from %s', fingerprint_hash, ms, caller or view)
+    except Exception:
+        # Logging must never fail the query itself
+        logger.exception('Could not log slow query')
+    finally:
+        _local.active = False
+    return result
+
+
+def install_slow_query_logger(sender, connection, **kwargs):
+    """connection_created receiver adding the wrapper to new connections"""
+    if settings.SLOW_QUERY_MS > 0 and slow_query_logger not in connection.execute_wrappers:
+        connection.execute_wrappers.append(slow_query_logger)
+
+
+def read_entries():
+    """Entries of the rotated and current log files, oldest first"""
+    path = Path(settings.SLOW_QUERY_LOG)
+    for candidate in (path.with_name(path.name + '.1'), path):
+        try:
+            handle = open(candidate)
+        except FileNotFoundError:
+            continue
+        with handle:
+            for line in handle:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Partially written last line
+                    continue
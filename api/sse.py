@@ -0,0 +1,380 @@
+"""
+Server-sent event stream of a member's balance, bonus and level changes.
+
+Runs as its own asyncio process (``manage.py sse_server``, under
+supervisord): a sync gunicorn worker would be held by each idle stream,
+here one costs a coroutine and a socket. nginx proxies
+/api/events/stream to it.
+
+The server follows the outbox (OutboxEvent) with a single cursor for all
+streams. It reads new events when a web worker wakes it up after a commit
+(api.broker) or at the latest every SSE_POLL_SECONDS, and pushes those of
+connected members to their streams. All database work runs on one
+thread, so the server holds one database connection however many
+streams are open.
+
+Streams send:
+- ``balance`` with the member's balances on connect and after confirmed
+  transactions
+- ``bonus`` for each confirmed bonus
+- ``level`` for level changes
+- ``resync`` when a reconnect (Last-Event-ID) is too far behind to replay
+
+The session is checked again at least every SSE_HEARTBEAT_SECONDS, and the
+stream closed once it no longer signs in the member (logout, expiry).
+"""
+import asyncio
+import json
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import CookieError, SimpleCookie
+from importlib import import_module
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+
+from api.broker import WakeUpProtocol
+from api.models import Member, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATH = '/api/events/stream'
+# Outbox rows read per query
+BATCH_SIZE = 2000
+# Pending messages after which a slow stream is closed
+MAX_QUEUED = 100
+REQUEST_TIMEOUT = 10
+RETRY_MS = 3000
+HEARTBEAT = b': ping\n\n'
+
+
+def format_message(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+def build_messages(rows, balances):
+    """
+    SSE messages per member for outbox rows (id, type, member_id, payload),
+    given the current balances of members with confirmed transactions
+    """
+    messages = {}
+    balance_ids = {}
+    for event_id, event_type, member_id, payload in rows:
+        if event_type == OutboxEvent.TRANSACTION_CONFIRMED:
+            balance_ids[member_id] = event_id
+            if payload.get('type') == 'bonus':
+                messages.setdefault(member_id, []).append(format_message('bonus', payload, event_id))
+        elif event_type == OutboxEvent.MEMBER_LEVEL_CHANGED:
+            messages.setdefault(member_id, []).append(
+                format_message('level', {'level': payload['to'], 'previous': payload['from']}, event_id)
+            )
+    # One balance per member and batch, after its bonuses
+    for member_id, event_id in balance_ids.items():
+        if member_id in balances:
+            messages.setdefault(member_id, []).append(
+                format_message('balance', balances[member_id], event_id)
+            )
+    return messages
+
+
+# Database work, run on the server's database thread
+
+def _call(func, *args):
+    try:
+        return func(*args)
+    except DatabaseError:
+        # Start over with a fresh connection next time
+        connection.close()
+        raise
+
+
+def latest_event_id():
+    return OutboxEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def read_balances(member_ids):
+    return {
+        row['id']: {
+            'balance_vcoins': str(row['balance_vcoins']),
+            'balance_rubles': str(row['balance_rubles']),
+            'level': row['level'],
+        }
+        for row in Member.objects.filter(id__in=member_ids).values(
+            'id', 'balance_vcoins', 'balance_rubles', 'level'
+        )
+    }
+
+
+def read_events(after, member_ids):
+    """New cursor, whether more rows are waiting, and messages of the given members"""
+    rows = list(
+        OutboxEvent.objects.filter(id__gt=after).order_by('id')
+        .values_list('id', 'type', 'member_id', 'payload')[:BATCH_SIZE]
+    )
+    cursor = rows[-1][0] if rows else after
+    more = len(rows) == BATCH_SIZE
+    rows = [row for row in rows if row[2] in member_ids]
+    balances = read_balances({
+        row[2] for row in rows if row[1] == OutboxEvent.TRANSACTION_CONFIRMED
+    })
+    return cursor, more, build_messages(rows, balances)
+
+
+def read_member_events(member_id, after, upto):
+    """Messages of one member's events in (after, upto] and its balance"""
+    rows = list(
+        OutboxEvent.objects.filter(id__gt=after, id__lte=upto, member_id=member_id)
+        .order_by('id').values_list('id', 'type', 'member_id', 'payload')
+    )
+    balances = read_balances([member_id])
+    messages = build_messages(rows, balances).get(member_id, [])
+    if member_id in balances and not any(row[1] == OutboxEvent.TRANSACTION_CONFIRMED for row in rows):
+        messages.append(format_message('balance', balances[member_id], upto))
+    return messages
+
+
+def session_member(session_key):
+    """Member id of a session cookie, None if not signed in"""
+    if not session_key:
+        return None
+    store = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    member_id = store.get('member_id')
+    if member_id and Member.objects.filter(id=member_id).exists():
+        return member_id
+    return None
+
+
+def parse_request(head):
+    """(method, path, lowercase header dict) of an HTTP request head"""
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ')
+    if len(parts) != 3:
+        raise ValueError('Malformed request line')
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return parts[0], parts[1].split('?', 1)[0], headers
+
+
+def error_response(status_line, error, detail, retry_after=None):
+    body = json.dumps({'error': error, 'detail': detail}).encode()
+    head = [
+        f'HTTP/1.1 {status_line}',
+        'Content-Type: application/json',
+        f'Content-Length: {len(body)}',
+        'Connection: close',
+    ]
+    if retry_after:
+        head.append(f'Retry-After: {retry_after}')
+    return ('\r\n'.join(head) + '\r\n\r\n').encode() + body
+
+
+STREAM_HEAD = (
+    'HTTP/1.1 200 OK\r\n'
+    'Content-Type: text/event-stream\r\n'
+    'Cache-Control: no-store\r\n'
+    'X-Accel-Buffering: no\r\n'
+    'Connection: close\r\n'
+    '\r\n'
+    f'retry: {RETRY_MS}\n\n'
+).encode()
+
+
+class EventStreamServer:
+
+    def __init__(self, host, port, notify_port):
+        self.host = host
+        self.port = port
+        self.notify_port = notify_port
+        # member id -> set of queues, one per open stream
+        self.streams = {}
+        self.stream_count = 0
+        self.cursor = 0
+        self.wakeup = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sse-db')
+
+    async def db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _call, func, *args)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        self.cursor = await self.db(latest_event_id)
+        server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        transport = None
+        if self.notify_port:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: WakeUpProtocol(self.wakeup), local_addr=(self.host, self.notify_port)
+            )
+        follower = asyncio.create_task(self.follow_outbox())
+        logger.info(
+            'Event stream server on %s:%s, notifications on udp %s, outbox cursor %s',
+            self.host, self.port, self.notify_port, self.cursor
+        )
+
+        await stop.wait()
+        follower.cancel()
+        server.close()
+        if transport is not None:
+            transport.close()
+        # Ends the open streams; clients reconnect to the restarted server
+        for queues in list(self.streams.values()):
+            for queue in queues:
+                queue.put_nowait(None)
+        await server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def follow_outbox(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), settings.SSE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.read_new_events()
+            except DatabaseError:
+                logger.exception('Reading outbox events failed')
+
+    async def read_new_events(self):
+        while True:
+            if not self.streams:
+                # Nobody to tell, just move past the events
+                self.cursor = await self.db(latest_event_id)
+                return
+            cursor, more, messages = await self.db(read_events, self.cursor, frozenset(self.streams))
+            self.cursor = cursor
+            for member_id, member_messages in messages.items():
+                self.publish(member_id, b''.join(member_messages))
+            if not more:
+                return
+
+    def publish(self, member_id, data):
+        for queue in self.streams.get(member_id, ()):
+            if queue.qsize() >= MAX_QUEUED:
+                # The client doesn't keep up, let it reconnect and resync
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(data)
+
+    async def handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+            method, path, headers = parse_request(head)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError, ValueError):
+            writer.close()
+            return
+
+        try:
+            await self.serve(reader, writer, method, path, headers)
+        except ConnectionError:
+            pass
+        except DatabaseError:
+            logger.exception('Opening event stream failed')
+            writer.write(error_response(
+                '503 Service Unavailable', 'Service unavailable', 'Try again later', 5
+            ))
+        finally:
+            writer.close()
+
+    async def serve(self, reader, writer, method, path, headers):
+        if path != STREAM_PATH:
+            writer.write(error_response('404 Not Found', 'Not found', f'Only {STREAM_PATH} is served'))
+            return
+        if method != 'GET':
+            writer.write(error_response('405 Method Not Allowed', 'Method not allowed', 'Use GET'))
+            return
+
+        try:
+            cookies = SimpleCookie(headers.get('cookie', ''))
+        except CookieError:
+            cookies = {}
+        session_cookie = cookies.get(settings.SESSION_COOKIE_NAME)
+        session_key = session_cookie.value if session_cookie else None
+        member_id = await self.db(session_member, session_key)
+        if member_id is None:
+            writer.write(error_response(
+                '401 Unauthorized', 'Authentication required', 'User is not authenticated'
+            ))
+            return
+        if self.stream_count >= settings.SSE_MAX_CONNECTIONS:
+            writer.write(error_response(
+                '503 Service Unavailable', 'Service overloaded', 'Too many open event streams', 5
+            ))
+            return
+        if len(self.streams.get(member_id, ())) >= settings.SSE_MAX_STREAMS_PER_MEMBER:
+            writer.write(error_response(
+                '429 Too Many Requests', 'Too many requests', 'Too many open event streams for this user', 5
+            ))
+            return
+
+        # Register before reading the backlog: later events queue up
+        # behind it instead of getting lost
+        queue = asyncio.Queue()
+        self.streams.setdefault(member_id, set()).add(queue)
+        self.stream_count += 1
+        closed = asyncio.ensure_future(reader.read())
+        closed.add_done_callback(lambda _: queue.put_nowait(None))
+        loop = asyncio.get_running_loop()
+        try:
+            writer.write(STREAM_HEAD)
+            await self.send_backlog(writer, member_id, headers.get('last-event-id'))
+            checked_at = loop.time()
+            while True:
+                try:
+                    data = await asyncio.wait_for(queue.get(), settings.SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    data = HEARTBEAT
+                if data is None:
+                    return
+                if loop.time() - checked_at >= settings.SSE_HEARTBEAT_SECONDS:
+                    # Signed out, expired or deleted since the stream opened
+                    if not await self.signed_in(session_key, member_id):
+                        return
+                    checked_at = loop.time()
+                writer.write(data)
+                await writer.drain()
+        finally:
+            closed.cancel()
+            self.stream_count -= 1
+            queues = self.streams[member_id]
+            queues.discard(queue)
+            if not queues:
+                del self.streams[member_id]
+
+    async def signed_in(self, session_key, member_id):
+        """Whether the stream's session still belongs to its member"""
+        try:
+            return await self.db(session_member, session_key) == member_id
+        except DatabaseError:
+            # Too late for an error response, the client reconnects instead
+            logger.exception('Checking event stream session failed')
+            return False
+
+    async def send_backlog(self, writer, member_id, last_event_id):
+        """Missed events after Last-Event-ID, or a resync, then the current balance"""
+        upto = self.cursor
+        try:
+            after = int(last_event_id) if last_event_id else upto
+        except ValueError:
+            after = upto
+        if after < upto - settings.SSE_REPLAY_WINDOW:
+            writer.write(format_message('resync', {}, upto))
+            after = upto
+        messages = await self.db(read_member_events, member_id, min(after, upto), upto)
+        writer.write(b''.join(messages))
+        await writer.drain()
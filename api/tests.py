@@ -1,3 +1,1387 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.admin import site
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models, transaction
+from django.forms import model_to_dict
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api import graph, health, metrics, sse
+from api.admin import DateProbeQuerySet
+from api.admission import route_class
+from api.backfill import compute_referral_rollups, run_backfill
+from api.metrics import QueryCounter
+from api.pagination import CappedCountPagination, CappedCountPaginator, EstimatedCountPaginator
+from api.models import (
+    BalanceSnapshot, IdempotencyKey, LedgerEntry, Level, Member, OutboxEvent, ReferralLevelRollup,
+    ReferralRelation, Transaction
+)
+from api.profiling import list_profiles, load_profile_meta
+from api.search import FTS_TRIGGERS, restore_fts_triggers, search_username
+from api.serializers import (
+    MemberAdminSerializer, MemberRegistrationSerializer, MemberSerializer, ReferralRelationSerializer
+)
+from api.slow_queries import explain, slow_query_logger
+from api.sse import EventStreamServer
+from api.views import ReferralTreeChildrenView
+
+
+def create_member(username, **fields):
+    member = Member(username=username, **fields)
+    member.set_password('password123')
+    member.save()
+    return member
+
+
+def register(username, referrer=None, user_type='player'):
+    """Register a member the way the API does, with its referral chain and bonuses"""
+    serializer = MemberRegistrationSerializer(data={
+        'username': username,
+        'password': 'password123',
+        'user_type': user_type,
+        'referral_code': referrer.referral_code if referrer else None,
+    })
+    serializer.is_valid(raise_exception=True)
+    return serializer.save()
+
+
+def client_for(member):
+    """Test client signed in as member"""
+    client = Client()
+    session = client.session
+    session['member_id'] = member.id
+    session.save()
+    client.cookies['sessionid'] = session.session_key
+    return client
+
+
+def query_plan(sql, params=()):
+    """EXPLAIN QUERY PLAN details of one statement, joined into a string"""
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return ' | '.join(row[-1] for row in cursor.fetchall())
+
+
+def captured_plans(func):
+    """Run func and return the query plans of the SELECTs it ran"""
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    return [
+        query_plan(query['sql'])
+        for query in queries.captured_queries
+        if query['sql'].startswith('SELECT')
+    ]
+
+
+class TransactionQueryPlanTests(TestCase):
+    """Hot transaction queries must be answered from their indexes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.referrer = create_member('referrer')
+        cls.referred = create_member('referred')
+        Transaction.objects.bulk_create([
+            Transaction(
+                member=cls.referrer,
+                type='bonus',
+                amount=Decimal('10.00'),
+                currency='vcoins',
+                status='confirmed',
+                related_member=cls.referred,
+                referral_level=1
+            )
+            for _ in range(5)
+        ])
+
+    def test_total_earned_uses_covering_stats_index(self):
+        plans = captured_plans(lambda: MemberAdminSerializer().get_total_earned(self.referrer))
+        self.assertEqual(len(plans), 1)
+        self.assertIn('USING COVERING INDEX transaction_member_stats_idx', plans[0])
+
+    def test_level_earnings_use_stats_index(self):
+        plans = captured_plans(
+            lambda: compute_referral_rollups(ReferralRelation, Transaction, [self.referrer.id])
+        )
+        earnings = [plan for plan in plans if 'transactions' in plan]
+        self.assertEqual(len(earnings), 1)
+        self.assertIn('transaction_member_stats_idx', earnings[0])
+
+    def test_earnings_per_referral_use_bonus_index(self):
+        relation = ReferralRelation(referrer=self.referrer, referred=self.referred, level=1)
+        plans = captured_plans(lambda: ReferralRelationSerializer().get_total_earned_from(relation))
+        self.assertEqual(len(plans), 1)
+        self.assertIn('USING INDEX transaction_bonus_related_idx (member_id=? AND related_member_id=?)', plans[0])
+
+    def test_pending_deposit_queue_uses_partial_index(self):
+        pending = Transaction.objects.filter(type='deposit', status='pending')
+        plans = captured_plans(lambda: (list(pending.order_by('-created_at')[:100]), pending.count()))
+        self.assertEqual(len(plans), 2)
+        for plan in plans:
+            self.assertIn('transaction_pending_dep_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plans[0])
+
+    def test_direct_referrer_uses_partial_index(self):
+        ReferralRelation.objects.create(referrer=self.referrer, referred=self.referred, level=1)
+        plans = captured_plans(lambda: MemberSerializer().get_referred_by(self.referred))
+        self.assertEqual(len(plans), 2)
+        self.assertIn('referral_direct_ref_idx', plans[0])
+
+    def test_level_index_was_dropped(self):
+        indexes = connection.introspection.get_constraints(connection.cursor(), 'transactions')
+        self.assertNotIn('transaction_member_level_idx', indexes)
+        self.assertIn('transaction_member_stats_idx', indexes)
+
+
+class BackfillTests(TestCase):
+    """Backfills stop after max_chunks and resume from their checkpoint"""
+
+    def bonuses(self, member, count):
+        return Transaction.objects.bulk_create([
+            Transaction(
+                member=member, type='bonus', amount=Decimal('1.00'), currency='vcoins',
+                status='confirmed', description=f'Referral bonus (Level {level})'
+            )
+            for level in range(1, count + 1)
+        ])
+
+    def levels(self, rows):
+        return list(
+            Transaction.objects.filter(pk__in=[row.pk for row in rows])
+            .order_by('pk').values_list('referral_level', flat=True)
+        )
+
+    def test_resume_after_max_chunks(self):
+        rows = self.bonuses(create_member('earner'), 4)
+        first = run_backfill(
+            'transaction_referral_level', chunk_size=rows[1].pk, sleep=0, max_chunks=1, reset=True
+        )
+        self.assertEqual((first.last_pk, first.rows_processed), (rows[1].pk, 2))
+        self.assertIsNone(first.completed_at)
+        self.assertEqual(self.levels(rows), [1, 2, None, None])
+
+        # Rows created after the run started are left to the application
+        late = self.bonuses(create_member('late'), 1)
+        resumed = run_backfill('transaction_referral_level', chunk_size=1, sleep=0)
+        self.assertEqual((resumed.last_pk, resumed.rows_processed), (rows[3].pk, 4))
+        self.assertIsNotNone(resumed.completed_at)
+        self.assertEqual(self.levels(rows), [1, 2, 3, 4])
+        self.assertEqual(self.levels(late), [None])
+
+        # A completed backfill does nothing until reset
+        self.assertEqual(run_backfill('transaction_referral_level', sleep=0).rows_processed, 4)
+        self.assertEqual(self.levels(late), [None])
+
+
+@override_settings(REFERRAL_GRAPH_REFRESH_SECONDS=3600)
+class ReferralTreeTests(TestCase):
+    """The tree is tagged with the member's data version, so it must be current"""
+
+    def setUp(self):
+        graph._graph = None
+
+    def test_new_referral_shows_up_with_the_new_etag(self):
+        root = register('root')
+        client = client_for(root)
+        first = client.get('/api/referrals/tree')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json(), [])
+
+        register('child', referrer=root)
+        second = client.get('/api/referrals/tree', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual([node['username'] for node in second.json()], ['child'])
+
+        third = client.get('/api/referrals/tree', HTTP_IF_NONE_MATCH=second['ETag'])
+        self.assertEqual(third.status_code, 304)
+
+
+    @override_settings(REFERRAL_GRAPH_REBUILD_SECONDS=0)
+    def test_due_rebuild_runs_in_the_background(self):
+        root = register('root')
+        built = graph.get_referral_graph()
+        register('child', referrer=root)
+        with mock.patch.object(graph, 'start_rebuild') as start_rebuild:
+            current = graph.get_referral_graph(current=True)
+        start_rebuild.assert_called_once_with()
+        # The request is served from the existing graph and its overlay
+        self.assertIs(current, built)
+        self.assertEqual(current.children_of(root.id), [Member.objects.get(username='child').id])
+
+class LevelRecomputeTests(TestCase):
+    """Member levels follow the thresholds of the level table"""
+
+    def setUp(self):
+        Level.objects.create(name='silver', required_referrals=1)
+        Level.objects.create(name='gold', required_referrals=2)
+        self.members = []
+        for count in (0, 1, 2):
+            member = create_member(f'referrals_{count}')
+            Member.objects.filter(pk=member.pk).update(direct_referral_count=count)
+            self.members.append(member)
+        Level.recompute_member_levels()
+
+    def levels(self):
+        return [Member.objects.get(pk=member.pk).level for member in self.members]
+
+    def level_events(self):
+        return list(
+            OutboxEvent.objects.filter(type=OutboxEvent.MEMBER_LEVEL_CHANGED)
+            .order_by('member_id').values_list('member_id', 'payload')
+        )
+
+    def test_threshold_change_moves_members(self):
+        self.assertEqual(self.levels(), ['none', 'silver', 'gold'])
+        OutboxEvent.objects.all().delete()
+        version = Member.objects.get(pk=self.members[2].pk).data_version
+
+        Level.objects.filter(name='gold').update(required_referrals=3)
+        self.assertEqual(Level.recompute_member_levels(), 1)
+        self.assertEqual(self.levels(), ['none', 'silver', 'silver'])
+        self.assertEqual(self.level_events(), [(self.members[2].id, {'from': 'gold', 'to': 'silver'})])
+        self.assertEqual(Member.objects.get(pk=self.members[2].pk).data_version, version + 1)
+
+    def test_members_below_every_threshold_drop_to_none(self):
+        OutboxEvent.objects.all().delete()
+        Level.objects.filter(name='silver').delete()
+        Level.objects.filter(name='gold').update(required_referrals=5)
+        self.assertEqual(Level.recompute_member_levels(), 2)
+        self.assertEqual(self.levels(), ['none', 'none', 'none'])
+        self.assertEqual(self.level_events(), [
+            (self.members[1].id, {'from': 'silver', 'to': 'none'}),
+            (self.members[2].id, {'from': 'gold', 'to': 'none'}),
+        ])
+        self.assertEqual(Level.recompute_member_levels(), 0)
+
+class ReferralChainTests(TestCase):
+    """A new member gets one closure row per ancestor, down to MAX_LEVEL"""
+
+    def test_chain_stops_at_max_level(self):
+        chain = [create_member('member_0')]
+        for index in range(1, ReferralRelation.MAX_LEVEL + 2):
+            member = create_member(f'member_{index}')
+            ReferralRelation.create_referral_chain(chain[-1], member)
+            chain.append(member)
+
+        newest = chain[-1]
+        self.assertEqual(
+            list(
+                ReferralRelation.objects.filter(referred=newest)
+                .order_by('level').values_list('referrer__username', 'level')
+            ),
+            [(f'member_{len(chain) - 1 - level}', level) for level in range(1, ReferralRelation.MAX_LEVEL + 1)]
+        )
+        # The root is one level too far above the newest member
+        self.assertFalse(ReferralRelation.objects.filter(referrer=chain[0], referred=newest).exists())
+        self.assertEqual(
+            ReferralRelation.objects.filter(referrer=chain[0]).aggregate(deepest=models.Max('level'))['deepest'],
+            ReferralRelation.MAX_LEVEL
+        )
+        counts = {
+            member.username: (member.direct_referral_count, member.downline_count)
+            for member in Member.objects.filter(username__in=['member_0', 'member_1', 'member_10'])
+        }
+        self.assertEqual(counts, {'member_0': (1, 10), 'member_1': (1, 10), 'member_10': (1, 1)})
+
+
+class ReferralUplineTests(TestCase):
+    """The upline lists a member's referrers, nearest first"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.top = register('top')
+        cls.middle = register('middle', referrer=cls.top)
+        cls.bottom = register('bottom', referrer=cls.middle)
+        cls.admin = create_member('admin', is_admin=True)
+
+    def upline(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [(entry['username'], entry['level']) for entry in response.json()['upline']]
+
+    def test_nearest_ancestor_first(self):
+        response = client_for(self.bottom).get('/api/referrals/upline')
+        self.assertEqual(response.json()['member_id'], self.bottom.id)
+        self.assertEqual(self.upline(response), [('middle', 1), ('top', 2)])
+
+    def test_admin_variant_tells_missing_users_from_roots(self):
+        client = client_for(self.admin)
+        response = client.get(f'/api/admin/users/{self.bottom.id}/upline')
+        self.assertEqual(self.upline(response), [('middle', 1), ('top', 2)])
+        self.assertEqual(self.upline(client.get(f'/api/admin/users/{self.top.id}/upline')), [])
+        response = client.get('/api/admin/users/999999/upline')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['error'], 'Not found')
+        response = client_for(self.bottom).get(f'/api/admin/users/{self.top.id}/upline')
+        self.assertEqual(response.status_code, 403)
+
+
+class ReferralTreeStreamTests(TestCase):
+    """?format=ndjson streams the downline as flat records"""
+
+    def read_lines(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_parents_come_before_children(self):
+        root = register('root')
+        first = register('first', referrer=root)
+        grandchild = register('grandchild', referrer=first)
+        register('great_grandchild', referrer=grandchild)
+        register('second', referrer=root)
+
+        response = client_for(root).get('/api/referrals/tree', {'format': 'ndjson'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        records = self.read_lines(response)
+        self.assertEqual(
+            [(record['username'], record['depth']) for record in records],
+            [('first', 1), ('second', 1), ('grandchild', 2), ('great_grandchild', 3)]
+        )
+        seen = {root.id}
+        for record in records:
+            self.assertIn(record['parent_id'], seen)
+            seen.add(record['id'])
+
+    def test_errors_are_one_line(self):
+        response = Client().get('/api/referrals/tree', {'format': 'ndjson'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.content.count(b'\n'), 1)
+        self.assertEqual(json.loads(response.content)['error'], 'Authentication required')
+
+    def test_each_media_type_has_its_own_etag(self):
+        root = register('root')
+        client = client_for(root)
+        as_json = client.get('/api/referrals/tree')
+        as_ndjson = client.get('/api/referrals/tree', HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(as_ndjson['Content-Type'], 'application/x-ndjson')
+        self.assertNotEqual(as_json['ETag'], as_ndjson['ETag'])
+        # A JSON copy is no validator for the stream
+        response = client.get('/api/referrals/tree', {'format': 'ndjson'}, HTTP_IF_NONE_MATCH=as_json['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+class ReferralTreeChildrenTests(TestCase):
+    """Tree nodes are expanded one keyset page of direct children at a time"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = register('root')
+        cls.children = [register(f'child_{index}', referrer=cls.root) for index in range(3)]
+        cls.grandchild = register('grandchild', referrer=cls.children[0])
+        cls.stranger = register('stranger')
+
+    def page(self, **params):
+        response = client_for(self.root).get('/api/referrals/tree/children', params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [node['username'] for node in data['results']], data['next_cursor']
+
+    def test_keyset_pages_newest_first(self):
+        usernames, cursor = self.page(limit=2)
+        self.assertEqual(usernames, ['child_2', 'child_1'])
+        usernames, cursor = self.page(limit=2, cursor=cursor)
+        self.assertEqual((usernames, cursor), (['child_0'], None))
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(len(self.page(limit=0)[0]), 1)
+        with mock.patch.object(ReferralTreeChildrenView, 'max_limit', 2):
+            usernames, cursor = self.page(limit=1000)
+        self.assertEqual(len(usernames), 2)
+        self.assertIsNotNone(cursor)
+
+    def test_nodes_of_the_downline_only(self):
+        response = client_for(self.root).get(
+            '/api/referrals/tree/children', {'node_id': self.children[0].id}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(node['username'], node['level']) for node in response.json()['results']],
+            [('grandchild', 2)]
+        )
+        for node_id in (self.stranger.id, 10 ** 9):
+            response = client_for(self.root).get('/api/referrals/tree/children', {'node_id': node_id})
+            self.assertEqual(response.status_code, 404)
+        response = client_for(self.root).get('/api/referrals/tree/children', {'cursor': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class UsernameFtsTriggerTests(TransactionTestCase):
+    """Table remakes drop the FTS sync triggers, post-migrate restores them"""
+
+    def triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'members'")
+            return {row[0] for row in cursor.fetchall()}
+
+    def remake_members(self):
+        """Add and drop a column with a default, both remake the table on SQLite"""
+        field = models.IntegerField(default=0)
+        field.set_attributes_from_name('remake_probe')
+        with connection.schema_editor() as schema_editor:
+            schema_editor.add_field(Member, field)
+            schema_editor.remove_field(Member, field)
+
+    def test_triggers_and_index_are_restored_after_a_remake(self):
+        self.remake_members()
+        self.addCleanup(restore_fts_triggers)
+        self.assertEqual(self.triggers(), set())
+
+        # Written while the triggers are gone, only the rebuild indexes it
+        create_member('remade_member')
+        self.assertEqual(sorted(restore_fts_triggers()), sorted(FTS_TRIGGERS))
+        self.assertEqual(self.triggers(), set(FTS_TRIGGERS))
+        self.assertEqual(restore_fts_triggers(), [])
+
+        create_member('after_restore')
+        usernames = search_username(Member.objects.all(), 'member').values_list('username', flat=True)
+        self.assertEqual(list(usernames), ['remade_member'])
+        usernames = search_username(Member.objects.all(), 'restore').values_list('username', flat=True)
+        self.assertEqual(list(usernames), ['after_restore'])
+
+
+def deposit(member, amount, currency='rubles'):
+    return Transaction.objects.create(member=member, type='deposit', amount=Decimal(amount), currency=currency)
+
+
+def reconcile():
+    """Output of the reconcile_ledger command"""
+    out = StringIO()
+    call_command('reconcile_ledger', stdout=out)
+    return out.getvalue()
+
+
+class LedgerTests(TestCase):
+    """Every balance change is a ledger entry, and reconciliation finds drift"""
+
+    def test_completed_deposits_are_in_the_ledger(self):
+        member = create_member('depositor')
+        for amount in ('10.00', '2.50'):
+            deposit(member, amount).complete()
+        member.refresh_from_db()
+        self.assertEqual(member.balance_rubles, Decimal('12.50'))
+        self.assertEqual(LedgerEntry.balance(member.id, 'rubles'), Decimal('12.50'))
+        self.assertEqual(
+            list(member.ledger_entries.values_list('sequence', 'amount')),
+            [(1, Decimal('10.00')), (2, Decimal('2.50'))]
+        )
+        self.assertIn('0 with drift found', reconcile())
+
+    def test_confirmed_transactions_are_not_credited_again(self):
+        member = create_member('rewarded')
+        reward = Transaction.objects.create(
+            member=member, type='tournament', amount=Decimal('5.00'), currency='vcoins', status='confirmed'
+        )
+        reward.complete()
+        member.refresh_from_db()
+        self.assertEqual(member.balance_vcoins, Decimal('0'))
+        self.assertFalse(member.ledger_entries.exists())
+
+    @override_settings(LEDGER_SNAPSHOT_INTERVAL=2)
+    def test_balance_at_a_sequence_reads_the_snapshot(self):
+        member = create_member('snapshotted')
+        for amount in ('1.00', '2.00', '4.00'):
+            deposit(member, amount).complete()
+        self.assertEqual(
+            list(BalanceSnapshot.objects.filter(member=member).values_list('sequence', 'balance')),
+            [(2, Decimal('3.00'))]
+        )
+        self.assertEqual(LedgerEntry.balance(member.id, 'rubles', sequence=2), Decimal('3.00'))
+        self.assertEqual(LedgerEntry.balance(member.id, 'rubles'), Decimal('7.00'))
+
+    def test_reconcile_reports_drift(self):
+        member = create_member('tampered')
+        deposit(member, '10.00').complete()
+        Member.objects.filter(pk=member.pk).update(balance_rubles=Decimal('15.00'))
+        output = reconcile()
+        self.assertIn(f'member {member.id}: rubles balance 15.00, ledger 10.00 (drift 5.00)', output)
+        self.assertIn('1 with drift found', output)
+
+
+class MemberSaveTests(TestCase):
+    """Saving a loaded member never writes its balances back"""
+
+    def test_stale_instance_keeps_later_credits(self):
+        member = create_member('stale')
+        stale = Member.objects.get(pk=member.pk)
+        deposit(member, '10.00').complete()
+        stale.username = 'renamed'
+        stale.save()
+        member.refresh_from_db()
+        self.assertEqual((member.username, member.balance_rubles), ('renamed', Decimal('10.00')))
+        self.assertIn('0 with drift found', reconcile())
+
+    def test_admin_balance_edit_is_an_adjustment(self):
+        member = create_member('adjusted')
+        model_admin = site._registry[Member]
+        request = RequestFactory().post('/admin/')
+        obj = Member.objects.get(pk=member.pk)
+        data = model_to_dict(obj, fields=model_admin.get_fields(request, obj))
+        deposit(member, '10.00').complete()
+        data.update(balance_vcoins='0.00', balance_rubles='5.00')
+        form = model_admin.get_form(request, obj, change=True)(data, instance=obj)
+        self.assertTrue(form.is_valid(), form.errors)
+        model_admin.save_model(request, form.save(commit=False), form, change=True)
+        member.refresh_from_db()
+        self.assertEqual(member.balance_rubles, Decimal('15.00'))
+        self.assertEqual(
+            list(member.ledger_entries.values_list('type', 'amount')),
+            [('deposit', Decimal('10.00')), ('adjustment', Decimal('5.00'))]
+        )
+        self.assertIn('0 with drift found', reconcile())
+
+
+class CreditingTests(TestCase):
+    """Per-request and batch admin paths apply the same money rules"""
+
+    def credited(self, member):
+        """Balances, ledger, bonuses and earnings of a member, for comparison"""
+        member.refresh_from_db()
+        return {
+            'balances': (member.balance_vcoins, member.balance_rubles),
+            'ledger': list(member.ledger_entries.values_list('type', 'amount')),
+            'bonuses': list(member.transactions.filter(type='bonus').values_list('status', 'amount')),
+            'earned': list(member.level_rollups.values_list('level', 'earned_vcoins', 'earned_rubles')),
+        }
+
+    def test_deposit_confirmation(self):
+        admin = create_member('admin', is_admin=True)
+        referrers = [register(f'influencer{i}', user_type='influencer') for i in range(2)]
+        deposits = [
+            deposit(register(f'depositor{i}', referrer=referrer), '123.45')
+            for i, referrer in enumerate(referrers)
+        ]
+
+        response = client_for(admin).post(
+            '/api/admin/confirm-deposit',
+            {'transaction_id': deposits[0].id},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        summary = Transaction.confirm_deposits(Transaction.objects.filter(pk=deposits[1].pk))
+        self.assertEqual((summary['deposits'], summary['bonuses'], summary['members']), (1, 1, 1))
+
+        per_request, batch = (self.credited(referrer) for referrer in referrers)
+        self.assertEqual(per_request, batch)
+        # Bonuses are recorded as confirmed but not paid out
+        self.assertEqual(batch['balances'], (Decimal('0'), Decimal('0')))
+        self.assertEqual(len(batch['bonuses']), 2)
+
+        per_request, batch = (self.credited(deposit.member) for deposit in deposits)
+        self.assertEqual(per_request, batch)
+        self.assertEqual(batch['balances'], (Decimal('0'), Decimal('123.45')))
+        self.assertEqual(batch['ledger'], [('deposit', Decimal('123.45'))])
+        self.assertIn('0 with drift found', reconcile())
+
+    def test_manual_bonus(self):
+        admin = create_member('admin', is_admin=True)
+        members = [create_member(f'player{i}') for i in range(2)]
+
+        response = client_for(admin).post(
+            '/api/admin/bonuses',
+            {'user_id': members[0].id, 'amount': '7.50', 'reason': 'Welcome'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        summary = Transaction.grant_bonuses(Member.objects.filter(pk=members[1].pk), Decimal('7.50'), 'Welcome')
+        self.assertEqual((summary['bonuses'], summary['members']), (1, 0))
+
+        per_request, batch = (self.credited(member) for member in members)
+        self.assertEqual(per_request, batch)
+        self.assertEqual(batch['balances'], (Decimal('0'), Decimal('0')))
+        self.assertEqual(batch['bonuses'], [('confirmed', Decimal('7.50'))])
+        self.assertEqual(batch['earned'], [(ReferralLevelRollup.UNATTRIBUTED_LEVEL, Decimal('7.50'), Decimal('0'))])
+
+    def test_tournament_confirmation(self):
+        admin = create_member('admin', is_admin=True)
+        referrer = register('referrer')
+        player = register('player', referrer=referrer)
+
+        response = client_for(admin).post(
+            '/api/admin/confirm-tournament',
+            {'user_id': player.id, 'tournament_name': 'Cup', 'reward_amount': '40.00'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        player.refresh_from_db()
+        self.assertTrue(player.first_tournament_played)
+        self.assertEqual(self.credited(player)['balances'], (Decimal('0'), Decimal('0')))
+        self.assertEqual(
+            self.credited(referrer)['bonuses'],
+            [('confirmed', Decimal('1000.00')), ('confirmed', Decimal('1000.00'))]
+        )
+        self.assertIn('0 with drift found', reconcile())
+
+
+@override_settings(ADMISSION_CONTROL=True)
+class AdmissionTests(TestCase):
+    """Requests take tokens from the buckets of their route class"""
+
+    def setUp(self):
+        # Buckets live in the cache and would outlast the overridden rates
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_route_classes(self):
+        factory = RequestFactory()
+        self.assertEqual(route_class(factory.post('/api/auth/login')), 'auth')
+        self.assertEqual(route_class(factory.post('/api/auth/register')), 'auth')
+        self.assertEqual(route_class(factory.get('/api/auth/me')), 'read')
+        self.assertEqual(route_class(factory.get('/api/referrals')), 'read')
+        self.assertEqual(route_class(factory.post('/api/transactions/deposit')), 'write')
+        self.assertEqual(route_class(factory.get('/api/admin/stats')), 'admin')
+        self.assertIsNone(route_class(factory.get('/api/health/ready')))
+
+    @override_settings(ADMISSION_RATES={'auth': {'global': (0.01, 1)}, 'read': {'ip': (0.01, 2)}})
+    def test_session_reads_use_the_read_buckets(self):
+        client = Client()
+        statuses = [client.get('/api/auth/me').status_code for _ in range(3)]
+        self.assertEqual(statuses, [401, 401, 429])
+        self.assertEqual(client.get('/api/auth/me')['Retry-After'], '100')
+
+        # The exhausted read bucket leaves logins alone, until the auth one is empty
+        login = {'username': 'nobody', 'password': 'password123'}
+        statuses = [
+            client.post('/api/auth/login', login, content_type='application/json').status_code
+            for _ in range(2)
+        ]
+        self.assertEqual(statuses, [401, 503])
+
+    @override_settings(ADMISSION_RATES={'read': {'global': (0.01, 1), 'ip': (0.01, 2)}})
+    def test_refused_requests_take_no_tokens(self):
+        client = Client()
+        statuses = [client.get('/api/auth/me').status_code for _ in range(3)]
+        self.assertEqual(statuses, [401, 503, 503])
+        # The site-wide refusals left the second token of the IP bucket alone
+        with override_settings(ADMISSION_RATES={'read': {'ip': (0.01, 2)}}):
+            statuses = [client.get('/api/auth/me').status_code for _ in range(2)]
+        self.assertEqual(statuses, [401, 429])
+
+    @override_settings(ADMISSION_RATES={'read': {'global': (0.01, 4)}}, ADMISSION_WORKERS=2)
+    def test_site_wide_rates_are_split_between_workers(self):
+        client = Client()
+        statuses = [client.get('/api/auth/me').status_code for _ in range(3)]
+        self.assertEqual(statuses, [401, 401, 503])
+
+    @override_settings(ADMISSION_RATES={}, ADMISSION_MAX_QUEUE_WAIT=5)
+    def test_requests_that_waited_too_long_are_shed(self):
+        response = Client().get('/api/auth/me', HTTP_X_REQUEST_START=f't={time.time() - 30:.3f}')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['error'], 'Service overloaded')
+        response = Client().get('/api/auth/me', HTTP_X_REQUEST_START=f't={time.time():.3f}')
+        self.assertEqual(response.status_code, 401)
+
+
+class ReadinessTests(TestCase):
+    """Readiness details are for admins and local addresses only"""
+
+    PUBLIC_ADDRESS = '203.0.113.7'
+
+    def setUp(self):
+        health._cached['result'] = None
+        self.addCleanup(health._cached.update, result=None)
+
+    def pending_migration(self):
+        return mock.patch.object(
+            health, 'check_migrations',
+            return_value={'ok': False, 'pending': 1, 'migrations': ['api.0099_unreleased']}
+        )
+
+    def test_public_failure_only_names_the_check(self):
+        with self.pending_migration(), self.assertLogs('api.health', 'WARNING') as logs:
+            response = Client(REMOTE_ADDR=self.PUBLIC_ADDRESS).get('/api/health/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['reason'], 'migrations')
+        self.assertNotIn('checks', response.json())
+        self.assertNotIn(b'0099', response.content)
+        self.assertIn('api.0099_unreleased', logs.output[0])
+
+    def test_public_success(self):
+        response = Client(REMOTE_ADDR=self.PUBLIC_ADDRESS).get('/api/health/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'ok')
+        self.assertIsNone(response.json()['reason'])
+        self.assertNotIn('checks', response.json())
+
+    def test_admins_and_local_addresses_get_details(self):
+        admin = create_member('admin', is_admin=True)
+        admin_client = client_for(admin)
+        admin_client.defaults['REMOTE_ADDR'] = self.PUBLIC_ADDRESS
+        with self.pending_migration(), self.assertLogs('api.health', 'WARNING'):
+            for client in (admin_client, Client()):
+                response = client.get('/api/health/ready')
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.json()['checks']['migrations']['migrations'], ['api.0099_unreleased'])
+
+
+class SlowQueryLogTests(TestCase):
+    """The logger's own EXPLAIN is not a statement of the request"""
+
+    def setUp(self):
+        cache.clear()
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        self.log = f'{log_dir.name}/slow.jsonl'
+        if slow_query_logger not in connection.execute_wrappers:
+            connection.execute_wrappers.insert(0, slow_query_logger)
+            self.addCleanup(connection.execute_wrappers.remove, slow_query_logger)
+
+    def test_explain_is_not_counted_by_request_wrappers(self):
+        counter = QueryCounter()
+        with self.settings(SLOW_QUERY_MS=0.000001, SLOW_QUERY_LOG=self.log):
+            with self.assertLogs('api.slow_queries', 'WARNING'), connection.execute_wrapper(counter):
+                Member.objects.filter(username='nobody').exists()
+        self.assertEqual(counter.count, 1)
+
+        with open(self.log) as handle:
+            entry = json.loads(handle.readline())
+        self.assertTrue(entry['plan'])
+        self.assertIn('members', entry['sql'])
+
+    def test_failed_explain_leaves_the_transaction_usable(self):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            self.assertIsNone(explain(connection, 'SELECT * FROM missing_table', None))
+        self.assertEqual(counter.count, 0)
+        self.assertFalse(Member.objects.exists())
+
+
+class ProfilingTests(TestCase):
+    """Only admins can ask for a profile, and old profiles are pruned"""
+
+    def setUp(self):
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        self.directory = Path(profile_dir.name)
+        profiling = self.settings(PROFILING_DIR=profile_dir.name, PROFILING_SAMPLE_RATE=0, PROFILING_MAX_FILES=2)
+        profiling.enable()
+        self.addCleanup(profiling.disable)
+
+    def test_only_admins_are_profiled(self):
+        member = create_member('player')
+        for client in (Client(), client_for(member)):
+            response = client.get('/api/auth/me', HTTP_X_PROFILE='1')
+            self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(list_profiles(self.directory), [])
+
+        admin = create_member('admin', is_admin=True)
+        response = client_for(admin).get('/api/auth/me', {'_profile': '1'})
+        name = response['X-Profile-Id']
+        self.assertEqual(list_profiles(self.directory), [name])
+        meta = load_profile_meta(name, self.directory)
+        self.assertEqual((meta['path'], meta['status'], meta['on_demand']), ('/api/auth/me', 200, True))
+        self.assertTrue(meta['queries'])
+
+    def test_only_the_newest_profiles_are_kept(self):
+        client = client_for(create_member('admin', is_admin=True))
+        names = [client.get('/api/auth/me', HTTP_X_PROFILE='1')['X-Profile-Id'] for _ in range(3)]
+        self.assertEqual(list_profiles(self.directory), names[1:])
+        self.assertEqual(sorted(path.name for path in self.directory.iterdir()), sorted(
+            f'{name}{suffix}' for name in names[1:] for suffix in ('.json', '.prof')
+        ))
+
+
+class MetricsTests(TestCase):
+    """Metrics of all worker processes, for local scrapers and admins"""
+
+    PUBLIC_ADDRESS = '203.0.113.7'
+
+    def setUp(self):
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        self.directory = Path(metrics_dir.name)
+        scrape = self.settings(METRICS_DIR=metrics_dir.name, METRICS_FLUSH_SECONDS=0)
+        scrape.enable()
+        self.addCleanup(scrape.disable)
+        # This process's own counters start empty
+        for values in (metrics._counters, metrics._histograms):
+            patcher = mock.patch.dict(values, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_process(self, pid, worker, value):
+        data = {
+            'worker': worker,
+            'counters': [['registrations_total', {'user_type': 'player'}, value]],
+            'histograms': [['http_request_duration_seconds', {'route': 'me', 'method': 'GET'},
+                            [1] + [0] * (len(metrics.BUCKETS) - 1), 0.004, 1]],
+        }
+        (self.directory / f'{pid}.json').write_text(json.dumps(data))
+
+    def exited_pid(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def test_local_addresses_and_admins_only(self):
+        self.assertEqual(Client().get('/api/metrics').status_code, 200)
+        self.assertEqual(Client(REMOTE_ADDR=self.PUBLIC_ADDRESS).get('/api/metrics').status_code, 401)
+        player = client_for(create_member('player'))
+        self.assertEqual(player.get('/api/metrics', REMOTE_ADDR=self.PUBLIC_ADDRESS).status_code, 403)
+        admin = client_for(create_member('admin', is_admin=True))
+        response = admin.get('/api/metrics', REMOTE_ADDR=self.PUBLIC_ADDRESS)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('# TYPE http_requests_total counter', response.content.decode())
+
+    def test_processes_are_merged_and_exited_ones_archived(self):
+        self.write_process(os.getppid(), True, 2)
+        exited = self.exited_pid()
+        self.write_process(exited, True, 3)
+
+        counters, histograms, workers = metrics.collect()
+        key = metrics._key('registrations_total', {'user_type': 'player'})
+        self.assertEqual((counters[key], workers), (5, 1))
+        latency = histograms[metrics._key('http_request_duration_seconds', {'route': 'me', 'method': 'GET'})]
+        self.assertEqual(latency[2], 2)
+        self.assertFalse((self.directory / f'{exited}.json').exists())
+        self.assertTrue((self.directory / metrics.ARCHIVE).exists())
+
+        # The archive is counted once, and keeps folding in exited processes
+        self.write_process(self.exited_pid(), True, 4)
+        counters, _, workers = metrics.collect()
+        self.assertEqual((counters[key], workers), (9, 1))
+        counters, _, _ = metrics.collect()
+        self.assertEqual(counters[key], 9)
+
+
+class IdempotencyTests(TestCase):
+    """Retries with the same Idempotency-Key replay the first response"""
+
+    def setUp(self):
+        self.member = create_member('payer')
+        self.client = client_for(self.member)
+
+    def post_deposit(self, key, amount='25.00'):
+        return self.client.post(
+            '/api/transactions/deposit',
+            {'amount': amount, 'payment_method': 'card'},
+            content_type='application/json',
+            HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_without_a_second_deposit(self):
+        first = self.post_deposit('deposit-1')
+        self.assertEqual(first.status_code, 201)
+        retry = self.post_deposit('deposit-1')
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(self.member.transactions.count(), 1)
+
+        self.assertEqual(self.post_deposit('deposit-2').status_code, 201)
+        self.assertEqual(self.member.transactions.count(), 2)
+
+    def test_key_reused_for_another_request(self):
+        self.post_deposit('deposit-1')
+        response = self.post_deposit('deposit-1', amount='30.00')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json()['error'], 'Idempotency key reused')
+        self.assertEqual(self.member.transactions.count(), 1)
+
+    def test_expired_key_runs_the_request_again(self):
+        self.post_deposit('deposit-1')
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(days=2))
+        response = self.post_deposit('deposit-1')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(self.member.transactions.count(), 2)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+    def test_keys_are_per_member(self):
+        self.post_deposit('shared')
+        other = create_member('other')
+        response = client_for(other).post(
+            '/api/transactions/deposit',
+            {'amount': '25.00', 'payment_method': 'card'},
+            content_type='application/json',
+            HTTP_IDEMPOTENCY_KEY='shared'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(other.transactions.count(), 1)
+
+
+class OutboxTests(TestCase):
+    """Changes append their events in the same database transaction"""
+
+    def events(self):
+        return list(OutboxEvent.objects.values_list('type', 'member_id'))
+
+    def test_registration_with_referral(self):
+        Level.objects.create(name='silver', required_referrals=1)
+        referrer = register('referrer')
+        OutboxEvent.objects.all().delete()
+
+        member = register('member', referrer=referrer)
+        self.assertEqual(self.events(), [
+            (OutboxEvent.MEMBER_REGISTERED, member.id),
+            (OutboxEvent.TRANSACTION_CONFIRMED, referrer.id),
+            (OutboxEvent.MEMBER_LEVEL_CHANGED, referrer.id),
+        ])
+        confirmed, changed = OutboxEvent.objects.exclude(type=OutboxEvent.MEMBER_REGISTERED)
+        self.assertEqual(confirmed.payload['amount'], '1000.00')
+        self.assertEqual(confirmed.payload['referral_level'], 1)
+        self.assertEqual(changed.payload, {'from': 'none', 'to': 'silver'})
+
+    def test_rolled_back_change_leaves_no_event(self):
+        member = create_member('depositor')
+        pending = deposit(member, '10.00')
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            pending.complete()
+            raise RuntimeError
+        self.assertEqual(self.events(), [])
+
+        deposit(member, '10.00').complete()
+        self.assertEqual(self.events(), [(OutboxEvent.TRANSACTION_CONFIRMED, member.id)])
+
+    def test_batch_paths_append_one_event_per_row(self):
+        members = [create_member(f'player{i}') for i in range(3)]
+        Transaction.grant_bonuses(Member.objects.all(), Decimal('1.00'), 'Launch')
+        self.assertEqual(
+            sorted(self.events()),
+            [(OutboxEvent.TRANSACTION_CONFIRMED, member.id) for member in members]
+        )
+
+    def test_admin_feed_pages_through_every_event(self):
+        admin = create_member('admin', is_admin=True)
+        referrer = register('referrer')
+        for i in range(3):
+            register(f'member{i}', referrer=referrer)
+        expected = list(OutboxEvent.objects.values_list('id', flat=True))
+
+        client = client_for(admin)
+        seen = []
+        after = 0
+        while True:
+            page = client.get('/api/admin/events', {'after': after, 'limit': 2}).json()
+            seen += [event['id'] for event in page['events']]
+            after = page['next_after']
+            if not page['has_more']:
+                break
+        self.assertEqual(seen, expected)
+
+        page = client.get('/api/admin/events', {'type': OutboxEvent.MEMBER_REGISTERED}).json()
+        self.assertEqual(len(page['events']), 4)
+        self.assertEqual(client_for(referrer).get('/api/admin/events').status_code, 403)
+
+
+class StreamWriter:
+    """Collects what the event stream server writes"""
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def messages(self):
+        """(id, event, data) of every SSE message written, comments skipped"""
+        messages = []
+        for block in self.data.split(b'\n\n'):
+            fields = dict(
+                line.split(': ', 1) for line in block.decode().split('\n')
+                if line and not line.startswith(':') and ': ' in line
+            )
+            if 'event' in fields:
+                messages.append((fields.get('id'), fields['event'], json.loads(fields['data'])))
+        return messages
+
+
+async def inline_db(func, *args):
+    """EventStreamServer.db on the test's own connection and transaction"""
+    return func(*args)
+
+
+def run_to_completion(coroutine):
+    """
+    Run a coroutine that never suspends without an event loop, so its
+    database calls stay on the test's connection
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise AssertionError('Coroutine suspended')
+
+
+class EventStreamTests(TestCase):
+    """Event streams replay what a reconnecting member missed"""
+
+    def setUp(self):
+        self.member = create_member('streamer')
+        self.server = EventStreamServer('127.0.0.1', 0, 0)
+        self.server.db = inline_db
+
+    def backlog(self, last_event_id):
+        writer = StreamWriter()
+        self.server.cursor = sse.latest_event_id()
+        run_to_completion(self.server.send_backlog(writer, self.member.id, last_event_id))
+        return writer.messages()
+
+    def test_build_messages(self):
+        bonus = {'type': 'bonus', 'amount': '5.00'}
+        rows = [
+            (1, OutboxEvent.TRANSACTION_CONFIRMED, 7, bonus),
+            (2, OutboxEvent.TRANSACTION_CONFIRMED, 7, {'type': 'deposit', 'amount': '10.00'}),
+            (3, OutboxEvent.MEMBER_LEVEL_CHANGED, 8, {'from': 'none', 'to': 'silver'}),
+            (4, OutboxEvent.MEMBER_REGISTERED, 9, {}),
+        ]
+        balances = {7: {'balance_vcoins': '5.00', 'balance_rubles': '10.00', 'level': 'none'}}
+        messages = sse.build_messages(rows, balances)
+        self.assertEqual(sorted(messages), [7, 8])
+        # Bonuses first, then one balance per member with the newest event id
+        self.assertEqual(messages[7], [
+            sse.format_message('bonus', bonus, 1),
+            sse.format_message('balance', balances[7], 2),
+        ])
+        self.assertEqual(messages[8], [sse.format_message('level', {'level': 'silver', 'previous': 'none'}, 3)])
+
+    def test_session_member(self):
+        store = SessionStore()
+        store['member_id'] = self.member.id
+        store.create()
+        self.assertEqual(sse.session_member(store.session_key), self.member.id)
+        self.assertIsNone(sse.session_member(None))
+        self.assertIsNone(sse.session_member('missing'))
+        self.member.delete()
+        self.assertIsNone(sse.session_member(store.session_key))
+
+    def test_last_event_id_replays_missed_events(self):
+        deposit(self.member, '10.00').complete()
+        seen = sse.latest_event_id()
+        Transaction.objects.create(
+            member=self.member, type='bonus', amount=Decimal('5.00'), currency='rubles', status='confirmed'
+        )
+        latest = sse.latest_event_id()
+
+        messages = self.backlog(str(seen))
+        self.assertEqual([(event_id, event) for event_id, event, _ in messages], [
+            (str(latest), 'bonus'), (str(latest), 'balance')
+        ])
+        self.assertEqual(messages[1][2]['balance_rubles'], '10.00')
+
+        # Up to date (or no Last-Event-ID): only the current balance
+        for last_event_id in (str(latest), None, 'garbage'):
+            self.assertEqual(
+                [(event_id, event) for event_id, event, _ in self.backlog(last_event_id)],
+                [(str(latest), 'balance')]
+            )
+
+    def test_resync_when_too_far_behind(self):
+        for amount in ('1.00', '2.00', '3.00'):
+            deposit(self.member, amount).complete()
+        first = OutboxEvent.objects.order_by('id').first().id
+        latest = sse.latest_event_id()
+        with self.settings(SSE_REPLAY_WINDOW=2):
+            self.assertEqual(
+                [(event_id, event) for event_id, event, _ in self.backlog(str(first))],
+                [(str(latest), 'balance')]
+            )
+        with self.settings(SSE_REPLAY_WINDOW=1):
+            self.assertEqual(
+                [(event_id, event) for event_id, event, _ in self.backlog(str(first))],
+                [(str(latest), 'resync'), (str(latest), 'balance')]
+            )
+
+
+@override_settings(SSE_HEARTBEAT_SECONDS=0.05)
+class EventStreamSessionTests(TransactionTestCase):
+    """Open streams end once their session no longer signs the member in"""
+
+    def test_stream_closes_after_logout(self):
+        member = create_member('streamer')
+        store = SessionStore()
+        store['member_id'] = member.id
+        store.create()
+        server = EventStreamServer('127.0.0.1', 0, 0)
+        writer = StreamWriter()
+
+        async def stream():
+            headers = {'cookie': f'{settings.SESSION_COOKIE_NAME}={store.session_key}'}
+            serving = asyncio.create_task(
+                server.serve(asyncio.StreamReader(), writer, 'GET', sse.STREAM_PATH, headers)
+            )
+            await asyncio.sleep(0.3)
+            # Heartbeats keep a signed in stream open
+            self.assertFalse(serving.done())
+            self.assertEqual(server.stream_count, 1)
+            await server.db(store.flush)
+            await asyncio.wait_for(serving, 1)
+            await server.db(lambda: connection.close())
+
+        asyncio.run(stream())
+        server.executor.shutdown()
+        self.assertEqual((server.stream_count, server.streams), (0, {}))
+        self.assertTrue(writer.data.startswith(sse.STREAM_HEAD))
+        self.assertIn(sse.HEARTBEAT, writer.data)
+
+
+class ConditionalGetTests(TestCase):
+    """Polled endpoints answer 304 until the data they show changes"""
+
+    def setUp(self):
+        cache.clear()
+        self.member = create_member('poller')
+        self.client = client_for(self.member)
+
+    def test_me_is_not_modified_until_the_balance_changes(self):
+        first = self.client.get('/api/auth/me')
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('private', first['Cache-Control'])
+        self.assertIn('no-cache', first['Cache-Control'])
+        self.assertTrue(first['Last-Modified'])
+
+        with self.assertNumQueries(2):
+            # Session and member only, the view doesn't run
+            again = self.client.get('/api/auth/me', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+        deposit(self.member, '5.00', currency='vcoins').complete()
+        changed = self.client.get('/api/auth/me', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+        self.assertEqual(changed.json()['balance'], 5.0)
+
+    def test_levels_change_with_the_level_table(self):
+        first = self.client.get('/api/levels')
+        self.assertEqual(
+            self.client.get('/api/levels', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304
+        )
+        Level.objects.create(name='gold', required_referrals=5)
+        self.assertEqual(
+            self.client.get('/api/levels', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200
+        )
+
+    def test_validated_responses_vary_by_format_and_session(self):
+        first = self.client.get('/api/auth/me')
+        again = self.client.get('/api/auth/me', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        for response in (first, again):
+            vary = [header.strip() for header in response['Vary'].split(',')]
+            self.assertEqual(sorted(set(vary) & {'Accept', 'Cookie'}), ['Accept', 'Cookie'])
+            self.assertEqual(len(vary), len(set(vary)))
+
+    def test_query_strings_get_their_own_etag(self):
+        plain = self.client.get('/api/referrals/stats')
+        filtered = self.client.get('/api/referrals/stats?format=json')
+        self.assertNotEqual(plain['ETag'], filtered['ETag'])
+
+    def test_anonymous_requests_are_not_tagged(self):
+        response = Client().get('/api/auth/me')
+        self.assertEqual(response.status_code, 401)
+        self.assertNotIn('ETag', response)
+
+
+class ResponseCacheTests(TestCase):
+    """Cached responses are keyed by data versions, so writes invalidate them"""
+
+    def setUp(self):
+        cache.clear()
+        self.referrer = register('referrer')
+        self.client = client_for(self.referrer)
+
+    def test_stats_are_served_from_the_cache_until_a_referral_joins(self):
+        self.assertEqual(self.client.get('/api/referrals/stats').json()['total_referrals'], 0)
+        with self.assertNumQueries(2):
+            # Session and member only, no rollup query
+            self.assertEqual(self.client.get('/api/referrals/stats').json()['total_referrals'], 0)
+
+        child = register('child', referrer=self.referrer)
+        register('grandchild', referrer=child)
+        stats = self.client.get('/api/referrals/stats').json()
+        self.assertEqual((stats['total_referrals'], stats['direct_referrals']), (2, 1))
+        self.assertEqual([row['level'] for row in stats['level_breakdown']], [1, 2])
+
+    def test_current_level_follows_level_table_changes(self):
+        register('child', referrer=self.referrer)
+        self.assertIsNone(self.client.get('/api/levels/current').json()['points_for_next_level'])
+        # Only the level table changes, the member's version stays the same
+        silver = Level.objects.create(name='silver', required_referrals=2)
+        self.assertEqual(self.client.get('/api/levels/current').json()['points_for_next_level'], 2)
+
+        silver.required_referrals = 1
+        silver.save()
+        Level.recompute_member_levels()
+        self.assertEqual(self.client.get('/api/levels/current').json()['level_name'], 'Silver')
+
+    def test_entries_are_per_member(self):
+        other = register('other', referrer=self.referrer)
+        self.assertEqual(self.client.get('/api/referrals/stats').json()['total_referrals'], 1)
+        self.assertEqual(client_for(other).get('/api/referrals/stats').json()['total_referrals'], 0)
+
+
+class ReferralRollupTests(TestCase):
+    """Rollups maintained on writes match a recomputation from source rows"""
+
+    def verify(self, *args):
+        out = StringIO()
+        call_command('verify_referral_rollups', *args, stdout=out)
+        return out.getvalue()
+
+    def test_maintained_rollups_match_source_rows(self):
+        root = register('root', user_type='influencer')
+        child = register('child', referrer=root)
+        grandchild = register('grandchild', referrer=child)
+        deposit(grandchild, '50.00').complete()
+        Transaction.grant_bonuses(Member.objects.filter(pk=root.pk), Decimal('3.00'), 'Thanks')
+
+        rollups = {
+            rollup.level: (rollup.member_count, rollup.earned_rubles)
+            for rollup in ReferralLevelRollup.objects.filter(referrer=root)
+        }
+        self.assertEqual(rollups, {
+            ReferralLevelRollup.UNATTRIBUTED_LEVEL: (0, Decimal('3.00')),
+            1: (1, Decimal('500.00')),
+            2: (1, Decimal('75.00')),
+        })
+        self.assertIn('3 members checked, 0 with drift found', self.verify())
+
+    def test_drift_is_reported_and_fixed(self):
+        root = register('root')
+        register('child', referrer=root)
+        ReferralLevelRollup.objects.filter(referrer=root, level=1).update(member_count=5)
+
+        self.assertIn(f'referrer {root.id} level 1: stored (5,', self.verify())
+        self.assertIn('1 with drift fixed', self.verify('--fix'))
+        self.assertEqual(ReferralLevelRollup.objects.get(referrer=root, level=1).member_count, 1)
+        self.assertIn('0 with drift found', self.verify())
+
+
+class DateProbeTests(TestCase):
+    """The admin date hierarchy probes periods instead of truncating rows"""
+
+    @classmethod
+    def setUpTestData(cls):
+        member = create_member('dated')
+        stamps = [
+            datetime(2024, 12, 31, 23, 30), datetime(2025, 1, 1, 0, 15), datetime(2025, 1, 1, 8),
+            datetime(2025, 3, 15, 12), datetime(2026, 7, 4, 9),
+        ]
+        for stamp in stamps:
+            row = deposit(member, '1.00')
+            Transaction.objects.filter(pk=row.pk).update(created_at=timezone.make_aware(stamp))
+
+    def probe(self, queryset):
+        return DateProbeQuerySet(model=Transaction, query=queryset.query, using=queryset.db)
+
+    def test_periods_match_truncation(self):
+        # 2024-12-31 23:30 UTC is already 2025 in Moscow
+        for zone in ('UTC', 'Europe/Moscow'):
+            with timezone.override(zone):
+                for queryset in (
+                    Transaction.objects.all(),
+                    Transaction.objects.filter(created_at__year=2025),
+                    Transaction.objects.filter(created_at__year=2025, created_at__month=1),
+                ):
+                    for kind in ('year', 'month', 'day'):
+                        with self.subTest(zone=zone, query=str(queryset.query), kind=kind):
+                            expected = list(queryset.datetimes('created_at', kind))
+                            self.assertEqual(self.probe(queryset).datetimes('created_at', kind), expected)
+                            self.assertEqual(self.probe(queryset).datetimes('created_at', kind, 'DESC'), expected[::-1])
+
+    def test_one_exists_query_per_period(self):
+        queryset = self.probe(Transaction.objects.all())
+        with CaptureQueriesContext(connection) as queries:
+            months = queryset.datetimes('created_at', 'month')
+        self.assertEqual(len(months), 4)
+        # Separate MIN and MAX, then every month from Dec 2024 to Jul 2026
+        self.assertEqual(len(queries.captured_queries), 2 + 20)
+
+    def test_empty_table(self):
+        self.assertEqual(self.probe(Transaction.objects.none()).datetimes('created_at', 'year'), [])
+
+
+class AdminPaginationTests(TestCase):
+    """Admin change lists count exactly up to a cap, then estimate"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.members = [create_member(name) for name in ('alice', 'alicia', 'bob', 'malice', 'carol')]
+
+    def count(self, queryset, max_count=3):
+        with mock.patch.object(EstimatedCountPaginator, 'max_count', max_count):
+            return EstimatedCountPaginator(queryset.order_by('pk'), 2).count
+
+    def test_exact_below_the_cap(self):
+        self.assertEqual(self.count(Member.objects.filter(username__startswith='ali')), 2)
+        self.assertEqual(self.count(Member.objects.all(), max_count=10), 5)
+
+    def test_estimated_above_the_cap(self):
+        # Unfiltered tables are estimated from the highest pk, even with gaps
+        Member.objects.filter(username='bob').delete()
+        highest = Member.objects.aggregate(highest=models.Max('pk'))['highest']
+        self.assertEqual(self.count(Member.objects.all()), highest)
+        # Filtered querysets have no estimate on SQLite and report the cap
+        self.assertEqual(self.count(Member.objects.exclude(username='carol')), 3)
+
+    def test_member_search_by_username_or_referral_code(self):
+        model_admin = site._registry[Member]
+        request = RequestFactory().get('/admin/api/member/')
+
+        def search(term):
+            queryset, may_have_duplicates = model_admin.get_search_results(request, Member.objects.all(), term)
+            self.assertFalse(may_have_duplicates)
+            return [member.username for member in queryset]
+
+        self.assertEqual(search('alic'), ['alice', 'alicia', 'malice'])
+        code = self.members[2].referral_code
+        self.assertEqual(search(f' {code.lower()} '), ['bob'])
+
+
+class ReferralSearchTests(TestCase):
+    """Network search ranks prefix matches first and caps its count"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = register('root')
+        child = register('kid_one', referrer=cls.root)
+        for username in ('kid_two', 'big_kid', 'kid_three'):
+            register(username, referrer=child)
+        register('kid_outsider')
+
+    def search(self, q, **params):
+        response = client_for(self.root).get('/api/referrals/search', dict(params, q=q))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_matches_within_the_network_prefix_first(self):
+        for q in ('kid', 'KI'):
+            page = self.search(q)
+            self.assertEqual(
+                [row['username'] for row in page['results']],
+                ['kid_one', 'kid_three', 'kid_two', 'big_kid']
+            )
+        self.assertEqual(self.search('three')['results'][0]['level'], 2)
+
+    def test_count_is_capped(self):
+        with mock.patch.object(CappedCountPagination, 'max_count', 3):
+            page = self.search('kid', page_size=2)
+        self.assertEqual(page['count'], 3)
+        self.assertIsNotNone(page['next'])
+        self.assertEqual(len(page['results']), 2)
+
+    def test_capped_count_skips_the_ordering(self):
+        paginator = CappedCountPaginator(Member.objects.order_by('username'), 10)
+        paginator.max_count = 2
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(paginator.count, 2)
+        self.assertNotIn('ORDER BY', queries.captured_queries[0]['sql'])
+        self.assertIn('LIMIT 2', queries.captured_queries[0]['sql'])
@@ -10,16 +10,25 @@ from .views import (
     ReferralsListView,
     ReferralStatsView,
     ReferralTreeView,
+    ReferralTreeChildrenView,
+    ReferralUplineView,
+    ReferralSearchView,
     TransactionsListView,
     DepositView,
     BonusesListView,
     CurrentLevelView,
     LevelsListView,
     AdminUsersListView,
+    AdminUserUplineView,
+    AdminUserBalanceView,
     AdminBonusView,
     ConfirmTournamentView,
     ConfirmDepositView,
-    AdminStatsView
+    AdminStatsView,
+    AdminEventsView,
+    MetricsView,
+    HealthLiveView,
+    HealthReadyView
 )
 
 urlpatterns = [
@@ -39,6 +48,9 @@ urlpatterns = [
     path("referrals", ReferralsListView.as_view(), name="referrals-list"),
     path("referrals/stats", ReferralStatsView.as_view(), name="referral-stats"),
     path("referrals/tree", ReferralTreeView.as_view(), name="referral-tree"),
+    path("referrals/tree/children", ReferralTreeChildrenView.as_view(), name="referral-tree-children"),
+    path("referrals/upline", ReferralUplineView.as_view(), name="referral-upline"),
+    path("referrals/search", ReferralSearchView.as_view(), name="referral-search"),
     
     # Transaction endpoints
     path("transactions", TransactionsListView.as_view(), name="transactions-list"),
@@ -51,8 +63,16 @@ urlpatterns = [
     
     # Admin endpoints
     path("admin/users", AdminUsersListView.as_view(), name="admin-users"),
+    path("admin/users/<int:user_id>/upline", AdminUserUplineView.as_view(), name="admin-user-upline"),
+    path("admin/users/<int:user_id>/balance", AdminUserBalanceView.as_view(), name="admin-user-balance"),
     path("admin/bonuses", AdminBonusView.as_view(), name="admin-bonus"),
     path("admin/confirm-tournament", ConfirmTournamentView.as_view(), name="admin-confirm-tournament"),
     path("admin/confirm-deposit", ConfirmDepositView.as_view(), name="admin-confirm-deposit"),
     path("admin/stats", AdminStatsView.as_view(), name="admin-stats"),
+    path("admin/events", AdminEventsView.as_view(), name="admin-events"),
+
+    # Operations
+    path("metrics", MetricsView.as_view(), name="metrics"),
+    path("health/live", HealthLiveView.as_view(), name="health-live"),
+    path("health/ready", HealthReadyView.as_view(), name="health-ready"),
 ]
@@ -2,10 +2,14 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.settings import api_settings
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.conf import settings
-from django.db.models import Q
-from drf_spectacular.utils import extend_schema
+from django.db.models import Count, Min, OuterRef, Subquery
+from django.http import StreamingHttpResponse
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema
 from datetime import timedelta
 from .serializers import (
     MessageSerializer,
@@ -16,16 +20,37 @@ from .serializers import (
     ReferralRelationSerializer,
     ReferralStatsSerializer,
     ReferralTreeNodeSerializer,
+    ReferralTreeChildSerializer,
+    ReferralTreeChildrenSerializer,
+    ReferralUplineSerializer,
+    ReferralSearchResultSerializer,
     TransactionSerializer,
     BonusSerializer,
     LevelSerializer,
     ManualBonusRequestSerializer,
     ConfirmTournamentRequestSerializer,
     ConfirmDepositRequestSerializer,
-    SystemStatsSerializer
+    SystemStatsSerializer,
+    OutboxEventPageSerializer,
+    LedgerBalanceSerializer,
+    HealthSerializer
 )
-from .models import Member, ReferralRelation, Transaction, Level
+from .models import Member, ReferralRelation, ReferralLevelRollup, Transaction, Level, OutboxEvent, LedgerEntry
 from .authentication import CookieAuthentication
+from .graph import get_referral_graph
+from .renderers import NDJSONRenderer, PrometheusTextRenderer, encode_ndjson_line
+from .search import search_username
+from .admission import client_ip
+from .idempotency import HEADER as IDEMPOTENCY_HEADER, idempotent
+from . import health, metrics
+from .pagination import CappedCountPagination, EstimatedCountPaginator
+from .caching import (
+    cached_response,
+    conditional_get,
+    member_validators,
+    level_validators,
+    member_level_validators
+)
 from decimal import Decimal
 import uuid
 
@@ -40,6 +65,15 @@ class AdminResultsSetPagination(PageNumberPagination):
     page_size = 20
     page_size_query_param = 'page_size'
     max_page_size = 100
+    django_paginator_class = EstimatedCountPaginator
+
+
+IDEMPOTENCY_KEY_PARAMETER = OpenApiParameter(
+    IDEMPOTENCY_HEADER,
+    str,
+    OpenApiParameter.HEADER,
+    description='Unique key per operation; retries with the same key replay the original response'
+)
 
 
 def check_admin_permission(request):
@@ -95,6 +129,7 @@ class RegisterView(APIView):
         
         if serializer.is_valid():
             member = serializer.save()
+            metrics.inc('registrations_total', user_type=member.user_type)
             
             # Create session and set cookie
             request.session['member_id'] = member.id
@@ -217,6 +252,7 @@ class MeView(APIView):
     @extend_schema(
         responses={200: MemberSerializer}
     )
+    @conditional_get(member_validators)
     def get(self, request):
         if not request.user or request.user.is_anonymous:
             return Response(
@@ -289,7 +325,12 @@ class ProfileView(APIView):
                 )
             
             member.username = username
-            member.save()
+            member.save(update_fields=['username'])
+            
+            # Username is shown in the referral trees of the whole upline
+            Member.bump_versions(
+                ReferralRelation.objects.filter(referred=member).values_list('referrer_id', flat=True)
+            )
         
         serializer = MemberSerializer(member)
         return Response(
@@ -384,6 +425,8 @@ class ReferralStatsView(APIView):
     @extend_schema(
         responses={200: ReferralStatsSerializer}
     )
+    @conditional_get(member_validators)
+    @cached_response('referral-stats', member_validators)
     def get(self, request):
         if not request.user or request.user.is_anonymous:
             return Response(
@@ -396,43 +439,23 @@ class ReferralStatsView(APIView):
         
         member = request.user
         
-        # Count total and direct referrals
-        total_referrals = ReferralRelation.objects.filter(referrer=member).count()
-        direct_referrals = ReferralRelation.objects.filter(referrer=member, level=1).count()
-        
-        # Calculate total earned from bonuses
-        bonus_transactions = Transaction.objects.filter(
-            member=member,
-            type='bonus',
-            status='confirmed'
-        )
-        total_earned = sum(t.amount for t in bonus_transactions)
+        # Per-level counts and earnings are maintained in the rollup table:
+        # at most one row per level plus the unattributed bucket
+        rollups = list(ReferralLevelRollup.objects.filter(referrer=member))
+        by_level = {rollup.level: rollup for rollup in rollups}
+        total_referrals = sum(rollup.member_count for rollup in rollups)
+        direct_referrals = by_level[1].member_count if 1 in by_level else 0
+        total_earned = sum((rollup.earned for rollup in rollups), Decimal('0'))
         
         # Level breakdown
         level_breakdown = []
         for level in range(1, 11):
-            level_relations = ReferralRelation.objects.filter(
-                referrer=member,
-                level=level
-            )
-            count = level_relations.count()
-            
-            if count > 0:
-                # Calculate earned at this level
-                level_earned = Decimal('0')
-                for relation in level_relations:
-                    level_transactions = Transaction.objects.filter(
-                        member=member,
-                        type='bonus',
-                        status='confirmed',
-                        related_member=relation.referred
-                    )
-                    level_earned += sum(t.amount for t in level_transactions)
-                
+            rollup = by_level.get(level)
+            if rollup and rollup.member_count > 0:
                 level_breakdown.append({
                     'level': level,
-                    'count': count,
-                    'earned': float(level_earned)
+                    'count': rollup.member_count,
+                    'earned': float(rollup.earned)
                 })
         
         data = {
@@ -448,41 +471,91 @@ class ReferralStatsView(APIView):
 
 class ReferralTreeView(APIView):
     """
-    Get hierarchical referral tree up to 10 levels
+    Get hierarchical referral tree up to 10 levels, or stream it as flat
+    NDJSON records with ?format=ndjson
     """
     authentication_classes = [CookieAuthentication]
-
-    def build_tree(self, referrer, current_level=1, max_depth=10):
-        """Recursively build referral tree"""
-        if current_level > max_depth:
-            return []
-        
-        direct_referrals = ReferralRelation.objects.filter(
-            referrer=referrer,
-            level=1
-        ).select_related('referred').order_by('-created_at')
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+    stream_chunk_size = 2000
+
+    def build_tree(self, referrer, max_depth=10):
+        """Build the nested referral tree from the in-memory referral graph"""
+        # Brought up to date first: the response's ETag is the member's data
+        # version, which already counts referrals the graph may not have yet
+        graph = get_referral_graph(current=True)
+        nodes = list(graph.descendants(referrer.id, max_depth))
+        members = Member.objects.only(
+            'id',
+            'username',
+            'user_type',
+            'created_at'
+        ).in_bulk([node_id for node_id, _, _ in nodes])
         
         tree = []
-        for relation in direct_referrals:
+        by_id = {referrer.id: {'children': tree}}
+        # Breadth first order, so every parent is placed before its children
+        for node_id, parent_id, depth in nodes:
+            member = members.get(node_id)
+            parent = by_id.get(parent_id)
+            if member is None or parent is None:
+                # Deleted since the graph was last rebuilt
+                continue
             node = {
-                'id': relation.referred.id,
-                'username': relation.referred.username,
-                'user_type': relation.referred.user_type,
-                'level': current_level,
-                'created_at': relation.created_at,
-                'children': self.build_tree(
-                    relation.referred,
-                    current_level + 1,
-                    max_depth
-                )
+                'id': member.id,
+                'username': member.username,
+                'user_type': member.user_type,
+                'level': depth,
+                'created_at': member.created_at,
+                'children': []
             }
-            tree.append(node)
+            parent['children'].append(node)
+            by_id[node_id] = node
+        
+        # Newest referrals first
+        for node in by_id.values():
+            node['children'].reverse()
         
         return tree
 
+    def stream_nodes(self, member, max_depth):
+        """Yield the downline as flat NDJSON lines, parents before children"""
+        # Direct referrer of each node, served by the level-1 partial index
+        parent_id = Subquery(
+            ReferralRelation.objects.filter(
+                referred=OuterRef('referred'),
+                level=1
+            ).order_by().values('referrer')[:1]
+        )
+        rows = ReferralRelation.objects.filter(
+            referrer=member,
+            level__lte=max_depth
+        ).annotate(parent_id=parent_id).order_by('level', 'id').values_list(
+            'referred_id',
+            'parent_id',
+            'level',
+            'referred__username',
+            'referred__user_type',
+            'created_at'
+        )
+        
+        for node_id, parent_id, depth, username, user_type, created_at in rows.iterator(
+            chunk_size=self.stream_chunk_size
+        ):
+            yield encode_ndjson_line({
+                'id': node_id,
+                'parent_id': parent_id,
+                'depth': depth,
+                'username': username,
+                'user_type': user_type,
+                'created_at': created_at
+            })
+
     @extend_schema(
         responses={200: ReferralTreeNodeSerializer(many=True)}
     )
+    # Not in the response cache: deleted relations only leave the graph on
+    # its next full rebuild, so a tree must not outlive the request
+    @conditional_get(member_validators)
     def get(self, request):
         if not request.user or request.user.is_anonymous:
             return Response(
@@ -499,12 +572,215 @@ class ReferralTreeView(APIView):
         if max_depth > 10:
             max_depth = 10
         
+        if request.accepted_renderer.format == NDJSONRenderer.format:
+            response = StreamingHttpResponse(
+                self.stream_nodes(request.user, max_depth),
+                content_type=NDJSONRenderer.media_type
+            )
+            # Let nginx pass lines through as they are produced
+            response['X-Accel-Buffering'] = 'no'
+            return response
+        
         tree = self.build_tree(request.user, max_depth=max_depth)
         
         serializer = ReferralTreeNodeSerializer(tree, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+class ReferralTreeChildrenView(APIView):
+    """
+    Get one page of direct children of a node in the user's referral tree
+    """
+    authentication_classes = [CookieAuthentication]
+    default_limit = 50
+    max_limit = 200
+    max_depth = 10
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('node_id', int, description='Node to expand, defaults to the current user'),
+            OpenApiParameter('cursor', int, description='next_cursor of the previous page'),
+            OpenApiParameter('limit', int, description='Page size (max 200)'),
+        ],
+        responses={200: ReferralTreeChildrenSerializer}
+    )
+    def get(self, request):
+        if not request.user or request.user.is_anonymous:
+            return Response(
+                {
+                    'error': 'Authentication required',
+                    'detail': 'User is not authenticated'
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        member = request.user
+        try:
+            node_id = int(request.GET.get('node_id', member.id))
+            cursor = request.GET.get('cursor')
+            cursor = int(cursor) if cursor else None
+            limit = int(request.GET.get('limit', self.default_limit))
+        except ValueError:
+            return Response(
+                {
+                    'error': 'Validation error',
+                    'detail': 'node_id, cursor and limit must be integers'
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = max(1, min(limit, self.max_limit))
+        
+        # The node must be the user or part of the user's downline
+        if node_id == member.id:
+            node_level = 0
+        else:
+            node_level = ReferralRelation.objects.filter(
+                referrer=member,
+                referred_id=node_id
+            ).values_list('level', flat=True).first()
+            if node_level is None:
+                return Response(
+                    {
+                        'error': 'Not found',
+                        'detail': f'Member {node_id} is not in your referral tree'
+                    },
+                    status=status.HTTP_404_NOT_FOUND
+                )
+        
+        children = []
+        next_cursor = None
+        if node_level < self.max_depth:
+            # Keyset page over the (referrer, level) index, newest first
+            queryset = ReferralRelation.objects.filter(
+                referrer_id=node_id,
+                level=1
+            ).select_related('referred').only(
+                'id',
+                'created_at',
+                'referred__id',
+                'referred__username',
+                'referred__user_type',
+                'referred__direct_referral_count',
+                'referred__downline_count'
+            ).order_by('-id')
+            if cursor:
+                queryset = queryset.filter(id__lt=cursor)
+            
+            children = list(queryset[:limit + 1])
+            if len(children) > limit:
+                children = children[:limit]
+                next_cursor = children[-1].id
+        
+        serializer = ReferralTreeChildSerializer(
+            children,
+            many=True,
+            context={'parent_level': node_level}
+        )
+        return Response(
+            {
+                'node_id': node_id,
+                'results': serializer.data,
+                'next_cursor': next_cursor
+            },
+            status=status.HTTP_200_OK
+        )
+
+
+class ReferralSearchView(APIView):
+    """
+    Search usernames within the user's referral network (all 10 levels)
+    """
+    authentication_classes = [CookieAuthentication]
+    pagination_class = CappedCountPagination
+    max_query_length = 150
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('q', str, required=True, description='Username prefix or substring'),
+        ],
+        responses={200: ReferralSearchResultSerializer(many=True)}
+    )
+    def get(self, request):
+        if not request.user or request.user.is_anonymous:
+            return Response(
+                {
+                    'error': 'Authentication required',
+                    'detail': 'User is not authenticated'
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        query = request.GET.get('q', '').strip()
+        if not query or len(query) > self.max_query_length:
+            return Response(
+                {
+                    'error': 'Validation error',
+                    'detail': f'q must be 1 to {self.max_query_length} characters'
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Only members below the user in the closure table can match
+        relations = ReferralRelation.objects.filter(
+            referrer=request.user
+        ).select_related('referred').only(
+            'level',
+            'created_at',
+            'referred__id',
+            'referred__username',
+            'referred__user_type'
+        )
+        results = search_username(relations, query, member_path='referred__')
+        
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(results, request)
+        
+        serializer = ReferralSearchResultSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+def get_upline(member_id):
+    """Ancestors of a member, nearest first, with one query on the referred index"""
+    return list(
+        ReferralRelation.objects.filter(referred_id=member_id)
+        .select_related('referrer')
+        .only(
+            'level',
+            'created_at',
+            'referrer__id',
+            'referrer__username',
+            'referrer__user_type'
+        )
+        .order_by('level')
+    )
+
+
+class ReferralUplineView(APIView):
+    """
+    Get the chain of members who referred the user, up to 10 levels
+    """
+    authentication_classes = [CookieAuthentication]
+
+    @extend_schema(
+        responses={200: ReferralUplineSerializer}
+    )
+    def get(self, request):
+        if not request.user or request.user.is_anonymous:
+            return Response(
+                {
+                    'error': 'Authentication required',
+                    'detail': 'User is not authenticated'
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        serializer = ReferralUplineSerializer({
+            'member_id': request.user.id,
+            'upline': get_upline(request.user.id)
+        })
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
 class TransactionsListView(APIView):
     """
     Get paginated transaction history
@@ -560,8 +836,10 @@ class DepositView(APIView):
                 'required': ['amount', 'payment_method']
             }
         },
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={201: TransactionSerializer}
     )
+    @idempotent
     def post(self, request):
         if not request.user or request.user.is_anonymous:
             return Response(
@@ -667,6 +945,8 @@ class CurrentLevelView(APIView):
             }
         }
     )
+    @conditional_get(member_level_validators)
+    @cached_response('current-level', member_level_validators)
     def get(self, request):
         if not request.user or request.user.is_anonymous:
             return Response(
@@ -679,11 +959,10 @@ class CurrentLevelView(APIView):
         
         member = request.user
         
-        # Count direct referrals (points)
-        current_points = ReferralRelation.objects.filter(
-            referrer=member,
-            level=1
-        ).count()
+        # Direct referrals (points)
+        current_points = member.direct_referral_count
+        all_levels = list(Level.objects.all().order_by('required_referrals'))
+        levels_by_name = {lvl.name: lvl for lvl in all_levels}
         
         # Get current level info
         levels_map = {'none': 0, 'silver': 1, 'gold': 2, 'platinum': 3}
@@ -693,8 +972,8 @@ class CurrentLevelView(APIView):
         # Get benefits for current level
         benefits = []
         if member.level != 'none':
-            try:
-                level_obj = Level.objects.get(name=member.level)
+            level_obj = levels_by_name.get(member.level)
+            if level_obj:
                 multiplier = float(level_obj.bonus_multiplier)
                 bonus_percent = int((multiplier - 1) * 100)
                 
@@ -705,11 +984,8 @@ class CurrentLevelView(APIView):
                 if member.level == 'platinum':
                     benefits.append("VIP support")
                     benefits.append("Exclusive rewards")
-            except Level.DoesNotExist:
-                pass
         
         # Find next level
-        all_levels = Level.objects.all().order_by('required_referrals')
         next_level = None
         for lvl in all_levels:
             if lvl.required_referrals > current_points:
@@ -719,12 +995,12 @@ class CurrentLevelView(APIView):
         if next_level:
             points_for_next_level = next_level.required_referrals
             # Calculate progress from current level to next
-            try:
-                current_level_obj = Level.objects.get(name=member.level)
+            current_level_obj = levels_by_name.get(member.level)
+            if current_level_obj:
                 points_from_current = current_points - current_level_obj.required_referrals
                 points_needed = points_for_next_level - current_level_obj.required_referrals
                 progress_percentage = (points_from_current / points_needed * 100) if points_needed > 0 else 0
-            except Level.DoesNotExist:
+            else:
                 progress_percentage = (current_points / points_for_next_level * 100) if points_for_next_level > 0 else 0
         else:
             points_for_next_level = None
@@ -752,6 +1028,7 @@ class LevelsListView(APIView):
     @extend_schema(
         responses={200: LevelSerializer(many=True)}
     )
+    @conditional_get(level_validators)
     def get(self, request):
         if not request.user or request.user.is_anonymous:
             return Response(
@@ -792,10 +1069,10 @@ class AdminUsersListView(APIView):
         if user_type and user_type in ['player', 'influencer']:
             members = members.filter(user_type=user_type)
         
-        # Search by username if provided
-        search = request.GET.get('search')
+        # Search by username if provided, prefix matches first
+        search = request.GET.get('search', '').strip()
         if search:
-            members = members.filter(username__icontains=search)
+            members = search_username(members, search)
         
         # Paginate results
         paginator = self.pagination_class()
@@ -805,6 +1082,93 @@ class AdminUsersListView(APIView):
         return paginator.get_paginated_response(serializer.data)
 
 
+class AdminUserUplineView(APIView):
+    """
+    Get the referral chain above a user (Admin only)
+    """
+    authentication_classes = [CookieAuthentication]
+
+    @extend_schema(
+        responses={200: ReferralUplineSerializer}
+    )
+    def get(self, request, user_id):
+        is_admin, error_response = check_admin_permission(request)
+        if not is_admin:
+            return error_response
+        
+        upline = get_upline(user_id)
+        # Only members without a referrer need the existence check
+        if not upline and not Member.objects.filter(id=user_id).exists():
+            return Response(
+                {
+                    'error': 'Not found',
+                    'detail': f'User with id {user_id} not found'
+                },
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        serializer = ReferralUplineSerializer({
+            'member_id': user_id,
+            'upline': upline
+        })
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class AdminUserBalanceView(APIView):
+    """
+    Get a user's balances from the ledger, now or at a past time (Admin only)
+    """
+    authentication_classes = [CookieAuthentication]
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('at', OpenApiTypes.DATETIME, description='ISO 8601 time, defaults to now'),
+        ],
+        responses={200: LedgerBalanceSerializer}
+    )
+    def get(self, request, user_id):
+        is_admin, error_response = check_admin_permission(request)
+        if not is_admin:
+            return error_response
+        
+        at = request.GET.get('at')
+        if at:
+            try:
+                at = parse_datetime(at)
+            except ValueError:
+                at = None
+            if at is None:
+                return Response(
+                    {
+                        'error': 'Validation error',
+                        'detail': 'at must be an ISO 8601 date and time'
+                    },
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+        else:
+            at = None
+        
+        if not Member.objects.filter(id=user_id).exists():
+            return Response(
+                {
+                    'error': 'Not found',
+                    'detail': f'User with id {user_id} not found'
+                },
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        # Each balance reads one snapshot and the entries after it
+        serializer = LedgerBalanceSerializer({
+            'member_id': user_id,
+            'at': at,
+            'balance_vcoins': LedgerEntry.balance(user_id, 'vcoins', at=at),
+            'balance_rubles': LedgerEntry.balance(user_id, 'rubles', at=at)
+        })
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
 class AdminBonusView(APIView):
     """
     Manual bonus assignment (Admin only)
@@ -813,8 +1177,10 @@ class AdminBonusView(APIView):
 
     @extend_schema(
         request=ManualBonusRequestSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={201: BonusSerializer}
     )
+    @idempotent
     def post(self, request):
         is_admin, error_response = check_admin_permission(request)
         if not is_admin:
@@ -879,8 +1245,10 @@ class ConfirmTournamentView(APIView):
 
     @extend_schema(
         request=ConfirmTournamentRequestSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={201: TransactionSerializer}
     )
+    @idempotent
     def post(self, request):
         is_admin, error_response = check_admin_permission(request)
         if not is_admin:
@@ -930,7 +1298,7 @@ class ConfirmTournamentView(APIView):
         # If this is the first tournament, trigger referral bonuses
         if not member.first_tournament_played:
             member.first_tournament_played = True
-            member.save()
+            member.save(update_fields=['first_tournament_played'])
             
             # Award bonuses to referral chain (up to 10 levels)
             relations = ReferralRelation.objects.filter(
@@ -952,7 +1320,8 @@ class ConfirmTournamentView(APIView):
                     currency=referrer_currency,
                     status='confirmed',
                     description=f"First tournament bonus from {member.username} (Level {relation.level})",
-                    related_member=member
+                    related_member=member,
+                    referral_level=relation.level
                 )
                 bonus_transaction.complete()
         
@@ -974,8 +1343,10 @@ class ConfirmDepositView(APIView):
 
     @extend_schema(
         request=ConfirmDepositRequestSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={200: TransactionSerializer}
     )
+    @idempotent
     def post(self, request):
         is_admin, error_response = check_admin_permission(request)
         if not is_admin:
@@ -1037,7 +1408,7 @@ class ConfirmDepositView(APIView):
         
         if direct_referrer_relation and direct_referrer_relation.referrer.user_type == 'influencer':
             # Award 10% of deposit to direct referrer
-            bonus_amount = transaction.amount * Decimal('0.10')
+            bonus_amount = transaction.amount * Transaction.DEPOSIT_BONUS_RATE
             
             bonus_transaction = Transaction.objects.create(
                 member=direct_referrer_relation.referrer,
@@ -1046,7 +1417,8 @@ class ConfirmDepositView(APIView):
                 currency='rubles',
                 status='confirmed',
                 description=f"10% deposit bonus from {member.username}",
-                related_member=member
+                related_member=member,
+                referral_level=1
             )
             bonus_transaction.complete()
         
@@ -1121,3 +1493,159 @@ class AdminStatsView(APIView):
         
         serializer = SystemStatsSerializer(data)
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class AdminEventsView(APIView):
+    """
+    Outbox events after a cursor, oldest first (Admin only)
+    """
+    authentication_classes = [CookieAuthentication]
+    default_limit = 1000
+    max_limit = 5000
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('after', int, description='next_after of the previous batch, 0 to start'),
+            OpenApiParameter('limit', int, description='Batch size (max 5000)'),
+            OpenApiParameter('type', str, description='Comma separated event types'),
+        ],
+        responses={200: OutboxEventPageSerializer}
+    )
+    def get(self, request):
+        is_admin, error_response = check_admin_permission(request)
+        if not is_admin:
+            return error_response
+        
+        try:
+            after = int(request.GET.get('after') or 0)
+            limit = int(request.GET.get('limit', self.default_limit))
+        except ValueError:
+            return Response(
+                {
+                    'error': 'Validation error',
+                    'detail': 'after and limit must be integers'
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = max(1, min(limit, self.max_limit))
+        
+        # Keyset batch along the primary key; plain dicts, as batches are large
+        events = OutboxEvent.objects.filter(id__gt=after)
+        event_types = request.GET.get('type')
+        if event_types:
+            events = events.filter(type__in=event_types.split(','))
+        rows = list(
+            events.order_by('id').values('id', 'type', 'member_id', 'payload', 'created_at')[:limit + 1]
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        return Response(
+            {
+                'events': rows,
+                'next_after': rows[-1]['id'] if rows else after,
+                'has_more': has_more
+            },
+            status=status.HTTP_200_OK
+        )
+
+
+class HealthLiveView(APIView):
+    """
+    Liveness probe: the worker is up and answering, no dependencies checked
+    """
+    authentication_classes = []
+    permission_classes = []
+
+    @extend_schema(
+        responses={200: HealthSerializer},
+        description="Liveness probe, answered without touching the database"
+    )
+    def get(self, request):
+        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
+
+
+class HealthReadyView(APIView):
+    """
+    Readiness probe: database reachable, write lock obtainable, migrations
+    applied. Answers 503 when the worker should be taken out of rotation.
+    Per-check details are only shown to admins and local addresses.
+    """
+    authentication_classes = [CookieAuthentication]
+    permission_classes = []
+
+    @extend_schema(
+        responses={200: HealthSerializer, 503: HealthSerializer},
+        description="Readiness probe with database, write lock, migration and "
+                    "background job checks; results are cached for a second"
+    )
+    def get(self, request):
+        result, cached = health.readiness()
+        is_admin = request.user and not request.user.is_anonymous and request.user.is_admin
+        if not (is_admin or is_local_request(request)):
+            result = health.public_result(result)
+        response = Response(
+            dict(result, cached=cached),
+            status=status.HTTP_200_OK if result['status'] == 'ok' else status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        if result['status'] != 'ok':
+            response['Retry-After'] = str(max(int(settings.HEALTH_CACHE_SECONDS), 1))
+        response['Cache-Control'] = 'no-store'
+        return response
+
+
+def is_local_request(request):
+    """
+    Whether the client is on an allowed local address. nginx always sets
+    X-Real-IP, and gunicorn only listens on localhost, so the header can't
+    be forged from outside.
+    """
+    return client_ip(request) in settings.METRICS_ALLOWED_IPS
+
+
+class MetricsView(APIView):
+    """
+    Prometheus metrics (admins or local addresses only)
+    """
+    authentication_classes = [CookieAuthentication]
+    permission_classes = []
+    renderer_classes = [PrometheusTextRenderer] + api_settings.DEFAULT_RENDERER_CLASSES
+
+    @extend_schema(
+        responses={200: OpenApiTypes.STR},
+        description="Request, database, cache and business metrics of all workers "
+                    "in the Prometheus text format"
+    )
+    def get(self, request):
+        if not is_local_request(request):
+            is_admin, error_response = check_admin_permission(request)
+            if not is_admin:
+                return error_response
+
+        counters, histograms, workers = metrics.collect()
+
+        lookups = {}
+        for (name, labels), value in counters.items():
+            if name == 'response_cache_lookups_total':
+                labels = dict(labels)
+                hits_and_total = lookups.setdefault(labels['endpoint'], [0, 0])
+                hits_and_total[0] += value if labels['result'] == 'hit' else 0
+                hits_and_total[1] += value
+
+        pending = Transaction.objects.filter(type='deposit', status='pending').aggregate(
+            count=Count('id'),
+            oldest=Min('created_at')
+        )
+        oldest_age = (timezone.now() - pending['oldest']).total_seconds() if pending['oldest'] else 0
+
+        gauges = [
+            ('gunicorn_workers', 'Live gunicorn worker processes', [({}, workers)]),
+            ('pending_deposits', 'Deposits waiting for confirmation', [({}, pending['count'])]),
+            ('pending_deposits_oldest_age_seconds', 'Age of the oldest pending deposit',
+             [({}, round(oldest_age, 3))]),
+            ('response_cache_hit_ratio', 'Share of response cache lookups served from the cache', [
+                ({'endpoint': endpoint}, round(hits / total, 4))
+                for endpoint, (hits, total) in sorted(lookups.items())
+            ]),
+        ]
+        return Response(metrics.render(counters, histograms, gauges))
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -85,13 +86,16 @@ SPECTACULAR_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    "api.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    "api.admission.AdmissionControlMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "api.profiling.ProfilingMiddleware",
 ]
 
 ROOT_URLCONF = "config.urls"
@@ -121,9 +125,129 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "persistent" / "db" / "db.sqlite3",
+        "OPTIONS": {
+            # Wait for short write locks (e.g. backfill chunks) instead of
+            # failing with "database is locked", and let readers run
+            # alongside a writer
+            "timeout": 20,
+            "init_command": "PRAGMA journal_mode=WAL;",
+        },
     }
 }
 
+# Run data backfills inline during migrate; set to "0" to only create their
+# checkpoints and finish them online with `manage.py backfill <name>`
+BACKFILL_IN_MIGRATIONS = os.environ.get("BACKFILL_IN_MIGRATIONS", "1") == "1"
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# locmem is per worker process; point DJANGO_CACHE_BACKEND at
+# django.core.cache.backends.filebased.FileBasedCache to share it between
+# gunicorn workers.
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.environ.get("DJANGO_CACHE_LOCATION", "easyapp-default"),
+    }
+}
+
+# Seconds a per-member cached API response is kept
+RESPONSE_CACHE_TIMEOUT = int(os.environ.get("RESPONSE_CACHE_TIMEOUT", 300))
+
+
+# In-memory referral graph (api.graph): seconds between incremental refreshes,
+# seconds between full rebuilds and overlay size forcing an early rebuild
+REFERRAL_GRAPH_REFRESH_SECONDS = float(
+    os.environ.get("REFERRAL_GRAPH_REFRESH_SECONDS", 1)
+)
+REFERRAL_GRAPH_REBUILD_SECONDS = float(
+    os.environ.get("REFERRAL_GRAPH_REBUILD_SECONDS", 3600)
+)
+REFERRAL_GRAPH_MAX_OVERLAY = int(os.environ.get("REFERRAL_GRAPH_MAX_OVERLAY", 50000))
+
+
+# Request profiling (api.profiling): admins profile a request on demand with
+# the X-Profile: 1 header or ?_profile=1; a sample rate above 0 also
+# profiles that share of all requests. Only the newest files are kept.
+PROFILING_DIR = os.environ.get("PROFILING_DIR", BASE_DIR / "persistent" / "profiles")
+PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", 0))
+PROFILING_MAX_FILES = int(os.environ.get("PROFILING_MAX_FILES", 200))
+
+# Slow-query log (api.slow_queries): statements slower than SLOW_QUERY_MS
+# (0 disables) are appended to SLOW_QUERY_LOG, with a query plan captured
+# once per fingerprint every SLOW_QUERY_PLAN_SECONDS
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+SLOW_QUERY_LOG = os.environ.get(
+    "SLOW_QUERY_LOG", BASE_DIR / "persistent" / "logs" / "slow_queries.jsonl"
+)
+SLOW_QUERY_LOG_MAX_BYTES = int(os.environ.get("SLOW_QUERY_LOG_MAX_BYTES", 10 * 1024 * 1024))
+SLOW_QUERY_PLAN_SECONDS = int(os.environ.get("SLOW_QUERY_PLAN_SECONDS", 86400))
+
+# Prometheus metrics (api.metrics): one file per process in METRICS_DIR,
+# emptied when gunicorn starts and merged on every /api/metrics scrape.
+# The endpoint is open to these client addresses, otherwise admins only.
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), "easyapp-metrics")
+)
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 1))
+METRICS_ALLOWED_IPS = os.environ.get("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+
+# Readiness probe (api.health): seconds a result is reused by the worker and
+# how long the SQLite write lock probe may wait before failing
+HEALTH_CACHE_SECONDS = float(os.environ.get("HEALTH_CACHE_SECONDS", 1))
+HEALTH_WRITE_LOCK_TIMEOUT_MS = int(os.environ.get("HEALTH_WRITE_LOCK_TIMEOUT_MS", 1000))
+
+# Admission control (api.admission): token buckets per route class as
+# (tokens per second, burst) for the whole site ("global", answered with 503
+# when empty), per client IP and per member (429). Buckets live in the
+# default cache, so they are per worker with locmem: the global rates are
+# then divided by ADMISSION_WORKERS (the gunicorn worker count), and a client
+# spread over workers may get up to that many times its own limits.
+# Requests that waited longer than ADMISSION_MAX_QUEUE_WAIT seconds before
+# reaching a worker (nginx X-Request-Start) are shed with 503. "auth" is only
+# the credential POSTs (login, register, logout).
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1") == "1"
+ADMISSION_RATES = {
+    "auth": {"global": (20, 40), "ip": (2, 20)},
+    "read": {"global": (200, 400), "ip": (20, 100), "member": (10, 50)},
+    "write": {"global": (50, 100), "ip": (5, 20), "member": (2, 10)},
+    "admin": {"global": (20, 40), "member": (10, 50)},
+}
+ADMISSION_MAX_QUEUE_WAIT = float(os.environ.get("ADMISSION_MAX_QUEUE_WAIT", 10))
+ADMISSION_WORKERS = (
+    int(os.environ.get("GUNICORN_WORKERS", 1))
+    if CACHES["default"]["BACKEND"].endswith(".LocMemCache") else 1
+)
+
+# Idempotency keys (api.idempotency): responses of money endpoints sent with
+# an Idempotency-Key header are replayed to retries for this many hours,
+# after which manage.py purge_idempotency_keys deletes them
+IDEMPOTENCY_KEY_TTL_HOURS = float(os.environ.get("IDEMPOTENCY_KEY_TTL_HOURS", 24))
+
+# Server-sent events (api.sse, manage.py sse_server): the stream server
+# listens on SSE_HOST:SSE_PORT behind nginx and is woken up by web workers
+# through UDP on SSE_NOTIFY_PORT (0 disables), otherwise it polls the
+# outbox every SSE_POLL_SECONDS. Reconnects further than SSE_REPLAY_WINDOW
+# events behind get a resync instead of a replay.
+SSE_HOST = os.environ.get("SSE_HOST", "127.0.0.1")
+SSE_PORT = int(os.environ.get("SSE_PORT", 8002))
+SSE_NOTIFY_PORT = int(os.environ.get("SSE_NOTIFY_PORT", 8003))
+SSE_POLL_SECONDS = float(os.environ.get("SSE_POLL_SECONDS", 5))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", 15))
+SSE_MAX_CONNECTIONS = int(os.environ.get("SSE_MAX_CONNECTIONS", 10000))
+SSE_MAX_STREAMS_PER_MEMBER = int(os.environ.get("SSE_MAX_STREAMS_PER_MEMBER", 10))
+SSE_REPLAY_WINDOW = int(os.environ.get("SSE_REPLAY_WINDOW", 10000))
+
+# Balance ledger (api.models.LedgerEntry): a balance snapshot is written
+# every LEDGER_SNAPSHOT_INTERVAL entries of a member and currency, which
+# bounds the entries read to compute a balance at any point in time.
+# manage.py reconcile_ledger checks the ledger against member balances.
+LEDGER_SNAPSHOT_INTERVAL = int(os.environ.get("LEDGER_SNAPSHOT_INTERVAL", 100))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -1,10 +1,13 @@
 """Gunicorn configuration for Docker deployment"""
+import os
 
 # Server socket - bind to different port for nginx upstream
 bind = "127.0.0.1:8001"
 
-# Worker processes
-workers = 2
+# Worker processes; the count is passed on to Django, which splits the
+# site-wide admission rates between workers keeping their own buckets
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+raw_env = [f"GUNICORN_WORKERS={workers}"]
 worker_class = "sync"
 worker_connections = 1000
 max_requests = 10000
@@ -36,3 +39,26 @@ limit_request_field_size = 8190
 
 # Preload app for better performance
 preload_app = True
+
+
+def when_ready(server):
+    """
+    Build the referral graph in the master so workers share it
+    copy-on-write, and start from empty metrics
+    """
+    from django.db import connections
+
+    from api.graph import warm_referral_graph
+    from api.metrics import reset_metrics
+
+    reset_metrics()
+    warm_referral_graph()
+    # Forked workers must not reuse the master's database connection
+    connections.close_all()
+
+
+def post_fork(server, worker):
+    """Register the worker so /api/metrics counts it"""
+    from api.metrics import register_worker
+
+    register_worker()